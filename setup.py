@@ -24,7 +24,8 @@ setup(
         'Programming Language :: Python :: 2.6'
     ],
     url='https://github.com/Cerberus98/yagi',
-    scripts=['bin/yagi-feed', 'bin/yagi-event'],
+    scripts=['bin/yagi-feed', 'bin/yagi-event', 'bin/yagi-replay',
+             'bin/yagi-migrate', 'bin/yagi-recode'],
     long_description=read('README.md'),
     install_requires=['anyjson',
                         'redis',
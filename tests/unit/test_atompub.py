@@ -1,4 +1,8 @@
 import functools
+import json
+import shutil
+import tempfile
+import time
 import unittest
 
 import httplib2
@@ -36,7 +40,9 @@ class AtomPubTests(unittest.TestCase):
                 'interval': 30,
                 'max_wait': 600,
                 'retries': 1,
-                'failures_before_reauth': 5
+                'failures_before_reauth': 5,
+                'pool_max_idle': 60,
+                'pool_max_age': 3600
             },
             'event_feed': {
                 'feed_title': 'feed_title',
@@ -99,3 +105,202 @@ class AtomPubTests(unittest.TestCase):
         self.stubs.Set(httplib2.Http, 'request', mock_request)
         self.handler.handle_messages(messages, dict())
         self.assertEqual(self.called, True)
+
+    def test_notify_concurrent(self):
+        messages = [MockMessage({'event_type': 'instance_create',
+                                 'message_id': i,
+                                 'content': dict(a=3)}) for i in range(10)]
+        self.handler.config_get = lambda key, default=None: dict(
+            concurrency='4', retries='1', interval='0', max_wait='0',
+            failures_before_reauth='5', url='http://127.0.0.1/',
+            validate_ssl='False', pool_max_idle='60',
+            pool_max_age='3600').get(key, default)
+
+        def mock_request(*args, **kwargs):
+            return MockResponse(201), None
+
+        self.stubs.Set(httplib2.Http, 'request', mock_request)
+        env = dict()
+        self.handler.handle_messages(messages, env)
+        results = env['atompub.results']
+        self.assertEqual(sorted(results.keys()), range(10))
+        self.assertTrue(all(r['code'] == 201 for r in results.values()))
+        self.assertTrue(all(m.acknowledged for m in messages))
+
+    def test_concurrent_failures_not_acked(self):
+        messages = [MockMessage({'event_type': 'instance_create',
+                                 'message_id': i,
+                                 'content': dict(a=3)}) for i in range(4)]
+        self.handler.config_get = lambda key, default=None: dict(
+            concurrency='2', retries='1', interval='0', max_wait='0',
+            failures_before_reauth='5', url='http://127.0.0.1/',
+            validate_ssl='False', pool_max_idle='60',
+            pool_max_age='3600').get(key, default)
+
+        class Pool(object):
+            gets = []
+
+            def get(pool):
+                pool.gets.append(1)
+                if len(pool.gets) == 1:
+                    raise Exception("Invalid auth or no auth supplied")
+                return httplib2.Http(), {}
+
+            def put(pool, conn, headers):
+                pass
+
+            def discard(pool, conn):
+                pass
+
+        def mock_request(*args, **kwargs):
+            return MockResponse(201), None
+
+        self.stubs.Set(httplib2.Http, 'request', mock_request)
+        self.handler.connection_pool = lambda: Pool()
+        env = dict()
+        self.assertRaises(Exception, self.handler.handle_messages, messages,
+                          env)
+        unacked = [m for m in messages if not m.acknowledged]
+        self.assertEqual(len(unacked), 1)
+        results = env['atompub.results']
+        self.assertTrue(results[unacked[0].payload['message_id']]['error'])
+        self.assertEqual(len(results), 4)
+
+    def _batch_config(self):
+        self.handler.config_get = lambda key, default=None: dict(
+            batch_size='3', retries='1', interval='0', max_wait='0',
+            failures_before_reauth='5', url='http://127.0.0.1/',
+            validate_ssl='False', pool_max_idle='60',
+            pool_max_age='3600').get(key, default)
+
+    def test_notify_batched(self):
+        messages = [MockMessage({'event_type': 'instance_create',
+                                 'message_id': i,
+                                 'content': dict(a=3)}) for i in range(4)]
+        self._batch_config()
+        self.called = []
+
+        def mock_request(*args, **kwargs):
+            body = kwargs['body']
+            self.called.append(body.count('<entry'))
+            if body.count('<entry') > 1:
+                # Entry 1 didn't make it, the rest did
+                return MockResponse(207), json.dumps(
+                    dict(entries={'0': 201, '1': 500, '2': 409}))
+            return MockResponse(201), None
+
+        self.stubs.Set(httplib2.Http, 'request', mock_request)
+        env = dict()
+        self.handler.handle_messages(messages, env)
+        # A batch of 3, entry 1 again on its own, then the last entry
+        # in a batch of one.
+        self.assertEqual(self.called, [3, 1, 1])
+        results = env['atompub.results']
+        self.assertEqual(sorted(results.keys()), range(4))
+        self.assertEqual(results[1]['code'], 201)
+        self.assertEqual(results[2]['code'], 409)
+        self.assertTrue(all(m.acknowledged for m in messages))
+        self.assertTrue(self.handler.batch_supported)
+
+    def test_batch_rejected_falls_back(self):
+        messages = [MockMessage({'event_type': 'instance_create',
+                                 'message_id': i,
+                                 'content': dict(a=3)}) for i in range(3)]
+        self._batch_config()
+        self.called = []
+
+        def mock_request(*args, **kwargs):
+            self.called.append(kwargs['body'].count('<entry'))
+            if kwargs['body'].count('<entry') > 1:
+                return MockResponse(415), None
+            return MockResponse(201), None
+
+        self.stubs.Set(httplib2.Http, 'request', mock_request)
+        env = dict()
+        self.handler.handle_messages(messages, env)
+        self.assertEqual(self.called, [3, 1, 1, 1])
+        self.assertFalse(self.handler.batch_supported)
+        results = env['atompub.results']
+        self.assertTrue(all(r['code'] == 201 for r in results.values()))
+        self.assertTrue(all(m.acknowledged for m in messages))
+
+    def test_failed_delivery_spooled(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        messages = [MockMessage({'event_type': 'instance_create',
+                                 'message_id': 1,
+                                 'content': dict(a=3)})]
+        self.handler.config_get = lambda key, default=None: dict(
+            retries='5', interval='30', max_wait='600',
+            failures_before_reauth='5', url='http://127.0.0.1/',
+            validate_ssl='False', pool_max_idle='60', pool_max_age='3600',
+            retry_mode='scheduled', spool_dir=spool_dir,
+            dead_letter_file=spool_dir + '/dead').get(key, default)
+
+        def mock_request(*args, **kwargs):
+            return MockResponse(500), None
+
+        def no_sleep(*args):
+            self.fail("Should not sleep with a retry scheduler")
+
+        self.stubs.Set(httplib2.Http, 'request', mock_request)
+        self.stubs.Set(time, 'sleep', no_sleep)
+        env = dict()
+        self.handler.handle_messages(messages, env)
+        self.addCleanup(self.handler.scheduler.stop)
+        self.assertEqual(env['atompub.results'][1]['code'], 500)
+        self.assertEqual(len(self.handler.scheduler), 1)
+        self.assertTrue(messages[0].acknowledged)
+
+    def test_redeliver_settles_probe_without_connection(self):
+        self.handler.config_get = lambda key, default=None: dict(
+            url='http://127.0.0.1/', circuit_breaker='True',
+            breaker_failure_rate='0.5', breaker_window='2',
+            breaker_min_calls='2', breaker_reset_timeout='30',
+            validate_ssl='False', pool_max_idle='60',
+            pool_max_age='3600').get(key, default)
+        breaker = self.handler.circuit_breaker('http://127.0.0.1/')
+        breaker.failure()
+        breaker.failure()
+        breaker.opened_at = time.time() - 31
+
+        class BrokenPool(object):
+            def get(pool):
+                raise IOError("Connection refused")
+
+        self.handler.connection_pool = lambda: BrokenPool()
+        self.assertRaises(IOError, self.handler._redeliver,
+                          dict(id=1, body='{}'))
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.probing)
+
+    def test_open_circuit_spools_without_sending(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        messages = [MockMessage({'event_type': 'instance_create',
+                                 'message_id': i,
+                                 'content': dict(a=3)}) for i in range(5)]
+        self.handler.config_get = lambda key, default=None: dict(
+            retries='5', interval='30', max_wait='600',
+            failures_before_reauth='5', url='http://127.0.0.1/',
+            validate_ssl='False', pool_max_idle='60', pool_max_age='3600',
+            retry_mode='scheduled', spool_dir=spool_dir,
+            dead_letter_file=spool_dir + '/dead', circuit_breaker='True',
+            breaker_failure_rate='0.5', breaker_window='2',
+            breaker_min_calls='2',
+            breaker_reset_timeout='30').get(key, default)
+        self.requests = 0
+
+        def mock_request(*args, **kwargs):
+            self.requests += 1
+            return MockResponse(503), None
+
+        self.stubs.Set(httplib2.Http, 'request', mock_request)
+        env = dict()
+        self.handler.handle_messages(messages, env)
+        self.addCleanup(self.handler.scheduler.stop)
+        # Two failures open the breaker, the rest go straight to the spool.
+        self.assertEqual(self.requests, 2)
+        self.assertEqual(len(self.handler.scheduler), 5)
+        self.assertEqual(env['atompub.results'][4]['message'],
+                         "Circuit open, queued for retry")
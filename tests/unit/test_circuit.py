@@ -0,0 +1,52 @@
+import time
+import unittest
+
+import yagi.circuit
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = yagi.circuit.CircuitBreaker('test', failure_rate=0.5,
+                                                   window=4, min_calls=4,
+                                                   reset_timeout=30)
+
+    def test_opens_at_failure_rate(self):
+        for outcome in (True, False, True):
+            if outcome:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+        self.assertEqual(self.breaker.state, yagi.circuit.CLOSED)
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, yagi.circuit.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertTrue(0 < self.breaker.retry_after() <= 30)
+
+    def test_single_probe_when_half_open(self):
+        for i in range(4):
+            self.breaker.failure()
+        self.breaker.opened_at = time.time() - 31
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, yagi.circuit.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, yagi.circuit.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        for i in range(4):
+            self.breaker.failure()
+        self.breaker.opened_at = time.time() - 31
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, yagi.circuit.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_lost_probe_given_up(self):
+        for i in range(4):
+            self.breaker.failure()
+        self.breaker.opened_at = time.time() - 31
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.probe_started = time.time() - 31
+        self.assertTrue(self.breaker.allow())
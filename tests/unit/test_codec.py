@@ -0,0 +1,43 @@
+import json
+import unittest
+
+import yagi.persistence.codec
+from yagi.persistence.codec import Codec, CodecError
+
+
+DOC = {u'event_type': u'compute.instance.exists',
+       u'content': {u'payload': {u'state': u'active' * 50,
+                                 u'memory_mb': 512}}}
+
+
+class CodecTests(unittest.TestCase):
+    def test_json_round_trip(self):
+        codec = Codec()
+        value = codec.encode(DOC)
+        self.assertTrue(value.startswith('j{'))
+        self.assertEqual(codec.decode(value), DOC)
+
+    def test_untagged_values_read_as_json(self):
+        self.assertEqual(Codec().decode(json.dumps(DOC)), DOC)
+
+    def test_compressed_above_threshold(self):
+        codec = Codec(compress_min_size=100)
+        value = codec.encode(DOC)
+        self.assertTrue(value.startswith('zj'))
+        self.assertTrue(len(value) < len(Codec().encode(DOC)))
+        self.assertEqual(Codec().decode(value), DOC)
+        small = {u'event_type': u'a', u'content': {}}
+        self.assertTrue(codec.encode(small).startswith('j'))
+
+    def test_msgpack(self):
+        if yagi.persistence.codec.msgpack is None:
+            self.assertRaises(CodecError, Codec, 'msgpack')
+            return
+        codec = Codec('msgpack', compress_min_size=100)
+        value = codec.encode(DOC)
+        self.assertTrue(value.startswith('zm'))
+        self.assertEqual(Codec().decode(value), DOC)
+
+    def test_unknown(self):
+        self.assertRaises(CodecError, Codec, 'xml')
+        self.assertRaises(CodecError, Codec().decode, 'q123')
@@ -0,0 +1,241 @@
+import threading
+import unittest
+
+import yagi.consumer
+import yagi.handler
+
+
+class MockChannel(object):
+    def __init__(self):
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+
+class MockBackend(object):
+    def __init__(self):
+        self.channel = MockChannel()
+
+
+class MockMessage(object):
+    def __init__(self, delivery_tag, backend=None, payload=None,
+                 redelivered=False):
+        self.delivery_tag = delivery_tag
+        self.backend = backend
+        self.payload = payload or {}
+        self.delivery_info = dict(redelivered=redelivered)
+        self._state = None
+
+    @property
+    def acknowledged(self):
+        return self._state is not None
+
+    def ack(self):
+        self._state = "ACK"
+
+    def requeue(self):
+        self._state = "REQUEUED"
+
+    def reject(self):
+        self._state = "REJECTED"
+
+
+class AckTests(unittest.TestCase):
+    def test_single_multiple_ack(self):
+        backend = MockBackend()
+        messages = [MockMessage(tag, backend) for tag in (3, 5, 4)]
+        yagi.consumer.ack_messages(messages)
+        self.assertEqual(backend.channel.acks, [(5, True)])
+        self.assertTrue(all(m.acknowledged for m in messages))
+
+    def test_requeued_messages_not_acked(self):
+        backend = MockBackend()
+        messages = [MockMessage(tag, backend) for tag in (1, 2, 3)]
+        yagi.consumer.requeue_messages(messages[2:])
+        yagi.consumer.ack_messages(messages)
+        self.assertEqual(backend.channel.acks, [(2, True)])
+        self.assertEqual(messages[2]._state, "REQUEUED")
+
+    def test_ack_without_channel(self):
+        messages = [MockMessage(1), MockMessage(2)]
+        yagi.consumer.ack_messages(messages)
+        self.assertTrue(all(m.acknowledged for m in messages))
+
+    def test_handler_skips_ack_after_chain(self):
+        class Handler(yagi.handler.BaseHandler):
+            AUTO_ACK = True
+
+        messages = [MockMessage(1), MockMessage(2)]
+        handler = Handler()
+        env = {'yagi.ack_policy': 'after_chain'}
+        list(handler.iterate_payloads(messages, env))
+        self.assertFalse(any(m.acknowledged for m in messages))
+        list(handler.iterate_payloads(messages, {}))
+        self.assertTrue(all(m.acknowledged for m in messages))
+
+
+class EnvelopeTests(unittest.TestCase):
+    def test_filtered_once_for_the_chain(self):
+        calls = []
+
+        def offset(payload):
+            calls.append(payload['message_id'])
+            payload['hour'] += 1
+            return payload
+
+        class Handler(yagi.handler.BaseHandler):
+            def handle_messages(self, messages, env):
+                self.seen = list(self.iterate_payloads(messages, env))
+
+        first = Handler()
+        second = Handler(first)
+        message = MockMessage(1, payload=dict(message_id=7, hour=1,
+                                              event_type='compute.start'))
+        envelope = yagi.consumer.Envelope(message, [offset])
+        second([envelope], env={})
+        self.assertEqual(calls, [7])
+        self.assertEqual(first.seen, [dict(message_id=7, hour=2,
+                                           event_type='compute.start')])
+        self.assertEqual(second.seen, first.seen)
+        self.assertEqual(envelope.raw_payload['hour'], 1)
+        self.assertEqual(envelope.message_id, 7)
+        self.assertEqual(envelope.event_type, 'compute.start')
+
+    def test_envelopes_acked_as_batch(self):
+        backend = MockBackend()
+        envelopes = [yagi.consumer.Envelope(MockMessage(tag, backend))
+                     for tag in (1, 2)]
+        yagi.consumer.ack_messages(envelopes)
+        self.assertEqual(backend.channel.acks, [(2, True)])
+        self.assertTrue(all(e.acknowledged for e in envelopes))
+
+    def test_bad_message_rejected_alone(self):
+        def broken(payload):
+            if payload['n'] == 2:
+                raise ValueError("Can't filter")
+            return payload
+
+        seen = []
+        consumer = yagi.consumer.Consumer.__new__(yagi.consumer.Consumer)
+        consumer.queue_name = 'notifications.info'
+        consumer.filters = [broken]
+        consumer.ack_policy = 'after_chain'
+        consumer.batch_sizer = None
+        consumer.app = lambda messages, env: seen.extend(messages)
+        messages = [MockMessage(tag, payload=dict(n=tag))
+                    for tag in (1, 2, 3)]
+        consumer.fetched_messages(messages)
+        self.assertEqual([e.payload['n'] for e in seen], [1, 3])
+        self.assertEqual([m._state for m in messages],
+                         ["ACK", "REJECTED", "ACK"])
+
+    def test_failed_chain_requeues_marked_once(self):
+        consumer = yagi.consumer.Consumer.__new__(yagi.consumer.Consumer)
+        consumer.queue_name = 'notifications.info'
+        consumer.filters = []
+        consumer.ack_policy = 'after_chain'
+        consumer.batch_sizer = None
+
+        def app(messages, env):
+            env['yagi.requeue'] = messages[1:]
+            raise IOError("Endpoint down")
+
+        consumer.app = app
+        messages = [MockMessage(1), MockMessage(2),
+                    MockMessage(3, redelivered=True)]
+        consumer.fetched_messages(messages)
+        self.assertEqual([m._state for m in messages],
+                         ["ACK", "REQUEUED", "REJECTED"])
+
+        def broken(messages, env):
+            raise IOError("Endpoint down")
+
+        consumer.app = broken
+        messages = [MockMessage(1), MockMessage(2, redelivered=True)]
+        consumer.fetched_messages(messages)
+        self.assertEqual([m._state for m in messages],
+                         ["REQUEUED", "REJECTED"])
+
+
+class Provider(yagi.handler.BaseHandler):
+    PROVIDES = ('results',)
+
+    def handle_messages(self, messages, env):
+        env['results'] = len(messages)
+
+
+class Dependent(yagi.handler.BaseHandler):
+    REQUIRES = ('results',)
+
+    def handle_messages(self, messages, env):
+        env['seen'] = env['results']
+
+
+class Independent(yagi.handler.BaseHandler):
+    def __init__(self, started, other_started):
+        super(Independent, self).__init__()
+        self.started = started
+        self.other_started = other_started
+
+    def handle_messages(self, messages, env):
+        self.started.set()
+        # Only returns if the other handler runs at the same time.
+        self.other_started.wait(5)
+        env.setdefault('overlapped', []).append(
+            self.other_started.is_set())
+
+
+class ConcurrentChainTests(unittest.TestCase):
+    def test_levels(self):
+        provider, dependent, other = Provider(), Dependent(), Independent(
+            None, None)
+        levels = yagi.consumer.dependency_levels([provider, dependent,
+                                                  other])
+        self.assertEqual(levels, [[provider, other], [dependent]])
+
+    def test_independent_apps_overlap(self):
+        first, second = threading.Event(), threading.Event()
+        chain = yagi.consumer.ConcurrentChain([
+            Independent(first, second), Provider(),
+            Independent(second, first), Dependent()])
+        env = chain([MockMessage(1), MockMessage(2)])
+        self.assertEqual(env['overlapped'], [True, True])
+        self.assertEqual(env['seen'], 2)
+
+    def test_failure_skips_later_levels(self):
+        class Broken(Provider):
+            def handle_messages(self, messages, env):
+                raise ValueError("broken")
+
+        chain = yagi.consumer.ConcurrentChain([Broken(), Dependent()])
+        env = {}
+        self.assertRaises(ValueError, chain, [MockMessage(1)], env)
+        self.assertFalse('seen' in env)
+
+
+class BatchSizerTests(unittest.TestCase):
+    def test_shrinks_to_target_latency(self):
+        sizer = yagi.consumer.BatchSizer(10, 1000, target_latency=1.0)
+        self.assertEqual(sizer.update(1000, 4.0, 0), 250)
+
+    def test_shrinks_to_byte_budget(self):
+        sizer = yagi.consumer.BatchSizer(10, 1000, max_bytes=1000)
+        self.assertEqual(sizer.update(1000, 0.1, 4000), 250)
+
+    def test_grows_full_batches(self):
+        sizer = yagi.consumer.BatchSizer(10, 1000, target_latency=1.0)
+        sizer.size = 100
+        self.assertEqual(sizer.update(100, 0.8, 0), 125)
+        self.assertEqual(sizer.update(125, 0.1, 0), 187)
+
+    def test_partial_batch_keeps_size(self):
+        sizer = yagi.consumer.BatchSizer(10, 1000, target_latency=1.0)
+        sizer.size = 100
+        self.assertEqual(sizer.update(5, 0.01, 0), 100)
+
+    def test_bounds(self):
+        sizer = yagi.consumer.BatchSizer(10, 1000, target_latency=1.0)
+        self.assertEqual(sizer.update(1000, 1000.0, 0), 10)
+        sizer.size = 900
+        self.assertEqual(sizer.update(900, 0.01, 0), 1000)
@@ -0,0 +1,26 @@
+import unittest
+
+import yagi.event_worker
+
+
+class EventWorkerTests(unittest.TestCase):
+    def test_shard_by_queue(self):
+        consumers = ['a', 'b', 'c']
+        shards = [yagi.event_worker.shard_consumers(consumers, 2, i, 'queues')
+                  for i in range(2)]
+        self.assertEqual(shards, [['a', 'c'], ['b']])
+
+    def test_shard_all(self):
+        consumers = ['a', 'b', 'c']
+        shard = yagi.event_worker.shard_consumers(consumers, 2, 1, 'all')
+        self.assertEqual(shard, consumers)
+
+    def test_worker_stats_wait_for_every_worker(self):
+        stats = yagi.event_worker.WorkerStats(2)
+        logged = []
+        stats.log = lambda: logged.append(dict(stats.reports))
+        stats.update(0, dict(messages_sent={'a': 1}, elapsed=300))
+        self.assertEqual(logged, [])
+        stats.update(1, dict(messages_sent={'a': 2}, elapsed=300))
+        self.assertEqual(len(logged), 1)
+        self.assertEqual(stats.reports, {})
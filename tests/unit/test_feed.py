@@ -1,9 +1,19 @@
+import re
 import unittest
+import zlib
 
+import eventlet
 import stubout
 import webob
 
+import yagi.config
+import yagi.feed.cache
+import yagi.feed.compression
 import yagi.feed.feed
+import yagi.persistence
+import yagi.serializer
+import yagi.serializer.atom
+import yagi.supervisor
 
 
 class FeedTests(unittest.TestCase):
@@ -77,3 +87,309 @@ class FeedTests(unittest.TestCase):
         req = webob.Request.blank('/instance/')
         req.get_response(feed.route_request)
         self.assertEqual(self.called, True)
+
+    def test_get_all_with_marker(self):
+        class Driver(object):
+            def get_range(driver, key, marker, limit, direction):
+                self.args = (key, marker, limit, direction)
+                return [dict(id='b'), dict(id='c')], True, True
+
+        def mock_respond(feed, req, elements, **links):
+            self.links = links
+
+        self.stubs.Set(yagi.feed.feed.EventFeed, 'respond', mock_respond)
+        feed = yagi.feed.feed.EventFeed()
+        feed.db_driver = Driver()
+        feed.pagesize = 100
+        feed.stream = False
+        req = webob.Request.blank('/instance?marker=a&limit=500')
+        req.get_response(feed.route_request)
+        self.assertEqual(self.args, ('instance', 'a', 100, 'older'))
+        self.assertEqual(self.links, dict(previous_marker='c',
+                                          next_marker='b', limit=100,
+                                          path='instance', archive=False))
+
+
+class MockSerializer(object):
+    __name__ = 'mock_serializer'
+
+    def dumps(self, elements, **kwargs):
+        return ','.join(e['id'] for e in elements)
+
+
+class MockDriver(object):
+    def __init__(self):
+        self.current_version = '1'
+        self.reads = 0
+
+    def version(self):
+        return self.current_version
+
+    def get_range(self, key, marker, limit, direction):
+        self.reads += 1
+        if marker:
+            return [dict(id='b'), dict(id='c')], True, True
+        return [dict(id='a')], False, True
+
+    def get_page(self, key, page_size, page):
+        self.reads += 1
+        return [dict(id='a')], 0, 1
+
+
+class FeedCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.driver = MockDriver()
+        self.config = dict(pagesize='2', cache_size='10',
+                           archive_max_age='60', stream=False,
+                           compression='gzip, deflate', compression_level='6',
+                           compression_min_size='0',
+                           stream_cache_max_size='1048576')
+        self.stubs.Set(yagi.config, 'get',
+                       lambda section, key, default=None: self.config[key])
+        self.stubs.Set(yagi.config, 'get_bool',
+                       lambda section, key, default=None: self.config[key])
+        self.stubs.Set(yagi.persistence, 'persistence_driver',
+                       lambda: self.driver)
+        self.stubs.Set(yagi.serializer, 'feed_serializer', MockSerializer)
+        self.feed = yagi.feed.feed.EventFeed()
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def get(self, path, **headers):
+        req = webob.Request.blank(path, headers=headers)
+        return req.get_response(self.feed.serve)
+
+    def test_head_page_cached_until_write(self):
+        first = self.get('/')
+        self.assertEqual(first.body, 'a')
+        self.assertEqual(first.headers['Cache-Control'], 'no-cache')
+        self.assertTrue(first.etag)
+        self.assertEqual(self.get('/').etag, first.etag)
+        self.assertEqual(self.driver.reads, 1)
+        not_modified = self.get('/', **{'If-None-Match': '"%s"' % first.etag})
+        self.assertEqual(not_modified.status_int, 304)
+        self.assertEqual(self.driver.reads, 1)
+        self.driver.current_version = '2'
+        self.assertEqual(self.get('/').body, 'a')
+        self.assertEqual(self.driver.reads, 2)
+
+    def test_archived_page_kept(self):
+        archived = self.get('/?marker=a')
+        self.assertTrue('immutable' in archived.headers['Cache-Control'])
+        self.driver.current_version = '2'
+        self.assertEqual(self.get('/?marker=a').body, 'b,c')
+        self.assertEqual(self.driver.reads, 1)
+
+    def test_only_older_marker_pages_archived(self):
+        newer = self.get('/?marker=a&direction=newer')
+        self.assertEqual(newer.headers['Cache-Control'], 'no-cache')
+        self.driver.current_version = '2'
+        self.get('/?marker=a&direction=newer')
+        self.assertEqual(self.driver.reads, 2)
+
+    def test_numbered_pages_not_archived(self):
+        page = self.get('/?page=0')
+        self.assertEqual(page.headers['Cache-Control'], 'no-cache')
+        self.get('/?page=0')
+        self.assertEqual(self.driver.reads, 1)
+        # Expiring entries shifts every numbered page.
+        self.driver.current_version = '2'
+        self.get('/?page=0')
+        self.assertEqual(self.driver.reads, 2)
+
+    def test_links_followed_from_head(self):
+        self.config.update(feed_title='Notifications', feed_host='feed',
+                           port='8000', use_https=False, atom_categories='')
+        self.stubs.Set(yagi.serializer, 'feed_serializer',
+                       lambda: yagi.serializer.atom)
+        ids = ['e', 'd', 'c', 'b', 'a']
+
+        def get_range(key, marker, limit, direction):
+            start, end, has_newer, has_older = (
+                yagi.persistence.keyset_slice(ids, marker, limit, direction))
+            return ([dict(id=uuid, event_type='instance', content={})
+                     for uuid in ids[start:end]], has_newer, has_older)
+
+        self.driver.get_range = get_range
+        self.feed = yagi.feed.feed.EventFeed()
+
+        def walk(path, rel):
+            pages = []
+            while path:
+                body = self.get(path).body
+                pages.append(re.findall(r'href="http://feed:8000/instance/'
+                                        r'(\w)"', body))
+                link = re.search(r'href="http://feed:8000(/\?[^"]*)" '
+                                 r'rel="%s"' % rel, body)
+                path = link and link.group(1).replace('&amp;', '&')
+            return pages
+
+        # As with numbered pages, previous goes back in time.
+        self.assertEqual(walk('/', 'previous'),
+                         [['e', 'd'], ['c', 'b'], ['a']])
+        self.assertEqual(walk('/?marker=a', 'next'),
+                         [[], ['c', 'b'], ['e', 'd']])
+
+    def test_streamed_page_cached_once_sent(self):
+        self.config['stream'] = True
+        self.stubs.Set(yagi.serializer, 'feed_serializer',
+                       lambda: yagi.serializer.atom)
+        self.stubs.Set(yagi.serializer.atom, 'dumps', None)
+        self.stubs.Set(yagi.serializer.atom, '_entity_url',
+                       lambda: u'http://feed/')
+        self.stubs.Set(yagi.serializer.atom, '_categories', lambda: [])
+        self.config['feed_title'] = 'Notifications'
+        fetched = []
+
+        def iter_many(uuids):
+            for uuid in uuids:
+                fetched.append(uuid)
+                yield dict(id=uuid, event_type='compute.start',
+                           content=dict(n=uuid))
+
+        def get_range_ids(key, marker, limit, direction):
+            return ['b', 'c'], True, True
+
+        self.driver.iter_many = iter_many
+        self.driver.get_range_ids = get_range_ids
+        feed = yagi.feed.feed.EventFeed()
+        req = webob.Request.blank('/?marker=a')
+        response = req.get_response(feed.serve)
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        chunks = iter(response.app_iter)
+        self.assertTrue(chunks.next().startswith('<?xml'))
+        self.assertEqual(fetched, [])
+        self.assertTrue('<entry>' in chunks.next())
+        self.assertEqual(fetched, ['b'])
+        body = ''.join(chunks)
+        self.assertTrue(body.endswith('</feed>'))
+        self.assertEqual(len(feed.cache), 1)
+        cached = req.get_response(feed.serve)
+        self.assertTrue('fh:archive' in cached.body)
+        self.assertEqual(fetched, ['b', 'c'])
+
+    def test_large_streamed_page_not_held(self):
+        self.config['stream'] = True
+        self.config['stream_cache_max_size'] = '10'
+        kept = []
+
+        def done(body):
+            kept.append(body)
+
+        chunks = yagi.feed.feed._recorded(iter(['<feed>', '<entry/>',
+                                                '</feed>']), done, 10)
+        self.assertEqual(''.join(chunks), '<feed><entry/></feed>')
+        self.assertEqual(kept, [])
+        chunks = yagi.feed.feed._recorded(iter(['<feed>', '</feed>']),
+                                          done, 100)
+        self.assertEqual(''.join(chunks), '<feed></feed>')
+        self.assertEqual(kept, ['<feed></feed>'])
+
+        class StreamingSerializer(MockSerializer):
+            def iter_dumps(serializer, elements, **links):
+                yield '<feed>'
+                for element in elements:
+                    yield '<entry>%s</entry>' % element['id']
+                yield '</feed>'
+
+        self.stubs.Set(yagi.serializer, 'feed_serializer',
+                       StreamingSerializer)
+        self.driver.get_range_ids = lambda key, marker, limit, direction: (
+            ['b', 'c'], True, True)
+        self.driver.iter_many = lambda uuids: (dict(id=u) for u in uuids)
+        feed = yagi.feed.feed.EventFeed()
+        response = webob.Request.blank('/?marker=a').get_response(feed.serve)
+        self.assertEqual(response.body,
+                         '<feed><entry>b</entry><entry>c</entry></feed>')
+        self.assertEqual(len(feed.cache), 0)
+
+    def test_gzip_negotiated(self):
+        plain = self.get('/')
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        self.assertFalse('Content-Encoding' in plain.headers)
+        zipped = self.get('/', **{'Accept-Encoding': 'deflate;q=0.5, gzip'})
+        self.assertEqual(zipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(zipped.body, 16 + zlib.MAX_WBITS),
+                         'a')
+        self.assertNotEqual(zipped.etag, plain.etag)
+        self.assertEqual(self.driver.reads, 1)
+
+    def test_archived_page_compressed_once(self):
+        compressed = []
+        compress = yagi.feed.compression.compress
+
+        def counting_compress(body, encoding, level):
+            compressed.append(encoding)
+            return compress(body, encoding, level)
+
+        self.stubs.Set(yagi.feed.compression, 'compress', counting_compress)
+        for i in xrange(3):
+            response = self.get('/?marker=a', **{'Accept-Encoding': 'deflate'})
+            self.assertEqual(zlib.decompress(response.body), 'b,c')
+        self.assertEqual(compressed, ['deflate'])
+
+    def test_small_pages_not_compressed(self):
+        self.config['compression_min_size'] = '1024'
+        feed = yagi.feed.feed.EventFeed()
+        req = webob.Request.blank('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertFalse('Content-Encoding' in
+                         req.get_response(feed.serve).headers)
+
+    def test_choose_encoding(self):
+        choose = yagi.feed.compression.choose_encoding
+        available = ['gzip', 'deflate']
+        self.assertEqual(choose(None, available), None)
+        self.assertEqual(choose('identity', available), None)
+        self.assertEqual(choose('deflate, gzip', available), 'gzip')
+        self.assertEqual(choose('gzip;q=0.2, deflate', available), 'deflate')
+        self.assertEqual(choose('gzip;q=0, *', available), 'deflate')
+
+    def test_lru_eviction(self):
+        cache = yagi.feed.cache.ResponseCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.pages.keys(), ['a', 'c'])
+
+
+class FeedServerTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.config = dict(port='8000', workers='3', pool_size='50',
+                           backlog='64', respawn_delay='1')
+        self.stubs.Set(yagi.config, 'get',
+                       lambda section, key, default=None: self.config[key])
+        self.served = []
+        self.stubs.Set(eventlet, 'listen',
+                       lambda address, backlog: ('sock', address, backlog))
+        self.stubs.Set(yagi.feed.feed, 'serve',
+                       lambda sock, pool_size: self.served.append(
+                           (sock, pool_size)))
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_single_process(self):
+        self.config['workers'] = '1'
+        yagi.feed.feed.start()
+        self.assertEqual(self.served, [(('sock', ('', 8000), 64), 50)])
+
+    def test_prefork_workers_share_socket(self):
+        test = self
+
+        class Supervisor(object):
+            def __init__(self, workers, target, respawn_delay):
+                self.workers = workers
+                self.target = target
+
+            def run(self):
+                test.assertEqual(test.served, [])
+                for index in xrange(self.workers):
+                    self.target(index, None)
+
+        self.stubs.Set(yagi.supervisor, 'Supervisor', Supervisor)
+        yagi.feed.feed.start()
+        self.assertEqual(self.served, [(('sock', ('', 8000), 64), 50)] * 3)
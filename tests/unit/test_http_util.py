@@ -0,0 +1,61 @@
+import time
+import unittest
+
+import yagi.http_util
+
+
+class MockConnection(object):
+    def __init__(self):
+        self.connections = {}
+        self.created = time.time()
+        self.last_used = self.created
+        self.closed = False
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.made = []
+
+        def factory(headers, force=False):
+            if force or 'X-Auth-Token' not in headers:
+                headers['X-Auth-Token'] = 'token%d' % len(self.made)
+            conn = MockConnection()
+            self.made.append(conn)
+            return conn
+
+        self.pool = yagi.http_util.ConnectionPool(factory, max_size=1,
+                                                  max_idle=60, max_age=3600)
+
+    def test_reuses_connection(self):
+        conn, headers = self.pool.get()
+        self.pool.put(conn, headers)
+        self.assertEqual(self.pool.get(), (conn, headers))
+        self.assertEqual(len(self.made), 1)
+
+    def test_expired_connection_replaced(self):
+        conn, headers = self.pool.get()
+        conn.created -= 7200
+        self.pool.put(conn, headers)
+        other, headers = self.pool.get()
+        self.assertNotEqual(conn, other)
+        # The auth headers are carried over to the new connection.
+        self.assertEqual(headers['X-Auth-Token'], 'token0')
+
+    def test_idle_connection_replaced(self):
+        conn, headers = self.pool.get()
+        self.pool.put(conn, headers)
+        conn.last_used -= 120
+        self.assertNotEqual(self.pool.get()[0], conn)
+
+    def test_forced_create_reauths(self):
+        self.pool.get()
+        conn, headers = self.pool.create(force=True)
+        self.assertEqual(headers['X-Auth-Token'], 'token1')
+        self.assertEqual(self.pool.get()[1]['X-Auth-Token'], 'token1')
+
+    def test_max_size(self):
+        first = self.pool.get()
+        second = self.pool.get()
+        self.pool.put(*first)
+        self.pool.put(*second)
+        self.assertEqual(len(self.pool.idle), 1)
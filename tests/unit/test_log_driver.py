@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import stubout
+
+import yagi.config
+import yagi.persistence.log_driver
+from yagi.persistence import InvalidEntityUUID
+
+
+class LogDriverTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.tmp = tempfile.mkdtemp()
+        self.config = {'log_dir': self.tmp, 'segment_size': '1000',
+                       'entry_ttl': '60', 'sweep_interval': '0',
+                       'fsync': False}
+
+        def get(section, key, default=None):
+            return self.config.get(key, default)
+
+        self.stubs.Set(yagi.config, 'get', get)
+        self.stubs.Set(yagi.config, 'get_bool', get)
+        self.driver = yagi.persistence.log_driver.Driver()
+        for i in range(0, 25, 5):
+            self.driver.create_many([('compute.start' if n % 2 else
+                                      'compute.end', 'uuid%d' % n,
+                                      dict(n=n)) for n in range(i, i + 5)])
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        shutil.rmtree(self.tmp)
+
+    def ids(self, entities):
+        return [e['id'] for e in entities]
+
+    def test_segments(self):
+        segments = self.driver.refresh()
+        self.assertTrue(len(segments) > 1)
+        self.assertEqual(sum(s.count for s in segments), 25)
+        self.assertEqual(segments[1].base, segments[0].count)
+
+    def test_get(self):
+        entity = self.driver.get(None, 'uuid23')[0]
+        self.assertEqual(entity, {'id': 'uuid23', 'content': {'n': 23},
+                                  'event_type': 'compute.start'})
+        self.assertRaises(InvalidEntityUUID, self.driver.get, None, 'nope')
+        self.assertEqual(self.ids(self.driver.get_many(['uuid4', 'nope',
+                                                        'uuid20', 'uuid1'])),
+                         ['uuid4', 'uuid20', 'uuid1'])
+
+    def test_hash_collisions(self):
+        segment = self.driver.refresh()[0]
+        n = segment.find('uuid3')
+        segment.ids[hash('uuid3')] = [n - 1, n]
+        segment.ids[hash('uuid2')] = [n - 1, n]
+        self.assertEqual(segment.find('uuid3'), n)
+        self.assertEqual(segment.find('uuid2'), n - 1)
+        self.assertEqual(segment.find('nope'), None)
+
+    def test_pages(self):
+        self.assertEqual(self.driver.count('compute.start'), 12)
+        entities, page, maxpage = self.driver.get_page(None, 10)
+        self.assertEqual((page, maxpage), (2, 2))
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(24, 19, -1)])
+        entities = self.driver.get_all_of_type('compute.start', 10, 0)
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(19, 0, -2)])
+        self.assertRaises(IndexError, self.driver.get_page, None, 10, 3)
+
+    def test_keyset_pages(self):
+        entities, has_newer, has_older = self.driver.get_range(limit=10)
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(24, 14, -1)])
+        self.assertEqual((has_newer, has_older), (False, True))
+        uuids, has_newer, has_older = self.driver.get_range_ids(
+            'compute.start', 'uuid5', 10)
+        self.assertEqual(uuids, ['uuid3', 'uuid1'])
+        self.assertEqual((has_newer, has_older), (True, False))
+        uuids, has_newer, has_older = self.driver.get_range_ids(
+            None, 'uuid5', 3, 'newer')
+        self.assertEqual(uuids, ['uuid8', 'uuid7', 'uuid6'])
+        self.assertEqual((has_newer, has_older), (True, True))
+        self.assertRaises(InvalidEntityUUID, self.driver.get_range,
+                          'compute.start', 'uuid4', 10)
+
+    def test_other_processes_see_appends(self):
+        reader = yagi.persistence.log_driver.Driver()
+        version = reader.version()
+        self.assertEqual(reader.count(), 25)
+        self.driver.create('compute.end', 'uuid25', dict(n=25))
+        self.assertNotEqual(reader.version(), version)
+        self.assertEqual(self.ids(reader.get_range(limit=1)[0]), ['uuid25'])
+
+    def test_partial_record_dropped(self):
+        path = self.driver.refresh()[-1].path
+        with open(path, 'ab') as f:
+            f.write('\x00\x00\x01')
+        reader = yagi.persistence.log_driver.Driver()
+        self.assertEqual(reader.count(), 25)
+        self.driver.create('compute.end', 'uuid25', dict(n=25))
+        self.assertEqual(reader.get(None, 'uuid25')[0]['content'],
+                         dict(n=25))
+
+    def test_sweep_deletes_whole_segments(self):
+        segments = self.driver.refresh()
+        self.assertEqual(self.driver.sweep(), 0)
+        removed = self.driver.sweep(time.time() + 120)
+        self.assertEqual(removed, 25 - segments[-1].count)
+        self.assertEqual(os.listdir(self.tmp).count('lock'), 1)
+        self.assertEqual(len(self.driver.refresh()), 1)
+        self.driver.create('compute.end', 'uuid25', dict(n=25))
+        self.assertEqual(self.ids(self.driver.get_range(limit=1)[0]),
+                         ['uuid25'])
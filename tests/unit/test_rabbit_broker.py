@@ -0,0 +1,188 @@
+import socket
+import threading
+import unittest
+
+import stubout
+
+import yagi.config
+from yagi.broker import rabbit
+
+
+class MockMessage(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class MockConnection(object):
+    def __init__(self, callback, pending):
+        self.callback = callback
+        self.pending = pending
+        self.drains = 0
+
+    def drain_events(self, timeout=None):
+        self.drains += 1
+        if not self.pending:
+            raise socket.timeout()
+        self.callback(None, self.pending.pop(0))
+
+
+class MockCarrotConsumer(object):
+    def __init__(self, pending):
+        self.pending = pending
+        self.prefetch_count = None
+        self.consuming = False
+        self.backend = self
+        self.channel = self
+        self.connection = None
+
+    def qos(self, prefetch_size, prefetch_count, apply_global):
+        self.prefetch_count = prefetch_count
+
+    def register_callback(self, callback):
+        self.connection = MockConnection(callback, self.pending)
+
+    def consume(self):
+        self.consuming = True
+
+
+class MockConsumer(object):
+    def __init__(self, max_messages, pending, options=None):
+        self.queue_name = 'notifications.info'
+        self.max_messages = max_messages
+        self.batch_limit = max_messages
+        self.consumer = MockCarrotConsumer(pending)
+        self.options = options or {}
+
+    def config(self, key):
+        return self.options.get(key)
+
+
+class PushBrokerTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+
+        def get(section, option, **kwargs):
+            return dict(prefetch_count=0, max_linger=5)[option]
+        self.stubs.Set(yagi.config, 'get', get)
+        self.broker = rabbit.PushBroker()
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_prefetch_defaults_to_max_messages(self):
+        consumer = MockConsumer(10, [])
+        self.broker.consumer_connected(consumer)
+        self.assertEqual(consumer.consumer.prefetch_count, 10)
+        self.assertTrue(consumer.consumer.consuming)
+
+    def test_prefetch_per_queue(self):
+        consumer = MockConsumer(10, [], dict(prefetch_count='25'))
+        self.broker.consumer_connected(consumer)
+        self.assertEqual(consumer.consumer.prefetch_count, 25)
+
+    def test_batch_stops_at_max_messages(self):
+        pending = [MockMessage(i) for i in range(5)]
+        consumer = MockConsumer(3, pending)
+        self.broker.consumer_connected(consumer)
+        messages = self.broker.fetch_messages(consumer)
+        self.assertEqual([m.delivery_tag for m in messages], [0, 1, 2])
+        self.assertEqual(consumer.consumer.connection.drains, 3)
+        messages = self.broker.fetch_messages(consumer)
+        self.assertEqual([m.delivery_tag for m in messages], [3, 4])
+
+    def test_empty_queue_does_not_wait_for_linger(self):
+        consumer = MockConsumer(3, [])
+        self.broker.consumer_connected(consumer)
+        self.assertEqual(self.broker.fetch_messages(consumer), [])
+        self.assertEqual(consumer.consumer.connection.drains, 1)
+
+
+class BrokerStatsTests(unittest.TestCase):
+    def test_messages_processed_per_queue(self):
+        broker = rabbit.Broker()
+        warn = MockConsumer(10, [])
+        warn.queue_name = 'notifications.warn'
+        info = MockConsumer(10, [])
+        broker.messages_processed(warn, 3)
+        broker.messages_processed(info, 2)
+        broker.messages_processed(warn, 4)
+        self.assertEqual(broker.messages_sent,
+                         {'notifications.warn': 7, 'notifications.info': 2})
+
+
+class QueueConsumer(object):
+    """Takes three batches, then waits for the test to finish."""
+
+    def __init__(self, queue_name, stop, handle=None, fail_fetch=False):
+        self.queue_name = queue_name
+        self.stop = stop
+        self.handle = handle
+        self.fail_fetch = fail_fetch
+        self.batches = []
+        self.threads = set()
+        self.handling = threading.Event()
+        self.done = threading.Event()
+
+    def fetch(self):
+        self.threads.add(threading.current_thread().name)
+        if self.fail_fetch:
+            self.fail_fetch = False
+            raise socket.error("Connection reset by peer")
+        if len(self.batches) >= 3:
+            self.done.set()
+            self.stop.wait()
+        if self.stop.is_set():
+            # Ends the thread quietly.
+            raise SystemExit()
+        return [MockMessage(len(self.batches))]
+
+    def fetched_messages(self, messages):
+        self.batches.append(messages)
+        self.handling.set()
+        if self.handle:
+            self.handle()
+
+
+class BrokerLoopTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(yagi.config, 'get',
+                       lambda section, option, **kwargs: 0)
+        self.stop = threading.Event()
+        self.broker = rabbit.Broker()
+        self.reconnected = []
+        self.broker.fetch_messages = lambda consumer: consumer.fetch()
+        self.broker.establish_consumer_connection = (
+            lambda consumer: self.reconnected.append(consumer.queue_name))
+        self.broker.report_loop = lambda: None
+
+    def tearDown(self):
+        self.stop.set()
+        for thread in threading.enumerate():
+            if thread.name.startswith('yagi-'):
+                thread.join(5)
+        self.stubs.UnsetAll()
+
+    def test_queues_consumed_independently(self):
+        def broken():
+            raise ValueError("Bad batch")
+
+        stuck = QueueConsumer('notifications.warn', self.stop,
+                              handle=self.stop.wait)
+        failing = QueueConsumer('notifications.error', self.stop,
+                                handle=broken, fail_fetch=True)
+        healthy = QueueConsumer('notifications.info', self.stop)
+        self.broker.consumers = [stuck, failing, healthy]
+        self.broker.loop()
+        self.assertTrue(healthy.done.wait(5))
+        self.assertTrue(failing.done.wait(5))
+        self.assertTrue(stuck.handling.wait(5))
+        # Stuck handling its first batch, without holding the others up.
+        self.assertEqual(len(stuck.batches), 1)
+        self.assertEqual(len(healthy.batches), 3)
+        self.assertEqual(len(failing.batches), 3)
+        self.assertEqual(self.reconnected, ['notifications.error'])
+        self.assertEqual(healthy.threads, set(['yagi-notifications.info']))
+        self.assertEqual(failing.threads, set(['yagi-notifications.error']))
+        self.assertEqual(self.broker.messages_sent,
+                         {'notifications.info': 3})
@@ -0,0 +1,457 @@
+import fnmatch
+import json
+import time
+import unittest
+
+import redis
+import stubout
+
+import yagi.config
+import yagi.handler.redis_handler
+import yagi.persistence
+import yagi.persistence.codec
+import yagi.persistence.redis_driver
+import yagi.serializer
+
+
+class FakeRedis(object):
+    """Just enough of the legacy redis.Redis API, kept in memory."""
+
+    def __init__(self, **kwargs):
+        self.data = {}
+        self.ttls = {}
+        self.commands = []
+        self.round_trips = 0
+
+    def _call(self, name, *args, **kwargs):
+        self.commands.append(name)
+        return getattr(self, '_%s' % name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if not hasattr(type(self), '_%s' % name):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.round_trips += 1
+            return self._call(name, *args, **kwargs)
+        return command
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def _set(self, name, value):
+        self.data[name] = str(value)
+
+    def _setex(self, name, value, time):
+        self.data[name] = str(value)
+        self.ttls[name] = time
+
+    def _get(self, name):
+        return self.data.get(name)
+
+    def _mget(self, *names):
+        if len(names) == 1 and isinstance(names[0], list):
+            names = names[0]
+        return [self.data.get(name) for name in names]
+
+    def _delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+    def _lpush(self, name, *values):
+        items = self.data.setdefault(name, [])
+        for value in values:
+            items.insert(0, str(value))
+        return len(items)
+
+    def _llen(self, name):
+        return len(self.data.get(name, []))
+
+    def _lrange(self, name, start, end):
+        return self._lrange_of(self.data.get(name, []), start, end)
+
+    def _lrange_of(self, items, start, end):
+        if end < 0:
+            end += len(items)
+        if start < 0:
+            start = max(start + len(items), 0)
+        if end < 0:
+            return []
+        return items[start:end + 1]
+
+    def _lrem(self, name, value, num=0):
+        items = self.data.get(name, [])
+        if str(value) in items:
+            items.remove(str(value))
+
+    def _incr(self, name):
+        self.data[name] = str(int(self.data.get(name, 0)) + 1)
+        return int(self.data[name])
+
+    def _ttl(self, name):
+        return self.ttls.get(name) if name in self.data else None
+
+    def _keys(self, pattern):
+        return [k for k in self.data if fnmatch.fnmatch(k, pattern)]
+
+    def _sadd(self, name, *values):
+        self.data.setdefault(name, set()).update(values)
+
+    def _smembers(self, name):
+        return set(self.data.get(name, set()))
+
+    def _zadd(self, name, *pairs):
+        zset = self.data.setdefault(name, {})
+        for i in range(0, len(pairs), 2):
+            zset[str(pairs[i])] = float(pairs[i + 1])
+
+    def _zcard(self, name):
+        return len(self.data.get(name, {}))
+
+    def _sorted(self, name):
+        zset = self.data.get(name, {})
+        return sorted(zset, key=lambda member: (zset[member], member))
+
+    def _zrange(self, name, start, end):
+        return self._lrange_of(self._sorted(name), start, end)
+
+    def _zrevrange(self, name, start, end):
+        return self._lrange_of(self._sorted(name)[::-1], start, end)
+
+    def _zrem(self, name, *members):
+        zset = self.data.get(name, {})
+        return len([zset.pop(m) for m in members if m in zset])
+
+    def _zcount(self, name, low, high):
+        return len(self._by_score(name, str(low), str(high)))
+
+    def _zscore(self, name, member):
+        return self.data.get(name, {}).get(member)
+
+    def _by_score(self, name, low, high, start=None, num=None):
+        def within(score, bound, above):
+            if bound in ('-inf', '+inf'):
+                return True
+            if bound.startswith('('):
+                bound = float(bound[1:])
+                return score > bound if above else score < bound
+            bound = float(bound)
+            return score >= bound if above else score <= bound
+
+        zset = self.data.get(name, {})
+        members = [m for m in self._sorted(name)
+                   if within(zset[m], low, True) and
+                   within(zset[m], high, False)]
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    def _zrangebyscore(self, name, low, high, start=None, num=None):
+        return self._by_score(name, low, high, start, num)
+
+    def _zrevrangebyscore(self, name, high, low, start=None, num=None):
+        zset = self.data.get(name, {})
+        members = self._by_score(name, low, high)[::-1]
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    def _zremrangebyscore(self, name, low, high):
+        zset = self.data.get(name, {})
+        removed = [m for m, score in zset.items()
+                   if float(low) <= score <= float(high)]
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.queued = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.queued.append((name, args))
+            return self
+        return command
+
+    def execute(self):
+        self.client.round_trips += 1
+        results = [self.client._call(name, *args)
+                   for name, args in self.queued]
+        self.queued = []
+        return results
+
+
+class RedisDriverTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        config_dict = {'persistence': {'host': 'localhost',
+                                       'port': '6379',
+                                       'password': '',
+                                       'entry_ttl': '60',
+                                       'sweep_interval': '60'}}
+
+        def get(section, key, default=None):
+            return config_dict.get(section, {}).get(key, default)
+
+        self.stubs.Set(yagi.config, 'get', get)
+        self.stubs.Set(yagi.config, 'get_bool', get)
+        self.stubs.Set(redis, 'Redis', FakeRedis)
+        self.driver = yagi.persistence.redis_driver.Driver()
+        self.client = self.driver.client
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_connection_pool_per_process(self):
+        pool = yagi.persistence.redis_driver.connection_pool
+        shared = pool('localhost', 6379, '')
+        self.assertTrue(pool('localhost', 6379, '') is shared)
+        self.stubs.Set(yagi.persistence.redis_driver.os, 'getpid',
+                       lambda: -1)
+        forked = pool('localhost', 6379, '', max_connections=10)
+        self.assertFalse(forked is shared)
+        self.assertTrue(isinstance(forked, redis.BlockingConnectionPool))
+
+    def test_create_many_single_round_trip(self):
+        entities = [('compute.start' if i % 2 else 'compute.end',
+                     'uuid%d' % i, dict(n=i)) for i in range(10)]
+        self.driver.create_many(entities)
+        self.assertEqual(self.client.round_trips, 1)
+        self.assertEqual(self.driver.count(), 10)
+        self.assertEqual(self.driver.count('compute.start'), 5)
+        self.assertEqual(self.client.data['entries'][0], 'uuid9')
+        self.assertEqual(self.driver.get(None, 'uuid3')[0]['content'],
+                         dict(n=3))
+
+    def test_page_in_two_round_trips(self):
+        self.driver.create_many([('compute.start', 'uuid%d' % i, dict(n=i))
+                                 for i in range(25)])
+        self.client.round_trips = 0
+        entities, page, maxpage = self.driver.get_page(None, 10)
+        self.assertEqual(self.client.round_trips, 2)
+        self.assertEqual((page, maxpage), (2, 2))
+        # The newest page is the partial one, newest entry first.
+        self.assertEqual([e['id'] for e in entities],
+                         ['uuid%d' % i for i in range(24, 19, -1)])
+        self.assertEqual(entities[0]['event_type'], 'compute.start')
+        entities, page, maxpage = self.driver.get_page('compute.start', 10, 0)
+        self.assertEqual([e['id'] for e in entities],
+                         ['uuid%d' % i for i in range(9, -1, -1)])
+        entities, page, maxpage = self.driver.get_page(None, 10, -2)
+        self.assertEqual(page, 1)
+        self.assertEqual(entities[0]['id'], 'uuid19')
+        self.assertRaises(IndexError, self.driver.get_page, None, 10, 3)
+
+    def test_legacy_and_expired_entries(self):
+        self.client.lpush('entries', 'old', 'gone')
+        self.client.set('entry:old:content', '{"n": 1}')
+        self.client.set('entry:old:event_type', 'compute.end')
+        self.client.set('entry:gone:event_type', 'compute.end')
+        self.client.lpush('type:compute.end', 'old', 'gone')
+        entities = self.driver.get_all()
+        self.assertEqual(entities, [{'id': 'old', 'content': {'n': 1},
+                                     'event_type': 'compute.end'}])
+        self.assertEqual(self.driver.count(), 1)
+        self.assertEqual(self.driver.count('compute.end'), 1)
+
+    def test_recode(self):
+        content = dict(payload='x' * 2000)
+        self.driver.create_many([('compute.end', 'uuid%d' % i, content)
+                                 for i in range(3)])
+        self.client.set('entry:uuid0', json.dumps(
+            dict(event_type='compute.end', content=content)))
+        self.driver.codec = yagi.persistence.codec.Codec(
+            compress_min_size=1024)
+        entries, before, after = self.driver.recode(batch_size=2)
+        self.assertEqual(entries, 3)
+        self.assertTrue(after < before / 10)
+        self.assertTrue(self.client.data['entry:uuid0'].startswith('zj'))
+        self.assertEqual(self.client.ttls['entry:uuid1'], 60)
+        self.assertEqual(self.driver.get_many(['uuid0'])[0]['content'],
+                         content)
+        self.assertEqual(self.driver.recode()[1:], (after, after))
+
+    def test_sorted_sets(self):
+        self.stubs.Set(redis, 'Redis', lambda **kwargs: self.client)
+        driver = yagi.persistence.redis_driver.SortedSetDriver()
+        self.stubs.Set(driver, 'start_sweeper', lambda: None)
+        driver.create_many([('compute.start' if i % 2 else 'compute.end',
+                             'uuid%d' % i, dict(n=i)) for i in range(25)])
+        self.client.round_trips = 0
+        entities, page, maxpage = driver.get_page(None, 10)
+        self.assertEqual(self.client.round_trips, 2)
+        self.assertEqual((page, maxpage), (2, 2))
+        self.assertEqual([e['id'] for e in entities],
+                         ['uuid%d' % i for i in range(24, 19, -1)])
+        entities, page, maxpage = driver.get_page(None, 10, 0)
+        self.assertEqual([e['id'] for e in entities],
+                         ['uuid%d' % i for i in range(9, -1, -1)])
+        self.assertEqual(driver.count('compute.start'), 12)
+        # Expired entries are left off the page, without any cleanup.
+        del self.client.data['entry:uuid24']
+        self.client.commands = []
+        entities, page, maxpage = driver.get_page(None, 10)
+        self.assertEqual(len(entities), 4)
+        self.assertFalse('lrem' in self.client.commands)
+        self.assertEqual(driver.sweep(), 0)
+        self.assertEqual(driver.sweep(time.time() + 120), 25)
+        self.assertEqual(driver.count(), 0)
+        self.assertEqual(driver.count('compute.end'), 0)
+
+    def test_migrate_to_sorted_sets(self):
+        self.driver.create_many([('compute.start', 'uuid%d' % i, dict(n=i))
+                                 for i in range(5)])
+        self.client.lpush('entries', 'old')
+        self.client.lpush('type:compute.end', 'old')
+        self.client.setex('entry:old:content', '{"n": 5}', 30)
+        self.client.set('entry:old:event_type', 'compute.end')
+        self.stubs.Set(redis, 'Redis', lambda **kwargs: self.client)
+        migrated = yagi.persistence.redis_driver.migrate_to_sorted_sets(
+            batch_size=2)
+        self.assertEqual(migrated, 6)
+        self.assertFalse('entries' in self.client.data)
+        self.assertFalse('type:compute.end' in self.client.data)
+        self.assertFalse('entry:old:event_type' in self.client.data)
+        driver = yagi.persistence.redis_driver.SortedSetDriver()
+        self.assertEqual([e['id'] for e in driver.get_all()],
+                         ['old'] + ['uuid%d' % i for i in range(4, -1, -1)])
+        self.assertEqual(driver.get(None, 'old')[0]['event_type'],
+                         'compute.end')
+
+    def _check_ranges(self, driver):
+        driver.create_many([('compute.start', 'uuid%d' % i, dict(n=i))
+                            for i in range(10)])
+
+        def ids(result):
+            entities, has_newer, has_older = result
+            return [e['id'] for e in entities], has_newer, has_older
+
+        self.assertEqual(ids(driver.get_range(limit=3)),
+                         (['uuid9', 'uuid8', 'uuid7'], False, True))
+        self.assertEqual(ids(driver.get_range(marker='uuid7', limit=3)),
+                         (['uuid6', 'uuid5', 'uuid4'], True, True))
+        # New entries don't move a page that starts at a marker.
+        driver.create_many([('compute.start', 'uuid10', dict(n=10))])
+        self.assertEqual(ids(driver.get_range(marker='uuid7', limit=3)),
+                         (['uuid6', 'uuid5', 'uuid4'], True, True))
+        self.assertEqual(ids(driver.get_range('compute.start', 'uuid2',
+                                              limit=3)),
+                         (['uuid1', 'uuid0'], True, False))
+        self.assertEqual(ids(driver.get_range(marker='uuid6', limit=3,
+                                              direction='newer')),
+                         (['uuid9', 'uuid8', 'uuid7'], True, True))
+        self.assertEqual(ids(driver.get_range(marker='uuid8', limit=3,
+                                              direction='newer')),
+                         (['uuid10', 'uuid9'], False, True))
+        self.assertRaises(yagi.persistence.InvalidEntityUUID,
+                          driver.get_range, None, 'nope', 3)
+
+    def test_list_ranges(self):
+        self._check_ranges(self.driver)
+
+    def test_sorted_set_ranges(self):
+        self.stubs.Set(redis, 'Redis', lambda **kwargs: self.client)
+        driver = yagi.persistence.redis_driver.SortedSetDriver()
+        self.stubs.Set(driver, 'start_sweeper', lambda: None)
+        self._check_ranges(driver)
+        self.client.commands = []
+        driver.get_range(marker='uuid5', limit=3)
+        self.assertEqual(self.client.commands,
+                         ['zscore', 'zrangebyscore', 'zrevrangebyscore',
+                          'mget'])
+
+    def test_sorted_set_ties_paged(self):
+        self.stubs.Set(redis, 'Redis', lambda **kwargs: self.client)
+        driver = yagi.persistence.redis_driver.SortedSetDriver()
+        # Workers writing in the same instant store entries with one score.
+        self.stubs.Set(driver, '_score', lambda now: 1000.0)
+        driver.create_many([('compute.start', uuid, dict(n=uuid))
+                            for uuid in 'abcd'])
+        self.assertEqual(driver.get_range_ids(limit=2),
+                         (['d', 'c'], False, True))
+        self.assertEqual(driver.get_range_ids(marker='c', limit=2),
+                         (['b', 'a'], True, False))
+        self.assertEqual(driver.get_range_ids(marker='b', limit=2,
+                                              direction='newer'),
+                         (['d', 'c'], False, True))
+        self.assertEqual(driver.get_range_ids(marker='a', limit=2,
+                                              direction='newer'),
+                         (['c', 'b'], True, True))
+
+    def test_fragments_stored(self):
+        self.driver.create_many([('compute.start', 'uuid1', dict(n=1)),
+                                 ('compute.start', 'uuid2', dict(n=2))],
+                                [('sig', u'<entry>1</entry>'), None])
+        first, second = self.driver.get_many(['uuid1', 'uuid2'])
+        self.assertEqual(first['fragment'], u'<entry>1</entry>')
+        self.assertEqual(first['fragment_sig'], 'sig')
+        self.assertFalse('fragment' in second)
+
+    def test_handler_renders_fragments(self):
+        class Serializer(object):
+            def render_entry(self, entity):
+                return 'sig', '<entry>%s</entry>' % entity['id']
+
+        self.stubs.Set(yagi.config, 'get_bool',
+                       lambda section, key, default=None: True)
+        self.stubs.Set(yagi.serializer, 'feed_serializer', Serializer)
+        handler = yagi.handler.redis_handler.RedisHandler()
+        handler.db = self.driver
+        payload = dict(message_id='1', publisher_id='compute.host',
+                       event_type='compute.start', priority='INFO',
+                       payload={}, timestamp='2012-01-01 00:00:00')
+        handler.handle_messages([MockMessage(payload)], {})
+        self.assertEqual(self.driver.get(None, '1')[0]['fragment'],
+                         '<entry>1</entry>')
+
+    def test_handler_keeps_driver(self):
+        handler = yagi.handler.redis_handler.RedisHandler()
+        created = []
+
+        class Driver(yagi.persistence.Driver):
+            def create_many(self, entities, fragments=None):
+                created.append(entities)
+
+        drivers = []
+
+        def persistence_driver():
+            drivers.append(Driver())
+            return drivers[-1]
+
+        self.stubs.Set(yagi.persistence, 'persistence_driver',
+                       persistence_driver)
+        payload = dict(message_id='1', publisher_id='compute.host',
+                       event_type='compute.start', priority='INFO',
+                       payload={}, timestamp='2012-01-01 00:00:00')
+        handler.handle_messages([MockMessage(payload)], {})
+        handler.handle_messages([MockMessage(payload)], {})
+        self.assertEqual(len(drivers), 1)
+        self.assertEqual(created, [[('compute.start', '1', payload)]] * 2)
+
+    def test_handler_skips_malformed(self):
+        class Serializer(object):
+            def render_entry(self, entity):
+                return 'sig', '<entry>%s</entry>' % entity['id']
+
+        self.stubs.Set(yagi.config, 'get_bool',
+                       lambda section, key, default=None: True)
+        self.stubs.Set(yagi.serializer, 'feed_serializer', Serializer)
+        handler = yagi.handler.redis_handler.RedisHandler()
+        handler.db = self.driver
+        messages = [MockMessage(dict(message_id=str(i),
+                                     event_type='compute.start', payload={}))
+                    for i in range(3)]
+        del messages[1].payload['event_type']
+        handler.handle_messages(messages, {})
+        self.assertEqual([e['fragment'] for e in
+                          self.driver.get_many(['0', '1', '2'])],
+                         ['<entry>0</entry>', '<entry>2</entry>'])
+
+
+class MockMessage(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.acknowledged = False
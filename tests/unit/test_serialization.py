@@ -4,6 +4,7 @@ import stubout
 
 import yagi.config
 import yagi.serializer
+import yagi.serializer.atom
 
 
 class SerializerTests(unittest.TestCase):
@@ -23,3 +24,44 @@ class SerializerTests(unittest.TestCase):
 
         ser = yagi.serializer.feed_serializer()
         self.assertEqual(ser, yagi.serializer.atom)
+
+    def _stub_config(self):
+        config = {'feed_title': 'Notifications', 'feed_host': 'feed',
+                  'port': '8000', 'use_https': False}
+
+        def config_get(section, key, default=None):
+            return config.get(key, default)
+
+        self.stubs.Set(yagi.config, 'get', config_get)
+        self.stubs.Set(yagi.config, 'get_bool', config_get)
+        return config
+
+    def test_marker_links(self):
+        self._stub_config()
+        body = yagi.serializer.atom.dumps(
+            [dict(id='b', event_type='instance', content={})],
+            previous_marker='a', next_marker='b', limit=10, path='instance')
+        self.assertTrue('href="http://feed:8000/instance?marker=b&amp;'
+                        'direction=newer&amp;limit=10"' in body)
+        self.assertTrue('href="http://feed:8000/instance?marker=a&amp;'
+                        'limit=10"' in body)
+
+    def test_stored_fragments(self):
+        config = self._stub_config()
+        entity = dict(id='b', event_type='instance', content=dict(a=1))
+        rendered = yagi.serializer.atom.dumps([entity])
+        signature, fragment = yagi.serializer.atom.render_entry(entity)
+        self.assertTrue(fragment.startswith('<entry>'))
+        self.assertTrue(fragment in rendered)
+
+        def add_item(feed, entity):
+            self.fail("Stored fragment not used")
+
+        stored = dict(entity, fragment=fragment.decode('utf-8'),
+                      fragment_sig=signature)
+        self.stubs.Set(yagi.serializer.atom, '_add_item', add_item)
+        self.assertTrue(fragment in yagi.serializer.atom.dumps([stored]))
+        # Rendered for another feed host, so it has to be redone.
+        config['feed_host'] = 'elsewhere'
+        self.assertRaises(AssertionError, yagi.serializer.atom.dumps,
+                          [stored])
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import yagi.spool
+
+
+class RetrySchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.dir, 'spool')
+        self.dead_letter_file = os.path.join(self.dir, 'dead_letter.json')
+        self.delivered = []
+        self.succeed = True
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def deliver(self, entry):
+        self.delivered.append(entry['id'])
+        return self.succeed
+
+    def scheduler(self, spool=None, max_tries=3):
+        spool = spool or yagi.spool.RetrySpool(self.spool_dir)
+        return yagi.spool.RetryScheduler(spool, self.deliver,
+                                         self.dead_letter_file,
+                                         max_tries=max_tries, interval=1,
+                                         max_wait=8, name='notifications')
+
+    def test_backoff_is_jittered_and_capped(self):
+        scheduler = self.scheduler()
+        for tries, delay in ((1, 1), (2, 2), (3, 4), (10, 8)):
+            wait = scheduler.backoff(tries)
+            self.assertTrue(delay / 2.0 <= wait <= delay)
+
+    def test_spooled_entries_survive_restart(self):
+        spool = yagi.spool.RetrySpool(self.spool_dir)
+        self.scheduler(spool).schedule('1', '<entry/>')
+        spool.lock_file.close()
+        restarted = self.scheduler()
+        self.assertEqual(len(restarted), 1)
+        self.assertEqual(restarted.heap[0][2]['body'], '<entry/>')
+
+    def test_second_process_gets_own_slot(self):
+        first = yagi.spool.RetrySpool(self.spool_dir)
+        second = yagi.spool.RetrySpool(self.spool_dir)
+        self.assertNotEqual(first.path, second.path)
+
+    def test_delivered_entry_removed(self):
+        scheduler = self.scheduler()
+        entry = scheduler.schedule('1', '<entry/>')
+        self.assertTrue(scheduler.retry(entry))
+        self.assertEqual(scheduler.spool.load(), [])
+
+    def test_failed_entry_rescheduled(self):
+        self.succeed = False
+        scheduler = self.scheduler()
+        entry = scheduler.schedule('1', '<entry/>')
+        scheduler.heap = []
+        self.assertFalse(scheduler.retry(entry))
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.spool.load()[0]['tries'], 2)
+
+    def test_dead_letter_and_replay(self):
+        self.succeed = False
+        scheduler = self.scheduler(max_tries=2)
+        entry = scheduler.schedule('1', '<entry/>')
+        scheduler.heap = []
+        scheduler.retry(entry)
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler.spool.load(), [])
+        with open(self.dead_letter_file) as f:
+            self.assertEqual(json.loads(f.read())['id'], '1')
+
+        count = yagi.spool.replay_dead_letters(self.dead_letter_file,
+                                               self.dir)
+        self.assertEqual(count, 1)
+        self.assertFalse(os.path.exists(self.dead_letter_file))
+        spool = yagi.spool.RetrySpool(os.path.join(self.dir,
+                                                   'notifications'))
+        entries = spool.claim_incoming()
+        self.assertEqual([e['id'] for e in entries], ['1'])
+        self.assertEqual(entries[0]['tries'], 0)
+
+    def test_untried_entry_keeps_tries(self):
+        self.succeed = None
+        scheduler = self.scheduler(max_tries=2)
+        entry = scheduler.schedule('1', '<entry/>')
+        scheduler.heap = []
+        scheduler.retry(entry)
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(entry['tries'], 1)
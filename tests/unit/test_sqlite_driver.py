@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import stubout
+
+import yagi.config
+import yagi.persistence.sqlite_driver
+from yagi.persistence import InvalidEntityUUID
+
+
+class SQLiteDriverTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.tmp = tempfile.mkdtemp()
+        config = {'database': os.path.join(self.tmp, 'yagi.sqlite'),
+                  'entry_ttl': '60', 'sweep_interval': '0',
+                  'busy_timeout': '1'}
+
+        def get(section, key, default=None):
+            return config.get(key, default)
+
+        self.stubs.Set(yagi.config, 'get', get)
+        self.driver = yagi.persistence.sqlite_driver.Driver()
+        self.driver.create_many([('compute.start' if i % 2 else
+                                  'compute.end', 'uuid%d' % i, dict(n=i))
+                                 for i in range(25)])
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        shutil.rmtree(self.tmp)
+
+    def ids(self, entities):
+        return [e['id'] for e in entities]
+
+    def test_wal(self):
+        mode = self.driver._query('PRAGMA journal_mode')[0][0]
+        self.assertEqual(mode, 'wal')
+
+    def test_get(self):
+        entity = self.driver.get(None, 'uuid3')[0]
+        self.assertEqual(entity, {'id': 'uuid3', 'content': {'n': 3},
+                                  'event_type': 'compute.start'})
+        self.assertRaises(InvalidEntityUUID, self.driver.get, None, 'nope')
+        self.assertEqual(self.ids(self.driver.get_many(['uuid4', 'nope',
+                                                        'uuid1'])),
+                         ['uuid4', 'uuid1'])
+
+    def test_redelivered_entries_ignored(self):
+        version = self.driver.version()
+        self.driver.create('compute.end', 'uuid0', dict(n=100))
+        self.assertEqual(self.driver.count(), 25)
+        self.assertEqual(self.driver.get(None, 'uuid0')[0]['content'],
+                         dict(n=0))
+        self.assertNotEqual(self.driver.version(), version)
+
+    def test_pages(self):
+        self.assertEqual(self.driver.count('compute.start'), 12)
+        entities, page, maxpage = self.driver.get_page(None, 10)
+        self.assertEqual((page, maxpage), (2, 2))
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(24, 19, -1)])
+        entities = self.driver.get_all_of_type('compute.start', 10, 0)
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(19, 0, -2)])
+        self.assertRaises(IndexError, self.driver.get_page, None, 10, 3)
+
+    def test_keyset_pages(self):
+        entities, has_newer, has_older = self.driver.get_range(limit=10)
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(24, 14, -1)])
+        self.assertEqual((has_newer, has_older), (False, True))
+        uuids, has_newer, has_older = self.driver.get_range_ids(
+            'compute.start', 'uuid5', 10)
+        self.assertEqual(uuids, ['uuid3', 'uuid1'])
+        self.assertEqual((has_newer, has_older), (True, False))
+        uuids, has_newer, has_older = self.driver.get_range_ids(
+            None, 'uuid5', 3, 'newer')
+        self.assertEqual(uuids, ['uuid8', 'uuid7', 'uuid6'])
+        self.assertEqual((has_newer, has_older), (True, True))
+        self.assertRaises(InvalidEntityUUID, self.driver.get_range,
+                          'compute.start', 'uuid4', 10)
+
+    def test_type_pages_use_covering_index(self):
+        plan = self.driver._query(
+            'EXPLAIN QUERY PLAN SELECT uuid FROM entries WHERE '
+            'event_type = ? AND seq < ? ORDER BY seq DESC LIMIT 10',
+            ('compute.start', 10))
+        self.assertTrue('COVERING INDEX entries_type_seq' in
+                        ' '.join(str(row[-1]) for row in plan))
+
+    def test_sweep(self):
+        self.assertEqual(self.driver.sweep(), 0)
+        self.assertEqual(self.driver.sweep(time.time() + 120), 25)
+        self.assertEqual(self.driver.count(), 0)
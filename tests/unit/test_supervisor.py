@@ -0,0 +1,102 @@
+import os
+import signal
+import StringIO
+import unittest
+
+import stubout
+
+import yagi.supervisor
+
+
+class ChildExit(Exception):
+    def __init__(self, status):
+        self.status = status
+
+
+class SupervisorTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.pids = iter(xrange(101, 200))
+        self.fds = iter(xrange(10, 100))
+        self.killed = []
+        self.exits = []
+        self.stubs.Set(os, 'fork', lambda: self.pids.next())
+        self.stubs.Set(os, 'pipe', lambda: (self.fds.next(),
+                                            self.fds.next()))
+        self.stubs.Set(os, 'close', lambda fd: None)
+        self.stubs.Set(os, 'kill',
+                       lambda pid, signum: self.killed.append((pid, signum)))
+
+        def waitpid(pid, options):
+            if self.exits:
+                return self.exits.pop(0)
+            return 0, 0
+
+        self.stubs.Set(os, 'waitpid', waitpid)
+        self.supervisor = yagi.supervisor.Supervisor(2, None,
+                                                     respawn_delay=60)
+        for index in xrange(2):
+            self.supervisor.spawn(index)
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_dead_worker_respawned(self):
+        self.assertEqual(self.supervisor.children, {101: 0, 102: 1})
+        # Killed by SIGKILL.
+        self.exits = [(101, signal.SIGKILL)]
+        self.supervisor._reap()
+        self.assertEqual(self.supervisor.children, {102: 1})
+        self.supervisor._respawn()
+        self.assertEqual(self.supervisor.children, {102: 1})
+        self.supervisor.respawns[0] = 0
+        self.supervisor._respawn()
+        self.assertEqual(self.supervisor.children, {102: 1, 103: 0})
+
+    def test_reloaded_worker_restarted_at_once(self):
+        self.exits = [(102, yagi.supervisor.RELOAD_STATUS << 8)]
+        self.supervisor._reap()
+        self.supervisor._respawn()
+        self.assertEqual(self.supervisor.children, {101: 0, 103: 1})
+
+    def test_signals_forwarded(self):
+        self.supervisor._handle_signal(signal.SIGHUP, None)
+        self.assertEqual(sorted(self.killed), [(101, signal.SIGHUP),
+                                               (102, signal.SIGHUP)])
+        self.assertFalse(self.supervisor.stopping)
+        self.supervisor._handle_signal(signal.SIGTERM, None)
+        self.assertTrue(self.supervisor.stopping)
+        self.assertEqual(len(self.killed), 4)
+        self.exits = [(101, 0), (102, 0)]
+        self.supervisor._reap()
+        self.supervisor._respawn()
+        self.assertEqual(self.supervisor.children, {})
+        self.assertEqual(self.supervisor.respawns, {})
+
+    def test_child_exits_cleanly_on_hup(self):
+        handlers = {}
+
+        def child_exit(status):
+            raise ChildExit(status)
+
+        self.stubs.Set(signal, 'signal',
+                       lambda signum, handler: handlers.update(
+                           {signum: handler}))
+        self.stubs.Set(os, 'fdopen',
+                       lambda fd, mode, bufsize: StringIO.StringIO())
+        self.stubs.Set(os, '_exit', child_exit)
+
+        def target(index, report):
+            try:
+                handlers[signal.SIGHUP](signal.SIGHUP, None)
+            except Exception:
+                self.fail("Reload caught as an error")
+
+        self.supervisor.target = target
+        try:
+            self.supervisor._run_child(0, 11)
+        except ChildExit, e:
+            self.assertEqual(e.status, yagi.supervisor.RELOAD_STATUS)
+        else:
+            self.fail("Child didn't exit")
+        self.assertEqual(handlers[signal.SIGTERM], signal.SIG_DFL)
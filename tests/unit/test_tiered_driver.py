@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import redis
+import stubout
+
+import yagi.config
+import yagi.persistence.tiered_driver
+from yagi.persistence import InvalidEntityUUID
+from tests.unit.test_redis_driver import FakeRedis
+
+
+class TieredDriverTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.tmp = tempfile.mkdtemp()
+        self.config = {'host': 'localhost', 'port': '6379', 'password': '',
+                       'entry_ttl': '3600', 'sweep_interval': '60',
+                       'archive_dir': self.tmp, 'archive_page_size': '5',
+                       'hot_entries': '7', 'hot_seconds': '0',
+                       'archive_interval': '0', 'archive_cache_size': '2'}
+
+        def get(section, key, default=None):
+            return self.config.get(key, default)
+
+        self.stubs.Set(yagi.config, 'get', get)
+        self.stubs.Set(yagi.config, 'get_bool', get)
+        self.client = FakeRedis()
+        self.stubs.Set(redis, 'Redis', lambda **kwargs: self.client)
+        self.driver = yagi.persistence.tiered_driver.Driver()
+        for i in range(0, 25, 5):
+            self.driver.create_many([('compute.start' if n % 2 else
+                                      'compute.end', 'uuid%d' % n,
+                                      dict(n=n)) for n in range(i, i + 5)])
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        shutil.rmtree(self.tmp)
+
+    def ids(self, entities):
+        return [e['id'] for e in entities]
+
+    def test_hot_window_bounded(self):
+        # Full pages only, so between 7 and 11 entries stay hot.
+        self.assertEqual(self.driver.hot.count(), 10)
+        self.assertFalse('entry:uuid0' in self.client.data)
+        self.assertTrue('entry:uuid24' in self.client.data)
+        self.assertEqual(len([n for n in os.listdir(self.tmp)
+                              if n.endswith('.json.gz')]), 3)
+        self.assertEqual(self.driver.count(), 25)
+        self.assertEqual(self.driver.count('compute.start'), 12)
+
+    def test_get_falls_through(self):
+        self.assertEqual(self.driver.get(None, 'uuid3')[0]['content'],
+                         dict(n=3))
+        self.assertEqual(self.ids(self.driver.get_many(['uuid20', 'nope',
+                                                        'uuid1'])),
+                         ['uuid20', 'uuid1'])
+        self.assertRaises(InvalidEntityUUID, self.driver.get, None, 'nope')
+
+    def test_archive_hash_collisions(self):
+        archives = self.driver._refresh()
+        archive = archives[0]
+        archive.ids[hash('uuid3')] = [2, 3]
+        self.assertEqual(self.driver._find(archives, 'uuid3'), (archive, 3))
+        self.assertEqual(self.driver._find(archives, 'nope'), None)
+
+    def test_pages(self):
+        entities, page, maxpage = self.driver.get_page(None, 10)
+        self.assertEqual((page, maxpage), (2, 2))
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(24, 19, -1)])
+        entities = self.driver.get_all(10, 1)
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(19, 9, -1)])
+        entities = self.driver.get_all_of_type('compute.start', 10, 0)
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(19, 0, -2)])
+
+    def test_keyset_pages_cross_tiers(self):
+        entities, has_newer, has_older = self.driver.get_range(limit=12)
+        self.assertEqual(self.ids(entities),
+                         ['uuid%d' % i for i in range(24, 12, -1)])
+        self.assertEqual((has_newer, has_older), (False, True))
+        uuids, has_newer, has_older = self.driver.get_range_ids(
+            'compute.start', 'uuid5', 10)
+        self.assertEqual(uuids, ['uuid3', 'uuid1'])
+        self.assertEqual((has_newer, has_older), (True, False))
+        uuids, has_newer, has_older = self.driver.get_range_ids(
+            None, 'uuid12', 4, 'newer')
+        self.assertEqual(uuids, ['uuid16', 'uuid15', 'uuid14', 'uuid13'])
+        self.assertEqual((has_newer, has_older), (True, True))
+        uuids, has_newer, has_older = self.driver.get_range_ids(
+            None, 'uuid20', 10, 'newer')
+        self.assertEqual(uuids, ['uuid24', 'uuid23', 'uuid22', 'uuid21'])
+        self.assertEqual((has_newer, has_older), (False, True))
+        self.assertRaises(InvalidEntityUUID, self.driver.get_range,
+                          'compute.start', 'uuid4', 10)
+
+    def test_range_ids_leave_archives_compressed(self):
+        def load_page(archive):
+            self.fail("Archive decompressed for an id-only range")
+
+        self.stubs.Set(yagi.persistence.tiered_driver, '_load_page',
+                       load_page)
+        self.assertEqual(self.driver.get_range_ids(None, 'uuid12', 4),
+                         (['uuid11', 'uuid10', 'uuid9', 'uuid8'], True, True))
+        self.assertEqual(self.driver.get_range_ids(None, 'uuid3', 2,
+                                                   'newer'),
+                         (['uuid5', 'uuid4'], True, True))
+
+    def test_sweep_deletes_whole_archives(self):
+        version = self.driver.version()
+        self.assertEqual(self.driver.sweep(), 0)
+        self.assertEqual(self.driver.sweep(time.time() + 7200), 15)
+        self.assertNotEqual(self.driver.version(), version)
+        self.assertEqual(self.driver.count(), 10)
+        self.assertEqual(os.listdir(self.tmp), ['lock'])
@@ -1,5 +1,6 @@
 import datetime
 import socket
+import threading
 import time
 
 import amqplib
@@ -22,6 +23,8 @@ with conf.defaults_for("rabbit_broker") as default:
     default("reconnect_delay", 5)
     default("max_wait", 600)
     default("max_connection_age", 14400)
+    default("prefetch_count", 0)
+    default("max_linger", 0.1)
 
 LOG = yagi.log.logger
 
@@ -88,6 +91,9 @@ class NotQuiteSoStupidConsumer(Consumer):
 class Broker(object):
     def __init__(self):
         self.consumers = []
+        self.messages_sent = {}
+        self.stats_lock = threading.Lock()
+        self.report_hook = None
 
     def add_consumer(self, consumer):
         self.establish_consumer_connection(consumer)
@@ -132,6 +138,7 @@ class Broker(object):
                         exchange_auto_delete=exauto_delete,
                         )
                 consumer.connect(connection, carrot_consumer)
+                self.consumer_connected(consumer)
                 LOG.info("Connection established for %s" % consumer.queue_name)
                 break
             except amqplib.client_0_8.exceptions.AMQPConnectionException, e:
@@ -148,63 +155,57 @@ class Broker(object):
             LOG.error("Could not reconnect, trying again in %d" % delay)
             time.sleep(delay)
 
+    def consumer_connected(self, consumer):
+        """Called once a consumer has (re)connected to its queue."""
+        pass
+
+    def poll_delay(self):
+        return float(conf.get("rabbit_broker", "poll_delay"))
+
+    def fetch_messages(self, consumer):
+        messages = []
+        for n in xrange(consumer.max_messages):
+            msg = consumer.consumer.fetch(enable_callbacks=False)
+            if not msg:
+                break
+            LOG.debug("Received message on queue %s" % consumer.queue_name)
+            messages.append(msg)
+        return messages
+
     def loop(self):
-        poll_delay = float(conf.get("rabbit_broker", "poll_delay"))
-        update_timer = int(conf.get("global", "update_timer"))
+        """Runs every consumer's fetch/handle cycle in its own thread.
+
+        Each queue keeps its own connection and reconnect state, so a stall,
+        back-off or reconnect on one queue doesn't hold up the others. The
+        calling thread only reports throughput every update_timer seconds.
+        """
+        for consumer in self.consumers:
+            worker = threading.Thread(target=self.consume_loop,
+                                      args=(consumer,),
+                                      name="yagi-%s" % consumer.queue_name)
+            worker.daemon = True
+            worker.start()
+        self.report_loop()
+
+    def consume_loop(self, consumer):
+        poll_delay = self.poll_delay()
         max_connection_age = int(conf.get("rabbit_broker",
                                           "max_connection_age"))
-        start_time = datetime.datetime.now()
-        messages_sent = {}
         while True:
             try:
-                for consumer in self.consumers:
-                    messages = []
-                    if not consumer.queue_name in messages_sent:
-                        messages_sent[consumer.queue_name] = 0
-
-                    for n in xrange(consumer.max_messages):
-                        msg = consumer.consumer.fetch(enable_callbacks=False)
-                        if not msg:
-                            break
-                        LOG.debug("Received message on queue %s" %
-                            consumer.queue_name)
-                        messages.append(msg)
-
-                    num_messages = len(messages)
-                    if num_messages > 0:
-                        consumer.fetched_messages(messages)
-                        messages_sent[consumer.queue_name] += num_messages
-                    if max_connection_age > 0:
-                        age = datetime.datetime.now() - consumer.connect_time
-                        age_sec = age.seconds + (age.days * 86400)
-                        if age_sec > max_connection_age:
-                            LOG.info("Maximum AMQP connection time for "
-                                     "connection to %s reached. "
-                                     "Reconnecting..." % consumer.queue_name)
-                            self.establish_consumer_connection(consumer)
-
-
-                # Ingnoring microseconds because we're not going to let you
-                # be that granular and it's not super useful anyway
-                td = datetime.datetime.now() - start_time
-                elapsed = td.seconds + td.days * 86400
-
-                if elapsed > update_timer:
-                    # This isn't threaded, it's just best effort
-                    LOG.info("Update timer elapsed: %s seconds", str(elapsed))
-                    total_messages = 0
-                    for consumer in self.consumers:
-                        LOG.info("\tSent %d messages from %s" %
-                                          (messages_sent[consumer.queue_name],
-                                           consumer.queue_name))
-                        total_messages += messages_sent[consumer.queue_name]
-                    LOG.info("\tSent %d total messages" % total_messages)
-                    if total_messages > 0:
-                        LOG.info("\tMessages per second: %f" %
-                                    (float(total_messages) / elapsed))
-
-                    start_time = datetime.datetime.now()
-                    messages_sent = {}
+                messages = self.fetch_messages(consumer)
+                num_messages = len(messages)
+                if num_messages > 0:
+                    consumer.fetched_messages(messages)
+                    self.messages_processed(consumer, num_messages)
+                if max_connection_age > 0:
+                    age = datetime.datetime.now() - consumer.connect_time
+                    age_sec = age.seconds + (age.days * 86400)
+                    if age_sec > max_connection_age:
+                        LOG.info("Maximum AMQP connection time for "
+                                 "connection to %s reached. "
+                                 "Reconnecting..." % consumer.queue_name)
+                        self.establish_consumer_connection(consumer)
 
                 # This should really only be used when trying to discern bugs
                 # in the flood of messages and coupled with DEBUG logging.
@@ -212,12 +213,111 @@ class Broker(object):
                 if poll_delay:
                     time.sleep(poll_delay)
             except socket.error, e:
-                LOG.critical("Rabbit connection lost, reconnecting")
+                LOG.critical("Rabbit connection lost for %s, reconnecting" %
+                             consumer.queue_name)
                 LOG.exception(e)
                 self.establish_consumer_connection(consumer)
             except amqplib.client_0_8.exceptions.AMQPException, e:
-                LOG.critical("Rabbit connection lost, reconnecting")
+                LOG.critical("Rabbit connection lost for %s, reconnecting" %
+                             consumer.queue_name)
                 LOG.exception(e)
                 self.establish_consumer_connection(consumer)
             except Exception, e:
                 LOG.exception(e)
+
+    def messages_processed(self, consumer, num_messages):
+        with self.stats_lock:
+            sent = self.messages_sent.get(consumer.queue_name, 0)
+            self.messages_sent[consumer.queue_name] = sent + num_messages
+
+    def report_loop(self):
+        update_timer = int(conf.get("global", "update_timer"))
+        start_time = datetime.datetime.now()
+        while True:
+            time.sleep(update_timer)
+            with self.stats_lock:
+                messages_sent = self.messages_sent
+                self.messages_sent = {}
+            # Ingnoring microseconds because we're not going to let you
+            # be that granular and it's not super useful anyway
+            td = datetime.datetime.now() - start_time
+            elapsed = td.seconds + td.days * 86400
+            start_time = datetime.datetime.now()
+            self.report(messages_sent, elapsed)
+            if self.report_hook:
+                self.report_hook(messages_sent, elapsed)
+
+    def report(self, messages_sent, elapsed):
+        LOG.info("Update timer elapsed: %s seconds", str(elapsed))
+        total_messages = 0
+        for consumer in self.consumers:
+            sent = messages_sent.get(consumer.queue_name, 0)
+            LOG.info("\tSent %d messages from %s" %
+                     (sent, consumer.queue_name))
+            total_messages += sent
+        LOG.info("\tSent %d total messages" % total_messages)
+        if total_messages > 0 and elapsed > 0:
+            LOG.info("\tMessages per second: %f" %
+                     (float(total_messages) / elapsed))
+
+
+class PushBroker(Broker):
+    """Consumes with basic_consume instead of polling with basic_get.
+
+    Rabbit pushes up to ``prefetch_count`` unacknowledged messages to each
+    consumer ahead of time, so filling a batch costs no round-trips. A batch
+    is handed to the consumer once it holds ``max_messages`` messages or
+    once ``max_linger`` seconds have passed, whichever comes first. Both
+    can be set per queue in the ``[consumer:*]`` sections, falling back to
+    ``[rabbit_broker]``. A ``prefetch_count`` of 0 means the configured
+    ``max_messages``.
+    """
+
+    def __init__(self):
+        super(PushBroker, self).__init__()
+        self.buffers = {}
+
+    def _consumer_option(self, consumer, option):
+        val = consumer.config(option)
+        if val is None:
+            val = conf.get("rabbit_broker", option)
+        return val
+
+    def consumer_connected(self, consumer):
+        prefetch_count = int(self._consumer_option(consumer,
+                                                   "prefetch_count"))
+        if prefetch_count <= 0:
+            prefetch_count = consumer.batch_limit
+        # Any messages buffered from the old connection will be redelivered
+        # since they were never acked, so start over with an empty buffer.
+        buf = self.buffers[consumer.queue_name] = []
+        carrot_consumer = consumer.consumer
+        carrot_consumer.qos(0, prefetch_count, False)
+        carrot_consumer.register_callback(lambda data, msg: buf.append(msg))
+        carrot_consumer.consume()
+
+    def poll_delay(self):
+        # Waiting on the socket replaces the sleep between sweeps.
+        return 0
+
+    def fetch_messages(self, consumer):
+        buf = self.buffers[consumer.queue_name]
+        linger = float(self._consumer_option(consumer, "max_linger"))
+        connection = consumer.consumer.backend.channel.connection
+        deadline = time.time() + linger
+        while len(buf) < consumer.max_messages:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                # Each call dispatches at most one delivery to the callback
+                # registered in consumer_connected.
+                connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                break
+        messages = buf[:consumer.max_messages]
+        del buf[:len(messages)]
+        if messages:
+            LOG.debug("Received %d messages on queue %s" %
+                      (len(messages), consumer.queue_name))
+        return messages
@@ -0,0 +1,96 @@
+"""A circuit breaker to stop hammering an endpoint that is down."""
+
+import collections
+import threading
+import time
+
+import yagi.log
+from yagi import stats
+
+LOG = yagi.log.logger
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+# Reported as a gauge so the state can be graphed.
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker(object):
+    """Tracks the outcome of the last ``window`` calls to an endpoint.
+
+    Once at least ``min_calls`` of them are in and the share that failed
+    reaches ``failure_rate`` the breaker opens and allow() turns everybody
+    away. After ``reset_timeout`` seconds it goes half open and lets a
+    single probe through. If the probe succeeds the breaker closes again,
+    otherwise it stays open for another ``reset_timeout``. A probe that
+    never reports back is given up on after ``reset_timeout``, and the
+    next caller probes instead.
+    """
+
+    def __init__(self, name, failure_rate=0.5, window=20, min_calls=10,
+                 reset_timeout=30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.outcomes = collections.deque(maxlen=window)
+        self.state = CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.probe_started = None
+        self.lock = threading.Lock()
+
+    def _transition(self, state):
+        LOG.warn("Circuit breaker %s is now %s" % (self.name, state))
+        self.state = state
+        stats.increment_stat(stats.metric("%s.%s" % (self.name, state)))
+        stats.gauge_stat(stats.metric("%s.state" % self.name),
+                         STATE_VALUES[state])
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self._transition(HALF_OPEN)
+            now = time.time()
+            if self.probing and now - self.probe_started < self.reset_timeout:
+                return False
+            self.probing = True
+            self.probe_started = now
+            return True
+
+    def retry_after(self):
+        """Seconds until the breaker will let a probe through."""
+        with self.lock:
+            if self.state != OPEN:
+                return 0
+            return max(self.opened_at + self.reset_timeout - time.time(), 0)
+
+    def success(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                self.outcomes.clear()
+                self._transition(CLOSED)
+            self.outcomes.append(True)
+
+    def failure(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                self._open()
+                return
+            self.outcomes.append(False)
+            if self.state == CLOSED and len(self.outcomes) >= self.min_calls:
+                failed = self.outcomes.count(False)
+                if float(failed) / len(self.outcomes) >= self.failure_rate:
+                    self._open()
+
+    def _open(self):
+        self.opened_at = time.time()
+        self._transition(OPEN)
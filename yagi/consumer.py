@@ -1,4 +1,6 @@
+import copy
 import datetime
+import threading
 import time
 
 import yagi.config
@@ -9,6 +11,217 @@ import yagi.utils
 
 LOG = yagi.log.logger
 
+# per_handler: every AUTO_ACK handler acks each message as it goes
+# after_chain: one ack for the whole batch once every handler has run
+# immediate: one ack for the whole batch before any handler runs
+ACK_POLICIES = ('per_handler', 'after_chain', 'immediate')
+
+
+class Envelope(object):
+    """A broker message, decoded and filtered once for the whole chain.
+
+    Handlers see ``payload`` as the filtered payload, and can ack or
+    requeue the envelope just like the message it wraps. The decoded but
+    unfiltered payload is kept in ``raw_payload``.
+    """
+
+    __slots__ = ('message', 'raw_payload', 'payload', 'message_id',
+                 'event_type')
+
+    def __init__(self, message, filters=None):
+        self.message = message
+        self.raw_payload = message.payload
+        payload = self.raw_payload
+        if filters:
+            # Filters transform in place, leave the original alone.
+            payload = copy.deepcopy(payload)
+            for f in filters:
+                payload = f(payload)
+        self.payload = payload
+        if isinstance(payload, dict):
+            self.message_id = payload.get('message_id')
+            self.event_type = payload.get('event_type')
+        else:
+            self.message_id = self.event_type = None
+
+    @property
+    def body(self):
+        return self.message.body
+
+    @property
+    def delivery_tag(self):
+        return self.message.delivery_tag
+
+    @property
+    def backend(self):
+        return getattr(self.message, 'backend', None)
+
+    @property
+    def delivery_info(self):
+        return getattr(self.message, 'delivery_info', None)
+
+    @property
+    def acknowledged(self):
+        return self.message.acknowledged
+
+    def ack(self):
+        self.message.ack()
+
+    def requeue(self):
+        self.message.requeue()
+
+    def reject(self):
+        self.message.reject()
+
+
+def ack_messages(messages):
+    """Acknowledges a batch with a single multiple ack where possible."""
+    pending = [m.message if isinstance(m, Envelope) else m
+               for m in messages if not m.acknowledged]
+    if not pending:
+        return
+    last = max(pending, key=lambda m: m.delivery_tag)
+    channel = getattr(getattr(last, 'backend', None), 'channel', None)
+    if channel is None:
+        for message in pending:
+            message.ack()
+        return
+    # Acks everything up to and including this tag that is still
+    # outstanding on the channel, i.e. the whole batch.
+    channel.basic_ack(last.delivery_tag, multiple=True)
+    for message in pending:
+        # Carrot has no public way to record an ack done on its behalf.
+        message._state = "ACK"
+
+
+def requeue_messages(messages):
+    """Requeues messages, rejecting those that were redelivered already.
+
+    A message that fails again once redelivered would most likely go on
+    failing, so it is rejected, i.e. dead-lettered if the queue has a
+    dead letter exchange and dropped otherwise, rather than requeued
+    forever.
+    """
+    # AMQP 0-8 has no multiple reject, so this is still a frame per message,
+    # but it is done in one go once the handler chain has finished.
+    for message in messages:
+        if message.acknowledged:
+            continue
+        info = getattr(message, 'delivery_info', None) or {}
+        if not info.get('redelivered'):
+            message.requeue()
+            continue
+        LOG.error("Rejecting message %s, it failed again after being "
+                  "redelivered" % message.delivery_tag)
+        yagi.stats.increment_stat(yagi.stats.metric('messages_rejected'))
+        message.reject()
+
+
+def dependency_levels(handlers):
+    """Groups handlers into levels that can each run concurrently.
+
+    A handler depends on every handler listed before it that PROVIDES an
+    env key it REQUIRES, and is put in the level after the last of those.
+    Handlers without dependencies all land in the first level.
+    """
+    levels = []
+    provided = {}
+    for handler in handlers:
+        level = 0
+        for key in handler.REQUIRES:
+            if key not in provided:
+                LOG.warn("%s requires %s, which no earlier app provides" %
+                         (handler.__class__.__name__, key))
+                continue
+            level = max(level, provided[key] + 1)
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(handler)
+        for key in handler.PROVIDES:
+            provided[key] = level
+    return levels
+
+
+class ConcurrentChain(object):
+    """Runs the handlers of each dependency level side by side.
+
+    Every handler sees the same batch and env. A level only starts once
+    the previous one has finished, and if any handler in a level fails,
+    the exception is raised after its siblings are done and the remaining
+    levels are skipped, just as a failure skips the rest of a normal chain.
+    """
+
+    def __init__(self, handlers):
+        self.levels = dependency_levels(handlers)
+
+    def __call__(self, messages, env=None):
+        if env is None:
+            env = dict()
+        for level in self.levels:
+            if len(level) == 1:
+                level[0](messages, env=env)
+                continue
+            errors = []
+
+            def run(handler):
+                try:
+                    handler(messages, env=env)
+                except Exception, e:
+                    LOG.exception(e)
+                    errors.append(e)
+
+            threads = [threading.Thread(target=run, args=(handler,),
+                                        name="yagi-app-%s" %
+                                             handler.__class__.__name__)
+                       for handler in level]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+        return env
+
+
+class BatchSizer(object):
+    """Adjusts the batch size to a target latency and a byte budget.
+
+    After each batch the size shrinks to whatever should have fit in
+    ``target_latency`` seconds and ``max_bytes`` bytes of payload, judging
+    by that batch. A full batch that came in under both grows by at most
+    GROWTH, in proportion to the headroom left. The size always stays
+    within [min_size, max_size].
+    """
+
+    GROWTH = 1.5
+
+    def __init__(self, min_size, max_size, target_latency=None,
+                 max_bytes=None):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.size = max_size
+
+    def update(self, count, elapsed, num_bytes):
+        if count <= 0:
+            return self.size
+        ratios = []
+        if self.target_latency and elapsed > 0:
+            ratios.append(self.target_latency / elapsed)
+        if self.max_bytes and num_bytes > 0:
+            ratios.append(float(self.max_bytes) / num_bytes)
+        ratio = min(ratios) if ratios else self.GROWTH
+        if ratio < 1:
+            size = count * ratio
+        elif count >= self.size:
+            size = self.size * min(ratio, self.GROWTH)
+        else:
+            # A partial batch says nothing about how big we could go.
+            size = self.size
+        self.size = int(max(self.min_size, min(self.max_size, size)))
+        return self.size
+
 
 class Consumer(object):
     def __init__(self, queue_name, app=None, config=None):
@@ -19,12 +232,40 @@ class Consumer(object):
         self.connection = None
         self.consumer = None
         apps = [a.strip() for a in self.config("apps").split(",")]
-        prev_app = None
-        for a in apps:
-            prev_app = yagi.utils.import_class(a)(prev_app,
-                                                queue_name=self.queue_name)
-        self.app = prev_app
+        concurrent = yagi.config.get_bool("consumer:%s" % queue_name,
+                                          "concurrent_apps")
+        if concurrent:
+            self.app = ConcurrentChain([
+                yagi.utils.import_class(a)(queue_name=self.queue_name)
+                for a in apps])
+        else:
+            prev_app = None
+            for a in apps:
+                prev_app = yagi.utils.import_class(a)(
+                    prev_app, queue_name=self.queue_name)
+            self.app = prev_app
         self.max_messages = int(self.config("max_messages"))
+        # max_messages is the current batch size, which may be adjusted by
+        # the batch sizer, batch_limit is the configured upper bound.
+        self.batch_limit = self.max_messages
+        self.batch_sizer = None
+        target_latency = self.config("target_latency")
+        max_batch_bytes = self.config("max_batch_bytes")
+        if target_latency or max_batch_bytes:
+            self.batch_sizer = BatchSizer(
+                int(self.config("min_messages") or 1),
+                self.batch_limit,
+                target_latency=float(target_latency or 0),
+                max_bytes=int(max_batch_bytes or 0))
+        self.ack_policy = self.config("ack_policy") or 'per_handler'
+        if self.ack_policy not in ACK_POLICIES:
+            raise Exception("Invalid ack_policy '%s' for queue %s" %
+                            (self.ack_policy, queue_name))
+        if concurrent and self.ack_policy == 'per_handler':
+            # Acks can't come from several threads on one channel.
+            LOG.info("Using ack_policy after_chain for queue %s, since its "
+                     "apps run concurrently" % queue_name)
+            self.ack_policy = 'after_chain'
 
         filter_names = self.config("filters")
         if filter_names:
@@ -56,19 +297,60 @@ class Consumer(object):
         self.connection = None
         self.consumer = None
 
+    def envelopes(self, messages):
+        """Wraps a batch for the chain, rejecting what can't be wrapped.
+
+        A message whose body can't be decoded, or that a filter fails
+        on, would fail the same way if redelivered, so it is rejected
+        rather than holding up the rest of the batch.
+        """
+        envelopes = []
+        for message in messages:
+            try:
+                envelopes.append(Envelope(message, self.filters))
+            except Exception, e:
+                LOG.exception("Rejecting message %s on %s: %s" %
+                              (message.delivery_tag, self.queue_name, e))
+                yagi.stats.increment_stat(
+                    yagi.stats.metric('messages_rejected'))
+                try:
+                    message.reject()
+                except Exception, e:
+                    LOG.exception(e)
+        return envelopes
+
     def fetched_messages(self, messages):
-        if self.filters:
-            env = {'yagi.filters': self.filters}
-        else:
-            env = {}
+        env = {'yagi.ack_policy': self.ack_policy}
+        fetched = len(messages)
+        messages = self.envelopes(messages)
+        if self.ack_policy == 'immediate':
+            ack_messages(messages)
+        start_time = time.time()
         try:
-            start_time = time.time()
-            self.app(messages, env=env)
+            if messages:
+                self.app(messages, env=env)
             yagi.stats.time_stat(yagi.stats.elapsed_message(),
                                  time.time() - start_time)
         except Exception, e:
             # If we get all the way back out here, that's bad juju
             LOG.exception("Error in fetched_messages: \n%s" % e)
+            # Requeue what the handlers said failed, or, if they didn't
+            # say, the whole batch.
+            if not env.get('yagi.requeue'):
+                env['yagi.requeue'] = messages
+        if self.ack_policy == 'after_chain':
+            requeue_messages(env.get('yagi.requeue', []))
+            ack_messages(messages)
+
+        yagi.stats.increment_stat(yagi.stats.messages_sent(), fetched)
+        if self.batch_sizer:
+            self.resize_batch(messages, time.time() - start_time)
 
-        yagi.stats.increment_stat(yagi.stats.messages_sent(),
-                                  len(messages))
+    def resize_batch(self, messages, elapsed):
+        num_bytes = sum(len(getattr(m, 'body', None) or '')
+                        for m in messages)
+        self.max_messages = self.batch_sizer.update(len(messages), elapsed,
+                                                    num_bytes)
+        yagi.stats.gauge_stat("%s.%s" % (yagi.stats.metric('batch_size'),
+                                         self.queue_name),
+                              self.max_messages)
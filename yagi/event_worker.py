@@ -1,5 +1,8 @@
+import functools
+
 import yagi.config
 import yagi.log
+import yagi.supervisor
 import yagi.utils
 
 LOG = yagi.log.logger
@@ -8,11 +11,95 @@ with yagi.config.defaults_for('event_worker') as default:
     default('pidfile', 'yagi_event_worker.pid')
     default('daemonize', 'False')
     default('event_driver', 'yagi.broker.rabbit.Broker')
+    default('workers', '1')
+    default('worker_sharding', 'all')
+    default('respawn_delay', '5')
 
 
 def start(consumers):
+    workers = int(yagi.config.get('event_worker', 'workers'))
+    if workers > 1:
+        start_workers(consumers, workers)
+    else:
+        run_broker(consumers)
+
+
+def run_broker(consumers, report_hook=None):
     broker = yagi.utils.import_class(yagi.config.get('event_worker',
                                                      'event_driver'))()
+    broker.report_hook = report_hook
     for consumer in consumers:
         broker.add_consumer(consumer)
     broker.loop()
+
+
+def shard_consumers(consumers, workers, index, sharding):
+    """Picks the consumers worker number ``index`` is responsible for.
+
+    With 'queues' sharding each queue is handled by exactly one worker.
+    With 'all' sharding every worker consumes from every queue, and rabbit
+    spreads the messages between them.
+    """
+    if sharding == 'queues':
+        return consumers[index::workers]
+    return consumers
+
+
+def start_workers(consumers, workers):
+    sharding = yagi.config.get('event_worker', 'worker_sharding')
+    if sharding == 'queues' and workers > len(consumers):
+        LOG.warn("Only %d queues to shard across %d workers, starting %d "
+                 "workers" % (len(consumers), workers, len(consumers)))
+        workers = len(consumers)
+
+    def run_worker(index, report):
+        shard = shard_consumers(consumers, workers, index, sharding)
+        LOG.info("Worker %d consuming from %s" %
+                 (index, ", ".join(c.queue_name for c in shard)))
+        run_broker(shard, functools.partial(report_stats, report))
+
+    respawn_delay = int(yagi.config.get('event_worker', 'respawn_delay'))
+    stats = WorkerStats(workers)
+    supervisor = yagi.supervisor.Supervisor(workers, run_worker,
+                                            on_report=stats.update,
+                                            respawn_delay=respawn_delay)
+    supervisor.run()
+
+
+def report_stats(report, messages_sent, elapsed):
+    report(dict(messages_sent=messages_sent, elapsed=elapsed))
+
+
+class WorkerStats(object):
+    """Totals up the update_timer reports of every worker process."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.reports = {}
+
+    def update(self, index, stats):
+        self.reports[index] = stats
+        if len(self.reports) < self.workers:
+            return
+        self.log()
+        self.reports = {}
+
+    def log(self):
+        totals = {}
+        elapsed = 0
+        for index, stats in sorted(self.reports.items()):
+            sent = stats['messages_sent']
+            LOG.info("\tWorker %d sent %d messages" %
+                     (index, sum(sent.values())))
+            for queue_name, count in sent.iteritems():
+                totals[queue_name] = totals.get(queue_name, 0) + count
+            elapsed = max(elapsed, stats['elapsed'])
+        total_messages = sum(totals.values())
+        for queue_name, count in sorted(totals.items()):
+            LOG.info("\tSent %d messages from %s across all workers" %
+                     (count, queue_name))
+        LOG.info("\tSent %d total messages across %d workers" %
+                 (total_messages, self.workers))
+        if total_messages > 0 and elapsed > 0:
+            LOG.info("\tMessages per second: %f" %
+                     (float(total_messages) / elapsed))
@@ -0,0 +1,79 @@
+"""Keeps rendered feed pages around between requests."""
+
+import collections
+
+import webob
+
+import yagi.feed.compression
+from yagi import stats
+
+
+class CachedPage(object):
+    """A rendered page, and what is needed to tell whether it is stale.
+
+    Archived pages never change. Any other page is only good for as long
+    as the store is at the same version as when the page was rendered.
+    Compressed variants are kept along with the page, so each is only
+    compressed once.
+    """
+
+    HEADERS = ('Content-Type', 'Cache-Control', 'ETag', 'Last-Modified')
+
+    def __init__(self, response, version, archived, body=None):
+        self.body = response.body if body is None else body
+        self.headers = [(k, response.headers[k]) for k in self.HEADERS
+                        if k in response.headers]
+        self.version = version
+        self.archived = archived
+        self.variants = {}
+
+    def fresh(self, version):
+        return self.archived or self.version == version
+
+    def response(self, encoding=None, compress=None):
+        """Builds a response for the page, coded with encoding if given.
+
+        compress(body, encoding) makes any variant not made yet.
+        """
+        body = self.body
+        if encoding is not None:
+            body = self.variants.get(encoding)
+            if body is None:
+                body = self.variants[encoding] = compress(self.body, encoding)
+        response = webob.Response(body=body, conditional_response=True)
+        for key, value in self.headers:
+            response.headers[key] = value
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+            if 'ETag' in response.headers:
+                response.headers['ETag'] = yagi.feed.compression.variant_etag(
+                    response.headers['ETag'], encoding)
+        return response
+
+
+class ResponseCache(object):
+    """A size bounded LRU cache of CachedPages."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.pages = collections.OrderedDict()
+
+    def get(self, key):
+        page = self.pages.pop(key, None)
+        if page is None:
+            stats.increment_stat(stats.metric('feed.cache_miss'))
+            return None
+        self.pages[key] = page
+        stats.increment_stat(stats.metric('feed.cache_hit'))
+        return page
+
+    def put(self, key, page):
+        if self.max_size <= 0:
+            return
+        self.pages.pop(key, None)
+        self.pages[key] = page
+        while len(self.pages) > self.max_size:
+            self.pages.popitem(last=False)
+
+    def __len__(self):
+        return len(self.pages)
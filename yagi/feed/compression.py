@@ -0,0 +1,95 @@
+"""gzip and deflate content codings for feed responses."""
+
+import time
+import zlib
+
+from yagi import stats
+
+# zlib window bits for each coding. deflate is zlib wrapped, as HTTP says.
+ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS,
+             'deflate': zlib.MAX_WBITS}
+
+
+def choose_encoding(accept_encoding, available):
+    """Picks the coding to use for an Accept-Encoding header.
+
+    available lists the codings we can use, most preferred first. Returns
+    None if the client accepts none of them.
+    """
+    if not accept_encoding:
+        return None
+    qvalues = {}
+    star = 0
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if coding == '*':
+            star = q
+        else:
+            qvalues[coding] = q
+    best = None
+    best_q = 0
+    for coding in available:
+        q = qvalues.get(coding, star)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def variant_etag(etag, encoding):
+    """Tags a coded variant's ETag, as it is a different representation."""
+    if not etag or not etag.endswith('"'):
+        return etag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+
+def _record(raw_size, size, elapsed):
+    stats.time_stat(stats.metric('feed.compress_time'), elapsed)
+    if raw_size:
+        stats.gauge_stat(stats.metric('feed.compression_ratio'),
+                         float(size) / raw_size)
+
+
+def compress(body, encoding, level):
+    start = time.time()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+    data = compressor.compress(body) + compressor.flush()
+    _record(len(body), len(data), time.time() - start)
+    return data
+
+
+def compress_iter(chunks, encoding, level):
+    """Compresses an app_iter as it goes.
+
+    The first chunk, the feed header, is flushed right away so the client
+    doesn't wait on zlib's buffering for its first bytes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+    raw_size = size = 0
+    elapsed = 0.0
+    first = True
+    for chunk in chunks:
+        start = time.time()
+        data = compressor.compress(chunk)
+        if first:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            first = False
+        elapsed += time.time() - start
+        raw_size += len(chunk)
+        size += len(data)
+        if data:
+            yield data
+    start = time.time()
+    data = compressor.flush()
+    elapsed += time.time() - start
+    size += len(data)
+    _record(raw_size, size, elapsed)
+    yield data
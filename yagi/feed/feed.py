@@ -1,18 +1,39 @@
+import hashlib
+import time
+
 import eventlet
 from eventlet import wsgi
 import webob
 import webob.dec
+import webob.exc
 
 import yagi.config
+import yagi.feed.cache
+import yagi.feed.compression
 import yagi.log
 import yagi.persistence
 import yagi.serializer
+import yagi.supervisor
 
 LOG = yagi.log.logger
 
 with yagi.config.defaults_for('event_feed') as default:
     default('pagesize', '1000')
     default('port', '8080')
+    default('cache_size', '100')
+    default('archive_max_age', '86400')
+    default('stream', 'False')
+    default('compression', 'gzip, deflate')
+    default('compression_level', '6')
+    default('compression_min_size', '1024')
+    default('stream_cache_max_size', '1048576')
+    default('workers', '1')
+    default('pool_size', '1000')
+    default('backlog', '128')
+    default('respawn_delay', '5')
+
+# The parameters that pick which page is served.
+PAGE_PARAMS = ('page', 'marker', 'limit', 'direction')
 
 
 class EventFeed(object):
@@ -20,6 +41,107 @@ class EventFeed(object):
         self.db_driver = yagi.persistence.persistence_driver()
         self.feed_serializer = yagi.serializer.feed_serializer()
         self.pagesize = int(yagi.config.get('event_feed', 'pagesize'))
+        self.archive_max_age = int(yagi.config.get('event_feed',
+                                                   'archive_max_age'))
+        self.cache = yagi.feed.cache.ResponseCache(
+            int(yagi.config.get('event_feed', 'cache_size')))
+        # Only serializers that can write a piece at a time can stream.
+        self.stream = (yagi.config.get_bool('event_feed', 'stream') and
+                       hasattr(self.feed_serializer, 'iter_dumps'))
+        conf = yagi.config.config_with('event_feed')
+        self.encodings = [e.strip() for e in
+                          (conf('compression') or '').split(',')
+                          if e.strip() in yagi.feed.compression.ENCODINGS]
+        self.compression_level = int(conf('compression_level'))
+        self.compression_min_size = int(conf('compression_min_size'))
+        self.stream_cache_max_size = int(conf('stream_cache_max_size'))
+
+    def _cache_key(self, req):
+        params = tuple((k, req.params.get(k)) for k in PAGE_PARAMS)
+        return (req.path_info.strip('/'), params,
+                self.feed_serializer.__name__)
+
+    @webob.dec.wsgify()
+    def serve(self, req):
+        """Serves a request from the response cache, if it can.
+
+        Archived pages are kept until evicted. Any other page is kept
+        until the driver reports a new version of the store, i.e. until
+        something was written. Every page has a strong ETag and a
+        Last-Modified date, so clients can poll with conditional requests
+        and get a 304 back when nothing changed. Streamed pages larger
+        than stream_cache_max_size aren't cached.
+        """
+        key = self._cache_key(req)
+        encoding = yagi.feed.compression.choose_encoding(
+            req.headers.get('Accept-Encoding'), self.encodings)
+        cached = self.cache.get(key)
+        if cached is not None and cached.archived:
+            return self._cached_response(cached, encoding)
+        version = self.db_driver.version()
+        if cached is not None and cached.fresh(version):
+            return self._cached_response(cached, encoding)
+        response = req.get_response(self.route_request)
+        if response.status_int != 200:
+            return response
+        response.last_modified = time.time()
+        response.conditional_response = True
+        archived = 'immutable' in response.headers.get('Cache-Control', '')
+        # Without a version there is no telling when a page goes stale.
+        cacheable = archived or version is not None
+        if not self.stream:
+            response.md5_etag()
+            if cacheable:
+                page = yagi.feed.cache.CachedPage(response, version, archived)
+                self.cache.put(key, page)
+                return self._cached_response(page, encoding)
+        elif cacheable and self.stream_cache_max_size:
+            # The body isn't known when the headers go out, so the ETag
+            # comes from what the page is, and is only a weak one, since
+            # two renderings of it differ in their updated dates.
+            tag = hashlib.md5(repr((key, version))).hexdigest()
+            response.headers['ETag'] = 'W/"%s"' % tag
+
+            def cache_page(body):
+                self.cache.put(key, yagi.feed.cache.CachedPage(
+                    response, version, archived, body=body))
+
+            response.app_iter = _recorded(response.app_iter, cache_page,
+                                          self.stream_cache_max_size)
+        return self._encode(response, encoding)
+
+    def _compress(self, body, encoding):
+        return yagi.feed.compression.compress(body, encoding,
+                                              self.compression_level)
+
+    def _vary(self, response):
+        if self.encodings:
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    def _cached_response(self, page, encoding):
+        if len(page.body) < self.compression_min_size:
+            encoding = None
+        return self._vary(page.response(encoding, self._compress))
+
+    def _encode(self, response, encoding):
+        """Compresses a freshly rendered response, if the client wants."""
+        self._vary(response)
+        if encoding is None:
+            return response
+        if self.stream:
+            response.app_iter = yagi.feed.compression.compress_iter(
+                response.app_iter, encoding, self.compression_level)
+            response.content_length = None
+        elif len(response.body) < self.compression_min_size:
+            return response
+        else:
+            response.body = self._compress(response.body, encoding)
+        response.headers['Content-Encoding'] = encoding
+        if 'ETag' in response.headers:
+            response.headers['ETag'] = yagi.feed.compression.variant_etag(
+                response.headers['ETag'], encoding)
+        return response
 
     @webob.dec.wsgify()
     def route_request(self, req):
@@ -36,12 +158,52 @@ class EventFeed(object):
         return self.get_all(req)
 
     def _get_page(self, req, key=None):
-        maxpage = self.db_driver.pages(self.pagesize,
-                                     self.db_driver.count(key)) - 1
-        if 'page' in req.str_params:
-            return (int(req.str_params['page']), maxpage)
-        else:
-            return (maxpage, maxpage)
+        page = -1
+        if 'page' in req.params:
+            page = int(req.params['page'])
+        return self.db_driver.get_page(key, self.pagesize, page)
+
+    def _get_range(self, req, key=None):
+        """Responds with a keyset page, as in ?marker=<id>&limit=N.
+
+        These pages stay the same as new events arrive, unlike numbered
+        pages, so clients walking the links don't see duplicates or miss
+        entries. As on numbered pages, previous links to older entries and
+        next to newer ones.
+        """
+        params = req.params
+        limit = self.pagesize
+        if 'limit' in params:
+            limit = int(params['limit'])
+            if self.pagesize:
+                limit = min(limit, self.pagesize)
+        marker = params.get('marker')
+        direction = params.get('direction', 'older')
+        if direction not in ('older', 'newer'):
+            return webob.exc.HTTPBadRequest("Invalid direction")
+        try:
+            if self.stream:
+                # Entries are fetched as the response is written.
+                uuids, has_newer, has_older = self.db_driver.get_range_ids(
+                    key, marker, limit, direction)
+                elements = self.db_driver.iter_many(uuids)
+            else:
+                elements, has_newer, has_older = self.db_driver.get_range(
+                    key, marker, limit, direction)
+                uuids = [e['id'] for e in elements]
+        except yagi.persistence.InvalidEntityUUID:
+            return webob.exc.HTTPNotFound("Unknown marker")
+        newest = uuids[0] if uuids else marker
+        oldest = uuids[-1] if uuids else marker
+        # A full page of the entries older than a marker never changes.
+        # Newer pages don't qualify, their link to even newer entries
+        # depends on what has been written since.
+        archive = (marker is not None and direction == 'older' and
+                   bool(limit) and len(uuids) == limit)
+        return self.respond(req, elements,
+                            previous_marker=oldest if has_older else None,
+                            next_marker=newest if has_newer else None,
+                            limit=limit, path=key or '', archive=archive)
 
     def get_one(self, req, resource, uuid):
         LOG.debug('get_one %s %s' % (resource, uuid))
@@ -50,38 +212,105 @@ class EventFeed(object):
 
     def get_all_of_resource(self, req, resource):
         LOG.debug('get_all_of_resource %s' % resource)
-        page, maxpage = self._get_page(req, resource)
-        elements = self.db_driver.get_all_of_type(resource,
-                                                  self.pagesize,
-                                                  page)
-        #print elements
+        if 'page' not in req.params:
+            return self._get_range(req, resource)
+        elements, page, maxpage = self._get_page(req, resource)
+        # Numbered pages count up from the oldest entry, so they all shift
+        # whenever entries expire. They are never archived.
         return self.respond(req, elements, page, maxpage)
 
     def get_all(self, req):
         LOG.debug('get_all')
-        page, maxpage = self._get_page(req)
-        elements = self.db_driver.get_all(self.pagesize, page)
+        if 'page' not in req.params:
+            return self._get_range(req)
+        elements, page, maxpage = self._get_page(req)
         return self.respond(req, elements, page, maxpage)
 
-    def respond(self, req, elements, page=0, maxpage=0):
+    def respond(self, req, elements, page=0, maxpage=0, archive=False,
+                **links):
+        """Renders a page of the feed.
+
+        Archived pages, which won't change any more (RFC 5005), may be
+        cached by clients for archive_max_age seconds, other pages have to
+        be revalidated.
+        """
         response = webob.Response()
         response.content_type = 'application/atom+xml'
+        if archive:
+            response.headers['Cache-Control'] = (
+                'public, max-age=%d, immutable' % self.archive_max_age)
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
         previous_page = next_page = None
         if page > 0:
             previous_page = page - 1
         if page < maxpage:
             next_page = page + 1
-        response.body = self.feed_serializer.dumps(elements,
-                                                   previous_page=previous_page,
-                                                   next_page=next_page)
+        dumps = self.feed_serializer.dumps
+        if self.stream:
+            dumps = self.feed_serializer.iter_dumps
+        body = dumps(elements, previous_page=previous_page,
+                     next_page=next_page, archive=archive, **links)
+        if self.stream:
+            response.app_iter = body
+        else:
+            response.body = body
         return response
 
     def listen(self, port):
-        wsgi.server(eventlet.listen(('', port)), self.route_request)
+        self.serve_on(eventlet.listen(('', port)))
+
+    def serve_on(self, sock, pool_size=1000):
+        wsgi.server(sock, self.serve, max_size=pool_size)
+
+
+def _recorded(app_iter, done, max_size):
+    """Passes app_iter through, then calls done with everything it sent.
+
+    Once more than max_size bytes went by, what was kept is dropped and
+    done isn't called, so a streamed page is only ever held in full if it
+    is small enough to be worth caching.
+    """
+    chunks = []
+    size = 0
+    for chunk in app_iter:
+        if chunks is not None:
+            size += len(chunk)
+            if size > max_size:
+                chunks = None
+            else:
+                chunks.append(chunk)
+        yield chunk
+    if chunks is not None:
+        done(''.join(chunks))
+
+
+def serve(sock, pool_size):
+    """Serves the feed on sock, up to pool_size requests at a time.
+
+    The standard library is patched first, so the redis client yields to
+    other requests while it waits on the server instead of blocking the
+    whole process.
+    """
+    eventlet.monkey_patch()
+    EventFeed().serve_on(sock, pool_size)
 
 
 def start():
-    port = int(yagi.config.get('event_feed', 'port'))
+    conf = yagi.config.config_with('event_feed')
+    port = int(conf('port'))
+    workers = int(conf('workers'))
+    pool_size = int(conf('pool_size'))
     LOG.debug('Starting feed on port %d' % port)
-    event_feed = EventFeed()
-    event_feed.listen(port)
+    # Opened before forking, so every worker accepts from the same socket.
+    sock = eventlet.listen(('', port), backlog=int(conf('backlog')))
+    if workers <= 1:
+        serve(sock, pool_size)
+        return
+
+    def run_worker(index, report):
+        serve(sock, pool_size)
+
+    supervisor = yagi.supervisor.Supervisor(
+        workers, run_worker, respawn_delay=int(conf('respawn_delay')))
+    supervisor.run()
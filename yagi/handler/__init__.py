@@ -8,6 +8,10 @@ LOG = yagi.log.logger
 class BaseHandler(object):
     CONFIG_SECTION = "DEFAULT"
     AUTO_ACK = False
+    # env keys this handler needs from, or leaves for, other handlers. Used
+    # to order handlers when a consumer runs its apps concurrently.
+    REQUIRES = ()
+    PROVIDES = ()
 
     def __init__(self, app=None, queue_name=None):
         self.app = app
@@ -40,17 +44,39 @@ class BaseHandler(object):
         return env
 
     def filter_payload(self, payload, env):
+        """Applies the filters in env['yagi.filters'] to a payload.
+
+        Messages handed out by the consumer come already filtered, so this
+        only does anything for callers that set the filters themselves.
+        """
         filters = env.get('yagi.filters')
         if filters:
             for f in filters:
                 payload = f(payload)
         return payload
 
+    def ack_message(self, message, env):
+        """Acks a message if this handler is responsible for acking.
+
+        That is only the case for AUTO_ACK handlers when the consumer's
+        ack_policy is per_handler, otherwise the consumer acks the batch.
+        """
+        if env.get('yagi.ack_policy', 'per_handler') != 'per_handler':
+            return
+        if self.AUTO_ACK and not message.acknowledged:
+            message.ack()
+
+    def requeue_message(self, message, env):
+        """Asks the consumer to requeue a message rather than ack it.
+
+        Only honored with the after_chain ack_policy.
+        """
+        env.setdefault('yagi.requeue', []).append(message)
+
     def iterate_payloads(self, messages, env):
         for message in messages:
             yield self.filter_payload(message.payload, env)
-            if self.AUTO_ACK and not message.acknowledged:
-                message.ack()
+            self.ack_message(message, env)
 
     def handle_messages(self, messages, env):
         raise NotImplementedError()
@@ -1,10 +1,16 @@
+import json
+import os
+import Queue
+import threading
 import time
 
 import yagi.auth
+import yagi.circuit
 import yagi.config
 import yagi.handler
 import yagi.log
 import yagi.serializer.atom
+import yagi.spool
 from yagi import stats
 from yagi import http_util
 
@@ -15,6 +21,19 @@ with yagi.config.defaults_for("atompub") as default:
     default("max_wait", "600")
     default("failures_before_reauth", "5")
     default("interval", "30")
+    default("concurrency", "1")
+    default("pool_max_idle", "60")
+    default("pool_max_age", "3600")
+    default("retry_mode", "inline")
+    default("spool_dir", "yagi_spool")
+    default("dead_letter_file", "yagi_dead_letter.json")
+    default("circuit_breaker", "False")
+    default("breaker_failure_rate", "0.5")
+    default("breaker_window", "20")
+    default("breaker_min_calls", "10")
+    default("breaker_reset_timeout", "30")
+    default("batch_size", "0")
+    default("batch_max_bytes", "1048576")
 
 LOG = yagi.log.logger
 
@@ -31,9 +50,28 @@ class UnauthorizedException(Exception):
     pass
 
 
+class BatchRejected(Exception):
+    pass
+
+
+# Statuses that mean the endpoint doesn't take feeds of several entries.
+BATCH_REJECTED = (400, 405, 413, 415, 501)
+# Per-entry statuses that mean the entry doesn't need to be sent again.
+DELIVERED = (201, 409)
+
+
 class AtomPub(yagi.handler.BaseHandler):
     CONFIG_SECTION = "atompub"
     AUTO_ACK = True
+    PROVIDES = ('atompub.results',)
+
+    def __init__(self, app=None, queue_name=None):
+        super(AtomPub, self).__init__(app=app, queue_name=queue_name)
+        self.pool = None
+        self.scheduler = None
+        self.breakers = {}
+        self.breaker_lock = threading.Lock()
+        self.batch_supported = True
 
     def _send_notification(self, endpoint, puburl, headers, body, conn):
         LOG.debug("Sending message to %s with body: %s" % (endpoint, body))
@@ -63,12 +101,11 @@ class AtomPub(yagi.handler.BaseHandler):
                        "Also, response was too large." % puburl )
                 raise MessageDeliveryFailed(msg, e.response.status)
 
-    def new_http_connection(self, force=False):
+    def new_http_connection(self, headers, force=False):
         ssl_check = not (self.config_get("validate_ssl") == "True")
         conn = http_util.LimitingBodyHttp(
                         disable_ssl_certificate_validation=ssl_check)
         auth_method = yagi.auth.get_auth_method()
-        headers = {}
         if auth_method:
             try:
                 auth_method(conn, headers, force=force)
@@ -81,87 +118,447 @@ class AtomPub(yagi.handler.BaseHandler):
                 time.sleep(interval)
         else:
             raise Exception("Invalid auth or no auth supplied")
-        return conn, headers
+        return conn
+
+    def connection_pool(self):
+        """The connections, and auth headers, kept between batches."""
+        if self.pool is None:
+            self.pool = http_util.ConnectionPool(
+                self.new_http_connection,
+                max_size=int(self.config_get("concurrency") or 1),
+                max_idle=int(self.config_get("pool_max_idle")),
+                max_age=int(self.config_get("pool_max_age")),
+                name="atompub.pool")
+        return self.pool
+
+    def retry_scheduler(self):
+        """The scheduler failed deliveries are parked in, if any.
+
+        With retry_mode = scheduled a failed delivery is spooled to disk and
+        retried in the background instead of blocking the batch.
+        """
+        if self.config_get("retry_mode") != "scheduled":
+            return None
+        if self.scheduler is None:
+            name = self.queue_name or "default"
+            spool_dir = os.path.join(self.config_get("spool_dir"), name)
+            self.scheduler = yagi.spool.RetryScheduler(
+                yagi.spool.RetrySpool(spool_dir),
+                self._redeliver,
+                self.config_get("dead_letter_file"),
+                max_tries=int(self.config_get("retries")),
+                interval=int(self.config_get("interval")),
+                max_wait=int(self.config_get("max_wait")),
+                name=name)
+            self.scheduler.start()
+        return self.scheduler
+
+    def circuit_breaker(self, endpoint):
+        """The breaker for an endpoint, if circuit_breaker is enabled."""
+        if self.config_get("circuit_breaker") != "True":
+            return None
+        with self.breaker_lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = yagi.circuit.CircuitBreaker(
+                    "atompub.breaker",
+                    failure_rate=float(
+                        self.config_get("breaker_failure_rate")),
+                    window=int(self.config_get("breaker_window")),
+                    min_calls=int(self.config_get("breaker_min_calls")),
+                    reset_timeout=int(
+                        self.config_get("breaker_reset_timeout")))
+            return self.breakers[endpoint]
+
+    def _send_batch(self, endpoint, puburl, headers, body, conn):
+        """POSTs a feed of several entries.
+
+        Returns the per-entry status map from the response, if there is
+        one. The endpoint may answer 200 or 201 when every entry was
+        created, or 207 with a JSON object mapping each entry's id (the
+        message_id), optionally under an "entries" key, to its status.
+        """
+        LOG.debug("Sending batch to %s" % endpoint)
+        headers["Content-Type"] = "application/atom+xml"
+        try:
+            resp, content = conn.request(endpoint, "POST", body=body,
+                                         headers=headers)
+        except http_util.ResponseTooLargeError, e:
+            if e.response.status in (200, 201):
+                LOG.error("Response too large on successful batch post")
+                return {}
+            raise MessageDeliveryFailed("AtomPub batch create failed for "
+                                        "%s. Also, response was too "
+                                        "large." % puburl,
+                                        e.response.status)
+        if resp.status == 401:
+            raise UnauthorizedException("Unauthorized or token expired")
+        if resp.status in BATCH_REJECTED:
+            raise BatchRejected("AtomPub endpoint %s rejected a batch with "
+                                "status %s" % (puburl, resp.status))
+        if resp.status not in (200, 201, 207):
+            raise MessageDeliveryFailed("AtomPub batch create failed for %s "
+                                        "Status: %s, %s" %
+                                        (puburl, resp.status, content),
+                                        resp.status)
+        try:
+            statuses = json.loads(content)
+            statuses = statuses.get("entries", statuses)
+        except (TypeError, ValueError, AttributeError):
+            statuses = None
+        if not isinstance(statuses, dict):
+            if resp.status == 207:
+                # No idea which ones made it, so send them all singly.
+                return {}
+            statuses = {}
+        if resp.status != 207:
+            statuses["*"] = 201
+        return statuses
+
+    def _send(self, endpoint, headers, body, conn, send=None):
+        """Sends a notification, telling the endpoint's breaker how it went.
+
+        Only failures that point at the endpoint rather than the message
+        count against it: connection errors, 401s and 5xx responses.
+        """
+        send = send or self._send_notification
+        breaker = self.circuit_breaker(endpoint)
+        if breaker is None:
+            return send(endpoint, endpoint, headers, body, conn)
+        try:
+            code = send(endpoint, endpoint, headers, body, conn)
+        except BatchRejected:
+            breaker.success()
+            raise
+        except MessageDeliveryFailed, e:
+            if not e.code or e.code >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            raise
+        except Exception:
+            breaker.failure()
+            raise
+        breaker.success()
+        return code
+
+    def _redeliver(self, entry):
+        endpoint = self.config_get("url")
+        breaker = self.circuit_breaker(endpoint)
+        if breaker is not None and not breaker.allow():
+            return None
+        pool = self.connection_pool()
+        try:
+            conn, headers = pool.get()
+        except Exception:
+            # Not getting as far as sending still has to settle the probe,
+            # if this was one.
+            if breaker is not None:
+                breaker.failure()
+            stats.increment_stat(yagi.stats.failure_message())
+            raise
+        try:
+            self._send(endpoint, headers, entry["body"], conn)
+        except UnauthorizedException:
+            pool.discard(conn)
+            conn, headers = pool.create(force=True)
+            raise
+        except Exception:
+            stats.increment_stat(yagi.stats.failure_message())
+            raise
+        finally:
+            pool.put(conn, headers)
+        return True
 
     def handle_messages(self, messages, env):
-        retries = int(self.config_get("retries"))
-        interval = int(self.config_get("interval"))
-        max_wait = int(self.config_get("max_wait"))
-        failures_before_reauth = int(self.config_get("failures_before_reauth"))
-        conn, headers = self.new_http_connection()
+        # Set up before any delivery threads can race to do it.
+        self.retry_scheduler()
         results = env.setdefault('atompub.results', dict())
+        batch_size = int(self.config_get("batch_size") or 0)
+        if batch_size > 1 and self.batch_supported and len(messages) > 1:
+            self._deliver_batches(messages, env, results, batch_size)
+            return
+        concurrency = int(self.config_get("concurrency") or 1)
+        if concurrency > 1 and len(messages) > 1:
+            self._deliver_concurrently(messages, env, results,
+                                       min(concurrency, len(messages)))
+            return
+        pool = self.connection_pool()
+        conn, headers = pool.get()
+        try:
+            for payload in self.iterate_payloads(messages, env):
+                conn, headers = self._deliver(payload, conn, headers,
+                                              results)
+        finally:
+            pool.put(conn, headers)
 
-        for payload in self.iterate_payloads(messages, env):
-            msgid = payload["message_id"]
+    def _batches(self, messages, env, results, batch_size, max_bytes):
+        """Groups messages into batches of (message, payload, entity).
+
+        A batch holds at most batch_size entries and roughly max_bytes of
+        content. Malformed notifications are acked and left out.
+        """
+        batch = []
+        size = 0
+        for message in messages:
+            payload = self.filter_payload(message.payload, env)
             try:
                 entity = dict(content=payload,
                               id=payload["message_id"],
                               event_type=payload["event_type"])
-                payload_body = yagi.serializer.atom.dump_item(entity)
             except KeyError, e:
                 error_msg = "Malformed Notification: %s" % payload
                 LOG.error(error_msg)
                 LOG.exception(e)
-                results[msgid] = dict(error=True, code=0, message=error_msg)
+                results[payload.get("message_id")] = dict(
+                    error=True, code=0, message=error_msg)
+                self.ack_message(message, env)
                 continue
+            entry_size = len(json.dumps(payload))
+            if batch and (len(batch) >= batch_size or
+                          (max_bytes and size + entry_size > max_bytes)):
+                yield batch
+                batch = []
+                size = 0
+            batch.append((message, payload, entity))
+            size += entry_size
+        if batch:
+            yield batch
+
+    def _deliver_batches(self, messages, env, results, batch_size):
+        """Posts up to batch_size entries per request as one Atom feed.
 
-            endpoint = self.config_get("url")
-            tries = 0
-            failures = 0
-            code = 0
-            error_msg = ''
+        Entries the endpoint didn't report as created, and whole batches
+        that failed, are sent again one by one through the usual retry
+        path. If the endpoint rejects batches outright, batching is turned
+        off for good.
+        """
+        max_bytes = int(self.config_get("batch_max_bytes") or 0)
+        endpoint = self.config_get("url")
+        pool = self.connection_pool()
+        conn, headers = pool.get()
+        try:
+            for batch in self._batches(messages, env, results, batch_size,
+                                       max_bytes):
+                statuses = {}
+                if self.batch_supported:
+                    statuses = self._post_batch(endpoint, batch, headers,
+                                                conn)
+                for message, payload, entity in batch:
+                    msgid = entity["id"]
+                    code = statuses.get(str(msgid), statuses.get("*"))
+                    if code is not None and int(code) in DELIVERED:
+                        results[msgid] = dict(error=False, code=int(code),
+                                              message="Success")
+                    else:
+                        conn, headers = self._deliver(payload, conn, headers,
+                                                      results)
+                    self.ack_message(message, env)
+        finally:
+            pool.put(conn, headers)
+
+    def _post_batch(self, endpoint, batch, headers, conn):
+        body = yagi.serializer.atom.dumps([entity for m, p, entity in batch])
+        breaker = self.circuit_breaker(endpoint)
+        if breaker is not None and breaker.allow() is False:
+            return {}
+        try:
+            statuses = self._send(endpoint, headers, body, conn,
+                                  send=self._send_batch)
+            stats.increment_stat(stats.metric("atompub.batch_sent"))
+            return statuses
+        except BatchRejected, e:
+            LOG.error("%s, falling back to single entry posts" % e)
+            self.batch_supported = False
+        except Exception, e:
+            LOG.error("AtomPub batch delivery to %s failed, sending entries "
+                      "singly" % endpoint)
+            LOG.exception(e)
+            stats.increment_stat(yagi.stats.failure_message())
+        return {}
+
+    def _deliver_concurrently(self, messages, env, results, workers):
+        """Delivers messages over ``workers`` threads and connections.
 
+        Each message still gets its own retry/backoff and its own entry in
+        results. Messages are acked from the calling thread as they finish
+        since the broker channel isn't thread safe. Messages whose delivery
+        raised are left unacked and marked for requeueing, and the first
+        error is raised once every thread is done, as it would be
+        delivering them one by one.
+        """
+        pool = self.connection_pool()
+        pending = Queue.Queue()
+        done = Queue.Queue()
+        for message in messages:
+            pending.put((message, self.filter_payload(message.payload, env)))
+
+        def worker():
+            conn = headers = None
             while True:
                 try:
-                    code = self._send_notification(endpoint, endpoint,
-                                                   headers,
-                                                   payload_body,
-                                                   conn)
-                    error = False
-                    msg = ''
+                    message, payload = pending.get_nowait()
+                except Queue.Empty:
                     break
-                except UnauthorizedException, e:
-                    LOG.exception(e)
-                    conn = None
-                    code = 401
-                    error_msg = "Unauthorized"
-                except MessageDeliveryFailed, e:
-                    LOG.exception(e)
-                    code = e.code
-                    error_msg = e.msg
+                try:
+                    if conn is None:
+                        conn, headers = pool.get()
+                    conn, headers = self._deliver(payload, conn, headers,
+                                                  results)
                 except Exception, e:
-                    code = 0 #aka 'unknown failure'
-                    error_msg = "AtomPub General Delivery Failure to %s with: %s" % (endpoint, e)
-                    LOG.error(error_msg)
                     LOG.exception(e)
+                    if conn is not None:
+                        pool.discard(conn)
+                    conn = None
+                    done.put((message, payload, e))
+                    continue
+                done.put((message, payload, None))
+            if conn is not None:
+                pool.put(conn, headers)
+
+        threads = [threading.Thread(target=worker) for i in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        errors = []
+        for i in xrange(len(messages)):
+            message, payload, error = done.get()
+            if error is None:
+                self.ack_message(message, env)
+                continue
+            errors.append(error)
+            self.requeue_message(message, env)
+            msgid = payload.get("message_id")
+            if msgid not in results:
+                results[msgid] = dict(error=True, code=0, message=str(error))
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _deliver(self, payload, conn, headers, results):
+        """POSTs a single notification, retrying as configured.
+
+        Returns the connection and headers to use for the next message,
+        which may have been replaced along the way.
+        """
+        retries = int(self.config_get("retries"))
+        interval = int(self.config_get("interval"))
+        max_wait = int(self.config_get("max_wait"))
+        failures_before_reauth = int(self.config_get("failures_before_reauth"))
+        pool = self.connection_pool()
+
+        msgid = payload["message_id"]
+        try:
+            entity = dict(content=payload,
+                          id=payload["message_id"],
+                          event_type=payload["event_type"])
+            payload_body = yagi.serializer.atom.dump_item(entity)
+        except KeyError, e:
+            error_msg = "Malformed Notification: %s" % payload
+            LOG.error(error_msg)
+            LOG.exception(e)
+            results[msgid] = dict(error=True, code=0, message=error_msg)
+            return conn, headers
 
-                #If we got here, something failed.
-                stats.increment_stat(yagi.stats.failure_message())
-                # Number of overall tries
-                tries += 1
-                # Number of tries between re-auth attempts
-                failures += 1
-
-                # Used primarily for testing, but it's possible we don't
-                # care if we lose messages?
-                if retries > 0:
-                    if tries >= retries:
-                        msg = "Exceeded retry limit. Error %s" % error_msg
-                        results[msgid] = dict(error=False, code=code, message=msg)
-                        break
-                wait = min(tries * interval, max_wait)
-                LOG.error("Message delivery failed, going to sleep, will "
-                         "try again in %s seconds" % str(wait))
+        endpoint = self.config_get("url")
+        tries = 0
+        failures = 0
+        code = 0
+        error_msg = ''
+
+        breaker = self.circuit_breaker(endpoint)
+        scheduler = self.retry_scheduler()
+
+        while True:
+            if breaker is not None and not breaker.allow():
+                if scheduler is not None:
+                    scheduler.schedule(msgid, payload_body, tries=tries,
+                                       error="Circuit open")
+                    stats.increment_stat(stats.metric("atompub.spooled"))
+                    results[msgid] = dict(error=False, code=0,
+                                          message="Circuit open, queued "
+                                                  "for retry")
+                    if conn is None:
+                        conn, headers = pool.create(force=True)
+                    return conn, headers
+                # Hold on to the message, unacked, until a probe has
+                # shown the endpoint is back.
+                wait = max(breaker.retry_after(), 1)
+                LOG.error("Circuit open for %s, holding delivery for %s "
+                          "seconds" % (endpoint, wait))
                 time.sleep(wait)
+                continue
+            try:
+                code = self._send(endpoint, headers, payload_body, conn)
+                error = False
+                msg = ''
+                break
+            except UnauthorizedException, e:
+                LOG.exception(e)
+                pool.discard(conn)
+                conn = None
+                code = 401
+                error_msg = "Unauthorized"
+            except MessageDeliveryFailed, e:
+                LOG.exception(e)
+                code = e.code
+                error_msg = e.msg
+            except Exception, e:
+                code = 0 #aka 'unknown failure'
+                error_msg = "AtomPub General Delivery Failure to %s with: %s" % (endpoint, e)
+                LOG.error(error_msg)
+                LOG.exception(e)
 
-                if failures >= failures_before_reauth:
-                    # Don't always try to reconnect, give it a few
-                    # tries first
-                    failures = 0
-                    conn = None
+            #If we got here, something failed.
+            stats.increment_stat(yagi.stats.failure_message())
+            # Number of overall tries
+            tries += 1
+            # Number of tries between re-auth attempts
+            failures += 1
+
+            if scheduler is not None:
+                if code == 401 and tries == 1:
+                    # Most likely an expired token, reauth and go again
+                    # right away rather than spooling every message.
+                    conn, headers = pool.create(force=True)
+                    continue
+                entry = dict(id=msgid, body=payload_body, tries=tries,
+                             error=error_msg)
+                if retries > 0 and tries >= retries:
+                    msg = "Exceeded retry limit. Error %s" % error_msg
+                    scheduler.dead_letter(entry)
+                    stats.increment_stat(stats.metric("atompub.dead_letter"))
+                else:
+                    msg = "Queued for retry. Error %s" % error_msg
+                    scheduler.schedule(msgid, payload_body, tries=tries,
+                                       error=error_msg)
+                    stats.increment_stat(stats.metric("atompub.spooled"))
+                results[msgid] = dict(error=False, code=code, message=msg)
                 if conn is None:
-                    conn, headers = self.new_http_connection(force=True)
+                    conn, headers = pool.create(force=True)
+                return conn, headers
 
-            results[msgid] = dict(error=False, code=code, message="Success")
+            # Used primarily for testing, but it's possible we don't
+            # care if we lose messages?
+            if retries > 0:
+                if tries >= retries:
+                    msg = "Exceeded retry limit. Error %s" % error_msg
+                    results[msgid] = dict(error=False, code=code, message=msg)
+                    return conn, headers
+            wait = min(tries * interval, max_wait)
+            LOG.error("Message delivery failed, going to sleep, will "
+                     "try again in %s seconds" % str(wait))
+            time.sleep(wait)
 
+            if failures >= failures_before_reauth:
+                # Don't always try to reconnect, give it a few
+                # tries first
+                failures = 0
+                if conn is not None:
+                    pool.discard(conn)
+                conn = None
+            if conn is None:
+                conn, headers = pool.create(force=True)
 
+        results[msgid] = dict(error=False, code=code, message="Success")
+        return conn, headers
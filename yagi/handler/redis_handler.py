@@ -1,6 +1,8 @@
+import yagi.config
 import yagi.handler
 import yagi.log
 import yagi.persistence
+import yagi.serializer
 
 LOG = yagi.log.logger
 
@@ -10,13 +12,43 @@ event_attributes = ['message_id', 'publisher_id', 'event_type', 'priority',
 
 class RedisHandler(yagi.handler.BaseHandler):
 
+    def __init__(self, app=None, queue_name=None):
+        super(RedisHandler, self).__init__(app=app, queue_name=queue_name)
+        self.db = None
+        self.serializer = None
+        if yagi.config.get_bool('persistence', 'store_fragments'):
+            self.serializer = yagi.serializer.feed_serializer()
+            if not hasattr(self.serializer, 'render_entry'):
+                LOG.warn("%s can't pre-render entries" %
+                         self.serializer.__name__)
+                self.serializer = None
+
+    def driver(self):
+        # Kept for the life of the handler, along with its connections.
+        if self.db is None:
+            self.db = yagi.persistence.persistence_driver()
+        return self.db
+
     def handle_messages(self, messages, env):
-        db = yagi.persistence.persistence_driver()
+        entities = []
         for payload in self.iterate_payloads(messages, env):
-            self._persist_event(db, payload)
+            try:
+                entities.append(self._event_entity(payload))
+            except KeyError, e:
+                # It would never be stored, so don't hold the rest back.
+                LOG.error("Skipping malformed notification: %s" % payload)
+                LOG.exception(e)
+        fragments = None
+        if self.serializer is not None:
+            # Events never change, so render them for the feed just once.
+            fragments = [self.serializer.render_entry(
+                             dict(id=m_id, event_type=key, content=value))
+                         for key, m_id, value in entities]
+        self.driver().create_many(entities, fragments)
+        LOG.debug('%d new notifications created' % len(entities))
 
-    def _persist_event(self, db, message_body):
-        """Stores an incoming event in the database
+    def _event_entity(self, message_body):
+        """Returns the (event_type, message_id, body) to store for an event
 
         Messages have the following expected attributes:
 
@@ -33,5 +65,4 @@ class RedisHandler(yagi.handler.BaseHandler):
                 LOG.error("Invalid Message Format, missing key %s" % key)
         event_type = message_body['event_type']
         m_id = message_body['message_id']
-        db.create(event_type, m_id, message_body)
-        LOG.debug('New notification created')
+        return event_type, m_id, message_body
@@ -15,6 +15,7 @@ LOG = yagi.log.logger
 
 class StackTachPing(yagi.handler.BaseHandler):
     CONFIG_SECTION = "stacktach"
+    REQUIRES = ('atompub.results',)
 
     def handle_messages(self, messages, env):
         atompub_results = env.get('atompub.results')
@@ -2,7 +2,12 @@
 import errno
 import httplib
 import httplib2
+import select
 import socket
+import threading
+import time
+
+from yagi import stats
 
 
 class ResponseTooLargeError(httplib2.HttpLib2ErrorWithResponse):
@@ -21,6 +26,8 @@ class LimitingBodyHttp(httplib2.Http):
     def __init__(self, max_body_size=1024 * 40, **kw):
         self.max_body_size = max_body_size
         self.follow_all_redirects = True
+        self.created = time.time()
+        self.last_used = self.created
         super(LimitingBodyHttp, self).__init__(**kw)
 
     def _conn_request(self, conn, request_uri, method, body, headers):
@@ -90,3 +97,92 @@ class LimitingBodyHttp(httplib2.Http):
                     content = httplib2._decompressContent(response, content)
             break
         return (response, content)
+
+
+def close_connection(conn):
+    for c in conn.connections.values():
+        try:
+            c.close()
+        except Exception:
+            pass
+
+
+def is_healthy(conn):
+    """False if the server has closed, or sent junk down, an idle socket.
+
+    An idle keep-alive socket should never be readable. If it is, the
+    server either hung up or sent something we didn't ask for.
+    """
+    for c in conn.connections.values():
+        if c.sock is None:
+            continue
+        try:
+            readable, _, _ = select.select([c.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        if readable:
+            return False
+    return True
+
+
+class ConnectionPool(object):
+    """Keeps keep-alive connections to one endpoint around between uses.
+
+    ``factory(headers, force=False)`` must return a new connection, and
+    fill in ``headers``, which starts out as a copy of the headers from the
+    last connection made. Auth methods that keep their token around can
+    then skip the auth round-trip unless ``force`` is set. Idle connections
+    are dropped after ``max_idle`` seconds, and any connection after
+    ``max_age`` seconds.
+    """
+
+    def __init__(self, factory, max_size=1, max_idle=60, max_age=3600,
+                 name="http_pool"):
+        self.factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.name = name
+        self.headers = {}
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _expired(self, conn, now):
+        if self.max_age > 0 and now - conn.created > self.max_age:
+            return True
+        if self.max_idle > 0 and now - conn.last_used > self.max_idle:
+            return True
+        return False
+
+    def get(self):
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                conn, headers = self.idle.pop()
+                if not self._expired(conn, now) and is_healthy(conn):
+                    stats.increment_stat(stats.metric("%s.hit" % self.name))
+                    return conn, headers
+                close_connection(conn)
+        return self.create()
+
+    def create(self, force=False):
+        stats.increment_stat(stats.metric("%s.miss" % self.name))
+        with self.lock:
+            headers = dict(self.headers)
+        conn = self.factory(headers, force=force)
+        with self.lock:
+            self.headers = dict(headers)
+        return conn, headers
+
+    def put(self, conn, headers):
+        now = time.time()
+        conn.last_used = now
+        with self.lock:
+            if len(self.idle) < self.max_size and \
+               not self._expired(conn, now):
+                self.idle.append((conn, headers))
+                return
+        close_connection(conn)
+
+    def discard(self, conn):
+        close_connection(conn)
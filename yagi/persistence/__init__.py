@@ -4,6 +4,7 @@ import yagi.utils
 yagi.config.defaults('persistence',
                      'driver',
                      'yagi.persistence.devnull.Driver')
+yagi.config.defaults('persistence', 'store_fragments', 'False')
 
 
 class InvalidEntityUUID(KeyError):
@@ -15,22 +16,133 @@ def persistence_driver():
     return yagi.utils.import_class(driver)()
 
 
+def keyset_slice(ids, marker=None, limit=None, direction='older'):
+    """Finds a keyset page in a newest first list of ids.
+
+    Returns (start, end, has_newer, has_older), where ids[start:end] are
+    the ids on the page.
+    """
+    if marker is None:
+        start = 0
+        end = limit or len(ids)
+    else:
+        try:
+            position = ids.index(marker)
+        except ValueError:
+            raise InvalidEntityUUID("Invalid marker: %s" % marker)
+        if direction == 'newer':
+            end = position
+            start = max(position - limit, 0) if limit else 0
+        else:
+            start = position + 1
+            end = start + limit if limit else len(ids)
+    return start, end, start > 0, end < len(ids)
+
+
 class Driver(object):
     def create(self, key, entity_uuid, value):
         pass
 
+    def create_many(self, entities, fragments=None):
+        """Stores a batch of (key, entity_uuid, value) tuples.
+
+        fragments, if given, holds a (signature, fragment) pre-rendered by
+        the feed serializer for each entity. Drivers that store them hand
+        them back as the entity's 'fragment' and 'fragment_sig'.
+
+        Drivers that can write a batch more cheaply than one entity at a
+        time should override this.
+        """
+        for key, entity_uuid, value in entities:
+            self.create(key, entity_uuid, value)
+
     def get(self, key, entity_uuid):
         return []
 
-    def get_all(self):
+    def get_many(self, entity_uuids):
+        """Returns the entities found for a list of uuids, in order."""
+        entities = []
+        for entity_uuid in entity_uuids:
+            try:
+                entities.extend(self.get(None, entity_uuid))
+            except InvalidEntityUUID:
+                pass
+        return entities
+
+    def iter_many(self, entity_uuids, chunk_size=100):
+        """Yields the entities found for uuids, fetching a chunk at a time."""
+        for i in xrange(0, len(entity_uuids), chunk_size):
+            for entity in self.get_many(entity_uuids[i:i + chunk_size]):
+                yield entity
+
+    def get_all(self, page_size=None, page=-1):
         return []
 
-    def get_all_of_type(self, key):
+    def get_all_of_type(self, key, page_size=None, page=-1):
         return []
 
     def count(self, type_key=None):
         return 1
 
+    def version(self):
+        """Returns something that changes whenever the stored data does.
+
+        None if the driver can't tell, in which case nothing it returns
+        is cached.
+        """
+        return None
+
+    def get_page(self, type_key=None, page_size=None, page=-1):
+        """Returns (entities, page, maxpage) for a page of the feed.
+
+        A negative page counts back from the newest one. Drivers that can
+        fetch the count and the page together should override this.
+        """
+        maxpage = self.pages(page_size, self.count(type_key)) - 1
+        if page < 0:
+            page = maxpage + 1 + page
+        if type_key:
+            entities = self.get_all_of_type(type_key, page_size, page)
+        else:
+            entities = self.get_all(page_size, page)
+        return entities, page, maxpage
+
+    def get_range(self, type_key=None, marker=None, limit=None,
+                  direction='older'):
+        """Returns (entities, has_newer, has_older) for a keyset page.
+
+        Entities come newest first. Without a marker the page starts with
+        the newest entity. With one, it holds up to limit entities older
+        than the marker, or newer with a direction of 'newer', but not the
+        marker itself. Unlike numbered pages, these don't shift as new
+        entities arrive. Raises InvalidEntityUUID for an unknown marker.
+
+        This reads the whole feed, drivers should override it with
+        something that can find the marker directly.
+        """
+        entities = self.get_page(type_key)[0]
+        start, end, has_newer, has_older = keyset_slice(
+            [e['id'] for e in entities], marker, limit, direction)
+        return entities[start:end], has_newer, has_older
+
+    def get_range_ids(self, type_key=None, marker=None, limit=None,
+                      direction='older'):
+        """Like get_range, but returns the uuids on the page, not entities.
+
+        For fetching the entities lazily, with iter_many.
+        """
+        entities, has_newer, has_older = self.get_range(type_key, marker,
+                                                        limit, direction)
+        return [e['id'] for e in entities], has_newer, has_older
+
+    def recode(self, batch_size=1000):
+        """Rewrites stored entries in the configured value codec.
+
+        Returns (entries, bytes before, bytes after). Drivers that don't
+        encode what they store have nothing to do.
+        """
+        return 0, 0, 0
+
     def pages(self, pagesize, length):
         if not pagesize:
             return 1
@@ -0,0 +1,95 @@
+"""Encodes the documents drivers store.
+
+Every value starts with a tag saying how it was encoded, so the format can
+be changed without rewriting what is already stored:
+
+    j<json>            JSON
+    m<msgpack>         msgpack, if the msgpack module is installed
+    z<tag><zlib data>  either of the above, zlib compressed
+
+Values written before the tags existed are untagged JSON objects, and so
+start with '{'.
+"""
+
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import yagi.config
+
+with yagi.config.defaults_for('persistence') as default:
+    default('codec', 'json')
+    default('compress_min_size', '0')
+    default('compress_level', '6')
+
+JSON = 'j'
+MSGPACK = 'm'
+ZLIB = 'z'
+
+FORMATS = {'json': JSON, 'msgpack': MSGPACK}
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _dumps(tag, doc):
+    if tag == MSGPACK:
+        return msgpack.packb(doc)
+    return json.dumps(doc, separators=(',', ':'))
+
+
+def _loads(tag, data):
+    if tag == JSON:
+        return json.loads(data)
+    if tag == MSGPACK:
+        if msgpack is None:
+            raise CodecError("Value stored as msgpack, but the msgpack "
+                             "module is not installed")
+        return msgpack.unpackb(data, raw=False)
+    raise CodecError("Unknown value tag %r" % tag)
+
+
+class Codec(object):
+    """Encodes with one format, decodes any of them.
+
+    Values of at least compress_min_size bytes are compressed when that
+    makes them smaller. A compress_min_size of 0 turns compression off.
+    """
+
+    def __init__(self, format='json', compress_min_size=0, compress_level=6):
+        if format not in FORMATS:
+            raise CodecError("Unknown codec %s, use one of %s" %
+                             (format, ", ".join(sorted(FORMATS))))
+        if FORMATS[format] == MSGPACK and msgpack is None:
+            raise CodecError("The msgpack codec needs the msgpack module")
+        self.tag = FORMATS[format]
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+
+    def encode(self, doc):
+        data = _dumps(self.tag, doc)
+        if self.compress_min_size and len(data) >= self.compress_min_size:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) + 1 < len(data):
+                return ZLIB + self.tag + compressed
+        return self.tag + data
+
+    def decode(self, value):
+        if value.startswith('{'):
+            return json.loads(value)
+        tag = value[:1]
+        if tag == ZLIB:
+            return _loads(value[1:2], zlib.decompress(value[2:]))
+        return _loads(tag, value[1:])
+
+
+def from_config():
+    conf = yagi.config.config_with('persistence')
+    return Codec(conf('codec') or 'json',
+                 int(conf('compress_min_size') or 0),
+                 int(conf('compress_level') or 6))
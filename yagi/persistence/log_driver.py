@@ -0,0 +1,440 @@
+"""Stores entries in an append-only log of segment files.
+
+Entries are never changed once written and are read newest first, so
+they are appended to a segment file in log_dir until it reaches
+segment_size, then a new segment is started. A segment is named after
+the sequence number of its first record, and the records in it are
+numbered from there, so an entry's sequence number says which segment
+it is in and where.
+
+Each record is a header (the length of the document, when it was
+written, and the lengths of its uuid and event type) followed by the
+uuid, the event type and the document, encoded with the value codec.
+
+Every process keeps an index of each segment in memory, built by reading
+the segment's record headers once and then whatever was appended since:
+
+* the offset of every INDEX_INTERVAL-th record, from which any other is
+  a few header hops away,
+* the record numbers of each event type, and
+* the record numbers of each uuid's hash, to find markers and entries
+  by.
+
+Segments are memory mapped, so reading a page doesn't take a system call
+per entry. Retention is a matter of deleting the segments whose newest
+record is older than entry_ttl. Several event workers may append to the
+same log, taking turns through a lock file.
+"""
+
+import array
+import bisect
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+import yagi.config
+import yagi.log
+import yagi.persistence
+import yagi.persistence.codec
+from yagi.persistence import InvalidEntityUUID
+
+with yagi.config.defaults_for('persistence') as default:
+    default('log_dir', 'yagi_log')
+    default('segment_size', 64 * 1024 * 1024)
+    default('entry_ttl', 60 * 60 * 24 * 30)
+    default('sweep_interval', 60)
+    default('fsync', 'False')
+
+LOG = yagi.log.logger
+
+# Document length, time written, uuid length, event type length.
+RECORD = struct.Struct('>IdHH')
+# How many records apart the offsets in the sparse index are.
+INDEX_INTERVAL = 16
+SUFFIX = '.log'
+
+
+def _record(entity_uuid, event_type, created, doc):
+    entity_uuid = unicode(entity_uuid).encode('utf-8')
+    event_type = unicode(event_type).encode('utf-8')
+    return ''.join((RECORD.pack(len(doc), created, len(entity_uuid),
+                                len(event_type)),
+                    entity_uuid, event_type, doc))
+
+
+class Segment(object):
+    """The in memory index of one segment file, and its mapping."""
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        # How much of the file has been indexed, which stops short of a
+        # record still being written.
+        self.size = 0
+        self.count = 0
+        self.newest = 0
+        self.map = None
+        self.sparse = array.array('l')
+        # Hash of uuid to record number, or to a list of them in the
+        # rare case two uuids hash the same.
+        self.ids = {}
+        self.types = {}
+
+    def refresh(self):
+        """Indexes whatever was appended since the last refresh."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size <= self.size:
+            return
+        with open(self.path, 'rb') as f:
+            # Readers may still hold the old mapping, so it is left for
+            # the garbage collector to close.
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        offset = self.size
+        while offset + RECORD.size <= size:
+            doc_len, created, uuid_len, type_len = RECORD.unpack_from(
+                self.map, offset)
+            start = offset + RECORD.size
+            end = start + uuid_len + type_len + doc_len
+            if end > size:
+                break
+            if self.count % INDEX_INTERVAL == 0:
+                self.sparse.append(offset)
+            key = hash(self.map[start:start + uuid_len])
+            found = self.ids.get(key)
+            if found is None:
+                self.ids[key] = self.count
+            elif isinstance(found, list):
+                found.append(self.count)
+            else:
+                self.ids[key] = [found, self.count]
+            event_type = self.map[start + uuid_len:start + uuid_len +
+                                  type_len]
+            if event_type not in self.types:
+                self.types[event_type] = array.array('I')
+            self.types[event_type].append(self.count)
+            self.newest = created
+            self.count += 1
+            offset = end
+        self.size = offset
+
+    def records(self, type_key=None):
+        """The numbers of the records of type_key, or of all of them."""
+        if type_key:
+            return self.types.get(type_key, ())
+        return xrange(self.count)
+
+    def _next(self, offset):
+        doc_len, created, uuid_len, type_len = RECORD.unpack_from(self.map,
+                                                                  offset)
+        return offset + RECORD.size + uuid_len + type_len + doc_len
+
+    def offsets(self, numbers):
+        """Finds the offsets of records, given their numbers in order."""
+        result = []
+        at = offset = None
+        for n in numbers:
+            block = n // INDEX_INTERVAL
+            if at is None or at > n or at < block * INDEX_INTERVAL:
+                at = block * INDEX_INTERVAL
+                offset = self.sparse[block]
+            while at < n:
+                offset = self._next(offset)
+                at += 1
+            result.append(offset)
+        return result
+
+    def read(self, offset):
+        """Returns the (uuid, event_type, doc) of the record at offset."""
+        doc_len, created, uuid_len, type_len = RECORD.unpack_from(self.map,
+                                                                  offset)
+        start = offset + RECORD.size
+        type_start = start + uuid_len
+        doc_start = type_start + type_len
+        return (self.map[start:type_start], self.map[type_start:doc_start],
+                self.map[doc_start:doc_start + doc_len])
+
+    def find(self, entity_uuid):
+        """Returns the number of the record for entity_uuid, or None."""
+        found = self.ids.get(hash(entity_uuid))
+        if found is None:
+            return None
+        if not isinstance(found, list):
+            found = [found]
+        for n in found:
+            if self.read(self.offsets([n])[0])[0] == entity_uuid:
+                return n
+        return None
+
+
+class Driver(yagi.persistence.Driver):
+    """Keeps entries in an append-only segmented log, see the module."""
+
+    def __init__(self):
+        conf = yagi.config.config_with('persistence')
+        self.log_dir = conf('log_dir')
+        self.segment_size = int(conf('segment_size'))
+        self.ttl = int(conf('entry_ttl'))
+        self.sweep_interval = float(conf('sweep_interval'))
+        self.fsync = yagi.config.get_bool('persistence', 'fsync')
+        self.codec = yagi.persistence.codec.from_config()
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        self.lock = threading.RLock()
+        self.segments = []
+        self.last_sweep = time.time()
+        super(yagi.persistence.Driver, self).__init__()
+
+    def _path(self, base):
+        return os.path.join(self.log_dir, '%020d%s' % (base, SUFFIX))
+
+    def refresh(self):
+        """Catches up with segments written or deleted by other processes."""
+        with self.lock:
+            bases = sorted(int(name[:-len(SUFFIX)])
+                           for name in os.listdir(self.log_dir)
+                           if name.endswith(SUFFIX))
+            known = dict((s.base, s) for s in self.segments)
+            segments = [known.get(base) or Segment(self._path(base), base)
+                        for base in bases]
+            # Only the segment that was newest, and any new ones, can have
+            # grown since.
+            newest = self.segments[-1].base if self.segments else -1
+            for segment in segments:
+                if segment.base >= newest:
+                    segment.refresh()
+            self.segments = segments
+            return segments
+
+    @contextlib.contextmanager
+    def _appending(self):
+        with self.lock:
+            with open(os.path.join(self.log_dir, 'lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield self.refresh()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def create(self, key, entity_uuid, value):
+        self.create_many([(key, entity_uuid, value)])
+
+    def create_many(self, entities, fragments=None):
+        """Appends the batch to the newest segment with a single write.
+
+        A segment can run past segment_size by up to a batch, as batches
+        aren't split across segments.
+        """
+        if not entities:
+            return
+        now = time.time()
+        records = []
+        for i, (key, entity_uuid, value) in enumerate(entities):
+            doc = dict(content=value)
+            if fragments:
+                doc['fragment_sig'], doc['fragment'] = fragments[i]
+            records.append(_record(entity_uuid, key, now,
+                                   self.codec.encode(doc)))
+        with self._appending() as segments:
+            segment = segments[-1] if segments else None
+            if segment is None or segment.size >= self.segment_size:
+                base = segment.base + segment.count if segment else 0
+                path = self._path(base)
+            else:
+                path = segment.path
+            with open(path, 'ab') as f:
+                # Drop what's left of a write that was cut short.
+                if segment is not None and path == segment.path:
+                    f.truncate(segment.size)
+                f.write(''.join(records))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+        if (self.sweep_interval and
+                now - self.last_sweep >= self.sweep_interval):
+            self.sweep(now)
+
+    def sweep(self, now=None):
+        """Deletes the segments holding nothing newer than entry_ttl.
+
+        The newest segment is always kept, so new records keep counting
+        from where it ends. Returns how many entries were deleted.
+        """
+        self.last_sweep = now or time.time()
+        if self.ttl <= 0:
+            return 0
+        cutoff = self.last_sweep - self.ttl
+        removed = 0
+        with self._appending() as segments:
+            for segment in segments[:-1]:
+                if segment.newest >= cutoff:
+                    break
+                os.unlink(segment.path)
+                removed += segment.count
+            self.refresh()
+        if removed:
+            LOG.debug("Swept %d expired entries" % removed)
+        return removed
+
+    def _entity(self, segment, offset):
+        entity_uuid, event_type, doc = segment.read(offset)
+        doc = self.codec.decode(doc)
+        entity = {'id': entity_uuid, 'content': doc['content'],
+                  'event_type': event_type}
+        if 'fragment' in doc:
+            entity['fragment'] = doc['fragment']
+            entity['fragment_sig'] = doc['fragment_sig']
+        return entity
+
+    def _entities(self, located):
+        """Reads the entities at a list of (segment, record number)."""
+        entities = []
+        i = 0
+        while i < len(located):
+            # Runs in the same segment are read in one pass over it.
+            segment = located[i][0]
+            j = i
+            while j < len(located) and located[j][0] is segment:
+                j += 1
+            numbers = [n for s, n in located[i:j]]
+            order = sorted(xrange(len(numbers)), key=numbers.__getitem__)
+            offsets = segment.offsets([numbers[k] for k in order])
+            run = [None] * len(numbers)
+            for k, offset in zip(order, offsets):
+                run[k] = self._entity(segment, offset)
+            entities.extend(run)
+            i = j
+        return entities
+
+    def _find(self, segments, entity_uuid, type_key=None):
+        entity_uuid = unicode(entity_uuid).encode('utf-8')
+        for segment in reversed(segments):
+            n = segment.find(entity_uuid)
+            if n is None:
+                continue
+            if type_key and segment.read(segment.offsets([n])[0])[1] != \
+                    type_key:
+                return None
+            return segment, n
+        return None
+
+    def get_many(self, entity_uuids):
+        segments = self.refresh()
+        located = [self._find(segments, entity_uuid)
+                   for entity_uuid in entity_uuids]
+        return self._entities([l for l in located if l is not None])
+
+    def get(self, key, entity_uuid):
+        """key is not used."""
+        entities = self.get_many([entity_uuid])
+        if not entities:
+            raise InvalidEntityUUID("Invalid event uuid: %s" % entity_uuid)
+        return entities
+
+    def count(self, type_key=None):
+        return sum(len(s.records(type_key)) for s in self.refresh())
+
+    def version(self):
+        segments = self.refresh()
+        if not segments:
+            return None
+        return '%d-%d' % (segments[0].base,
+                          segments[-1].base + segments[-1].count)
+
+    def _older(self, segments, type_key, seq=None):
+        """Yields (segment, record number) newest first, from before seq."""
+        for segment in reversed(segments):
+            if seq is not None and segment.base >= seq:
+                continue
+            records = segment.records(type_key)
+            i = len(records)
+            if seq is not None:
+                i = bisect.bisect_left(records, seq - segment.base)
+            for k in xrange(i - 1, -1, -1):
+                yield segment, records[k]
+
+    def _newer(self, segments, type_key, seq):
+        """Yields (segment, record number) oldest first, from after seq."""
+        for segment in segments:
+            if segment.base + segment.count <= seq:
+                continue
+            records = segment.records(type_key)
+            i = bisect.bisect_right(records, seq - segment.base)
+            for k in xrange(i, len(records)):
+                yield segment, records[k]
+
+    def _range(self, type_key, marker, limit, direction):
+        segments = self.refresh()
+        seq = None
+        if marker is not None:
+            found = self._find(segments, marker, type_key)
+            if found is None:
+                raise InvalidEntityUUID("Invalid marker: %s" % marker)
+            seq = found[0].base + found[1]
+        newer = seq is not None and direction == 'newer'
+        if newer:
+            located = self._newer(segments, type_key, seq)
+        else:
+            located = self._older(segments, type_key, seq)
+        if limit:
+            # One more than the page holds, to tell if there is another.
+            located = [l for l, _ in zip(located, xrange(limit + 1))]
+        else:
+            located = list(located)
+        more = bool(limit) and len(located) > limit
+        located = located[:limit] if limit else located
+        if newer:
+            located.reverse()
+            return located, more, True
+        return located, seq is not None, more
+
+    def get_range(self, type_key=None, marker=None, limit=None,
+                  direction='older'):
+        """Fetches a keyset page, see yagi.persistence.Driver.get_range."""
+        located, has_newer, has_older = self._range(type_key, marker, limit,
+                                                    direction)
+        return self._entities(located), has_newer, has_older
+
+    def get_range_ids(self, type_key=None, marker=None, limit=None,
+                      direction='older'):
+        located, has_newer, has_older = self._range(type_key, marker, limit,
+                                                    direction)
+        ids = [segment.read(segment.offsets([n])[0])[0]
+               for segment, n in located]
+        return ids, has_newer, has_older
+
+    def get_page(self, type_key=None, page_size=None, page=-1):
+        """Fetches a numbered page, counting up from the oldest entries."""
+        segments = self.refresh()
+        length = sum(len(s.records(type_key)) for s in segments)
+        maxpage = self.pages(page_size, length) - 1
+        if page < 0:
+            page = maxpage + 1 + page
+        if page < 0 or page > maxpage:
+            raise IndexError("Invalid page")
+        start, stop = 0, length
+        if page_size:
+            start, stop = page * page_size, min((page + 1) * page_size,
+                                                length)
+        located = []
+        for segment in segments:
+            records = segment.records(type_key)
+            if start < len(records) and stop > 0:
+                located.extend((segment, records[k]) for k in
+                               xrange(max(start, 0), min(stop, len(records))))
+            start -= len(records)
+            stop -= len(records)
+        located.reverse()
+        return self._entities(located), page, maxpage
+
+    def get_all(self, page_size=None, page=-1):
+        return self.get_page(None, page_size, page)[0]
+
+    def get_all_of_type(self, key, page_size=None, page=-1):
+        return self.get_page(key, page_size, page)[0]
@@ -1,9 +1,14 @@
 import json
+import os
+import threading
+import time
 
 import redis
 
 import yagi.config
+import yagi.log
 import yagi.persistence
+import yagi.persistence.codec
 from yagi.persistence import InvalidEntityUUID
 
 with yagi.config.defaults_for('persistence') as default:
@@ -11,69 +16,306 @@ with yagi.config.defaults_for('persistence') as default:
     default('port', 6379)
     default('entry_ttl', 60 * 60 * 24 * 30)
     default('password', '')
+    default('sweep_interval', 60)
+    default('max_connections', 0)
+    default('pool_timeout', 20)
+
+LOG = yagi.log.logger
+
+_pools = {}
+
+
+def connection_pool(host, port, password, max_connections=0, timeout=20):
+    """The connection pool every driver in this process shares.
+
+    With max_connections set, callers wait up to timeout seconds for a
+    connection rather than opening more. Under eventlet only the green
+    thread waiting is blocked. A forked child never uses the connections
+    of its parent, it gets a pool of its own.
+    """
+    key = (os.getpid(), host, port, password)
+    pool = _pools.get(key)
+    if pool is None:
+        if max_connections:
+            pool = redis.BlockingConnectionPool(
+                host=host, port=port, password=password,
+                max_connections=max_connections, timeout=timeout)
+        else:
+            pool = redis.ConnectionPool(host=host, port=port,
+                                        password=password)
+        _pools[key] = pool
+    return pool
+
+
+def _trim_page(page, page_size, length, uuids, pages):
+    """Works out which page was fetched, given the length of the index.
+
+    The newest page (-1) is fetched as a full page from the head of the
+    index, and trimmed here, since it is the only partial one.
+    """
+    maxpage = pages(page_size, length) - 1
+    this_page = page
+    if page < 0:
+        this_page = maxpage
+        if page_size:
+            uuids = uuids[:length - maxpage * page_size]
+    if this_page < 0 or this_page > maxpage:
+        raise IndexError("Invalid page")
+    return uuids, this_page, maxpage
 
 
 class Driver(yagi.persistence.Driver):
+    # Bumped on every change to the indexes, see version()
+    VERSION = 'feed:version'
+    # Whether to look for entries stored as separate content and event_type
+    # keys, and clean up after the ones that have expired.
+    LEGACY_KEYS = True
+
     def __init__(self):
         conf = yagi.config.config_with('persistence')
         host = conf('host')
         port = int(conf('port', default=6379))
         password = conf('password')
         self.ttl = int(conf('entry_ttl'))
-        self.client = redis.Redis(host=host, password=password, port=port)
+        pool = connection_pool(host, port, password,
+                               int(conf('max_connections') or 0),
+                               float(conf('pool_timeout') or 20))
+        self.client = redis.Redis(connection_pool=pool)
+        self.codec = yagi.persistence.codec.from_config()
         super(yagi.persistence.Driver, self).__init__()
 
     def create(self, key, entity_uuid, value):
-        if self.ttl <= 0:
-            self.client.set('entry:%s:content' % entity_uuid,
-                            json.dumps(value))
+        self.create_many([(key, entity_uuid, value)])
+
+    def create_many(self, entities, fragments=None):
+        """Writes the whole batch in a single MULTI/EXEC round trip."""
+        if not entities:
+            return
+        pipe = self.client.pipeline()
+        uuids = []
+        by_type = {}
+        types = []
+        for i, (key, entity_uuid, value) in enumerate(entities):
+            # The separate event_type key outlives the entry, so an expired
+            # entry can still be cleaned out of its index.
+            self._write_entry(pipe, key, entity_uuid, value,
+                              fragment=fragments[i] if fragments else None)
+            pipe.set('entry:%s:event_type' % entity_uuid, key)
+            if key not in by_type:
+                by_type[key] = []
+                types.append(key)
+            by_type[key].append(entity_uuid)
+            uuids.append(entity_uuid)
+        # LPUSH with several values pushes them in order, same as one LPUSH
+        # per entity would.
+        for key in types:
+            pipe.lpush('type:%s' % key, *by_type[key])
+        pipe.lpush('entries', *uuids)
+        pipe.incr(self.VERSION)
+        pipe.execute()
+
+    def _write_entry(self, pipe, key, entity_uuid, value, ttl=None,
+                     fragment=None):
+        # The event type, and the pre-rendered fragment if there is one, are
+        # kept next to the content so a read is a single GET.
+        ttl = self.ttl if ttl is None else ttl
+        doc = dict(event_type=key, content=value)
+        if fragment is not None:
+            doc['fragment_sig'], doc['fragment'] = fragment
+        doc = self.codec.encode(doc)
+        if ttl <= 0:
+            pipe.set('entry:%s' % entity_uuid, doc)
         else:
-            self.client.setex('entry:%s:content' % entity_uuid,
-                              json.dumps(value),
-                              self.ttl)
-        self.client.set('entry:%s:event_type' % entity_uuid, key)
-        self.client.lpush('type:%s' % key, entity_uuid)
-        self.client.lpush('entries', entity_uuid)
+            pipe.setex('entry:%s' % entity_uuid, doc, ttl)
 
     def _clean(self, uuid):
         event_type = self.client.get('entry:%s:event_type' % uuid)
         self.client.lrem('type:%s' % event_type, uuid, 1)
         self.client.lrem('entries', uuid, 1)
         self.client.delete('entry:%s:event_type' % uuid)
+        self.client.incr(self.VERSION)
+
+    def _get_many(self, uuids):
+        """Returns the entities found for uuids, and whether any were not.
+
+        Entries missing from the store are cleaned out of the indexes.
+        """
+        if not uuids:
+            return [], False
+        docs = self.client.mget(['entry:%s' % uuid for uuid in uuids])
+        # Entries written before content and event type were stored
+        # together only cost an extra round trip while they last.
+        legacy = []
+        if self.LEGACY_KEYS:
+            legacy = [uuid for uuid, doc in zip(uuids, docs) if doc is None]
+        legacy_docs = {}
+        if legacy:
+            keys = []
+            for uuid in legacy:
+                keys.append('entry:%s:content' % uuid)
+                keys.append('entry:%s:event_type' % uuid)
+            values = self.client.mget(keys)
+            for i, uuid in enumerate(legacy):
+                legacy_docs[uuid] = (values[2 * i], values[2 * i + 1])
+        entities = []
+        missing = False
+        for uuid, doc in zip(uuids, docs):
+            if doc is not None:
+                doc = self.codec.decode(doc)
+                entity = {'id': uuid, 'content': doc['content'],
+                          'event_type': doc['event_type']}
+                if 'fragment' in doc:
+                    entity['fragment'] = doc['fragment']
+                    entity['fragment_sig'] = doc['fragment_sig']
+                entities.append(entity)
+                continue
+            elif not self.LEGACY_KEYS:
+                missing = True
+                continue
+            else:
+                content, event_type = legacy_docs[uuid]
+                if not content:
+                    self._clean(uuid)
+                    missing = True
+                    continue
+                content = json.loads(content)
+            entities.append({'id': uuid, 'content': content,
+                             'event_type': event_type})
+        return entities, missing
+
+    def get_many(self, entity_uuids):
+        return self._get_many(entity_uuids)[0]
+
+    def _oldest_ids(self, offset, count):
+        """The count entries after the offset oldest, oldest first."""
+        uuids = self.client.lrange('entries', -(offset + count),
+                                   -(offset + 1))
+        uuids.reverse()
+        return uuids
+
+    def recode(self, batch_size=1000):
+        """Rewrites stored entries in the configured codec.
+
+        Entries keep what is left of their TTL. Safe to run while events
+        are being written, since it works from the oldest entry forward.
+        Returns how many entries there were, and their total size in bytes
+        before and after, to judge the saving by.
+        """
+        entries = before = after = 0
+        offset = 0
+        while True:
+            uuids = self._oldest_ids(offset, batch_size)
+            if not uuids:
+                break
+            offset += len(uuids)
+            keys = ['entry:%s' % uuid for uuid in uuids]
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(key)
+                pipe.ttl(key)
+            results = pipe.execute()
+            pipe = self.client.pipeline(transaction=False)
+            for i, key in enumerate(keys):
+                value, ttl = results[2 * i], results[2 * i + 1]
+                if value is None:
+                    continue
+                recoded = self.codec.encode(self.codec.decode(value))
+                entries += 1
+                before += len(value)
+                after += len(recoded)
+                if recoded == value:
+                    continue
+                if ttl is not None and ttl > 0:
+                    pipe.setex(key, recoded, ttl)
+                else:
+                    pipe.set(key, recoded)
+            pipe.execute()
+        return entries, before, after
 
     def _get(self, entity_uuid):
-        content = self.client.get('entry:%s:content' % entity_uuid)
-        if not content:
-            self._clean(entity_uuid)
+        entities = self.get_many([entity_uuid])
+        if not entities:
             raise InvalidEntityUUID("Invalid event uuid: %s" % entity_uuid)
-        event_type = self.client.get('entry:%s:event_type' % entity_uuid)
-        return {'id': entity_uuid, 'content': json.loads(content),
-                'event_type': event_type}
+        return entities[0]
 
     def get(self, key, entity_uuid):
         """key is no longer used."""
         return [self._get(entity_uuid)]
 
-    def _get_all(self, index_name, page_size=None, page=-1):
+    def get_page(self, type_key=None, page_size=None, page=-1):
+        """Fetches a page in two round trips.
+
+        The first gets the length of the index and the page's slice of it
+        in one transaction, the second gets every entry on the page.
+        """
+        index_name = 'type:%s' % type_key if type_key else 'entries'
+        if page < -1:
+            page = self.pages(page_size, self.client.llen(index_name)) + page
         while True:
-            bad_uuids = False
-            entities = []
-            length = self.client.llen(index_name)
-            start, end = self._page(page, page_size, length)
-            uuids = self.client.lrange(index_name, start, end)
-            for uuid in uuids:
-                try:
-                    entities.append(self._get(uuid))
-                except InvalidEntityUUID:
-                    bad_uuids = True
-            if not bad_uuids:
-                return entities
+            pipe = self.client.pipeline()
+            pipe.llen(index_name)
+            start, end = self._page_slice(page, page_size)
+            pipe.lrange(index_name, start, end)
+            length, uuids = pipe.execute()
+            uuids, this_page, maxpage = _trim_page(page, page_size, length,
+                                                   uuids, self.pages)
+            entities, missing = self._get_many(uuids)
+            if not missing:
+                return entities, this_page, maxpage
+
+    def get_range(self, type_key=None, marker=None, limit=None,
+                  direction='older'):
+        """Fetches a keyset page, see yagi.persistence.Driver.get_range.
+
+        A list can't be searched for the marker, so this reads all of the
+        index's uuids, though only the entries on the page. Use the
+        SortedSetDriver for large feeds.
+        """
+        while True:
+            uuids, has_newer, has_older = self.get_range_ids(
+                type_key, marker, limit, direction)
+            entities, missing = self._get_many(uuids)
+            if not missing:
+                return entities, has_newer, has_older
+
+    def get_range_ids(self, type_key=None, marker=None, limit=None,
+                      direction='older'):
+        index_name = 'type:%s' % type_key if type_key else 'entries'
+        if marker is None and limit:
+            uuids = self.client.lrange(index_name, 0, limit)
+        else:
+            uuids = self.client.lrange(index_name, 0, -1)
+        start, end, has_newer, has_older = yagi.persistence.keyset_slice(
+            uuids, marker, limit, direction)
+        return uuids[start:end], has_newer, has_older
+
+    def _page_slice(self, page, pagesize):
+        """Returns the LRANGE indexes of a page, without knowing the length.
+
+        It may seem odd to have paging logic in the persistence drivers, but
+        it differs depending on the store (i.e. a relational db would have to
+        calculate offset and limit args, which are different than Redis's list
+        indexes.)
+
+        Page 0 holds the oldest entries, at the tail of the list, so a page
+        counted from there is always the same slice from the tail. The
+        newest page, -1, has at most pagesize entries from the head, which
+        get_page trims once it knows the length.
+        """
+        if not pagesize:
+            return (0, -1)
+        if page < 0:
+            return (0, pagesize - 1)
+        return (-(page + 1) * pagesize, -(page * pagesize) - 1)
 
     def get_all(self, page_size=None, page=-1):
-        return self._get_all('entries', page_size, page)
+        return self.get_page(None, page_size, page)[0]
 
     def get_all_of_type(self, key, page_size=None, page=-1):
-        return self._get_all('type:%s' % key, page_size, page)
+        return self.get_page(key, page_size, page)[0]
+
+    def version(self):
+        return self.client.get(self.VERSION)
 
     def count(self, type_key=None):
         if not type_key:
@@ -81,19 +323,240 @@ class Driver(yagi.persistence.Driver):
         else:
             return self.client.llen('type:%s' % type_key)
 
-    def _page(self, page, pagesize, length):
-        """ It may seem odd to have paging logic in the persistance drivers
-        here, but this logic differs depending on the persistance store (i.e.
-        a relational db would have to calculate offset and limit args, which
-        are different than Redis's list indexes.) """
-        if not pagesize:
-            return (0, -1)
-        pages = self.pages(pagesize, length)
-        if page < 0:
-            page = pages - (page * -1)
-        if page < 0 or page >= pages:
-            raise IndexError("Invalid page")
-        end = (length - (page * pagesize)) - 1
-        start = (end - pagesize) + 1
-        start = start if start > 0 else 0
-        return (start, end)
+
+class SortedSetDriver(Driver):
+    """Stores the indexes as sorted sets scored by the time of the write.
+
+    Expired entries are dropped from the indexes by a background sweeper,
+    with a ZREMRANGEBYSCORE per index, so reads never have to clean up
+    and the indexes stay about as big as entry_ttl allows. Entries that
+    expired since the last sweep are just left off the page they're on.
+    Pages are ranges of rank, which ZRANGE finds in O(log N).
+
+    Use bin/yagi-migrate to move the data over from the list layout.
+    """
+
+    LEGACY_KEYS = False
+    ENTRIES = 'v2:entries'
+    TYPES = 'v2:types'
+
+    def __init__(self):
+        super(SortedSetDriver, self).__init__()
+        conf = yagi.config.config_with('persistence')
+        self.sweep_interval = float(conf('sweep_interval'))
+        self.sweeper = None
+        self.last_score = 0
+
+    def _index(self, type_key=None):
+        if type_key:
+            return 'v2:type:%s' % type_key
+        return self.ENTRIES
+
+    def _score(self, now):
+        # Scores must keep increasing within a batch, or entries written at
+        # the same moment would be ordered by uuid.
+        self.last_score = max(now, self.last_score + 0.000001)
+        return self.last_score
+
+    def create_many(self, entities, fragments=None):
+        """Writes the whole batch in a single MULTI/EXEC round trip."""
+        if not entities:
+            return
+        now = time.time()
+        pipe = self.client.pipeline()
+        scored = []
+        by_type = {}
+        for i, (key, entity_uuid, value) in enumerate(entities):
+            self._write_entry(pipe, key, entity_uuid, value,
+                              fragment=fragments[i] if fragments else None)
+            score = self._score(now)
+            scored.extend((entity_uuid, score))
+            by_type.setdefault(key, []).extend((entity_uuid, score))
+        pipe.sadd(self.TYPES, *by_type.keys())
+        for key, type_scored in by_type.iteritems():
+            pipe.zadd(self._index(key), *type_scored)
+        pipe.zadd(self.ENTRIES, *scored)
+        pipe.incr(self.VERSION)
+        pipe.execute()
+        self.start_sweeper()
+
+    def count(self, type_key=None):
+        return self.client.zcard(self._index(type_key))
+
+    def _oldest_ids(self, offset, count):
+        return self.client.zrange(self.ENTRIES, offset, offset + count - 1)
+
+    def get_page(self, type_key=None, page_size=None, page=-1):
+        """Fetches a page in two round trips, like Driver.get_page."""
+        index_name = self._index(type_key)
+        if page < -1:
+            page = self.pages(page_size, self.client.zcard(index_name)) + page
+        pipe = self.client.pipeline()
+        pipe.zcard(index_name)
+        if not page_size:
+            pipe.zrevrange(index_name, 0, -1)
+        elif page < 0:
+            pipe.zrevrange(index_name, 0, page_size - 1)
+        else:
+            # Page 0 holds the oldest entries, so counts up by rank.
+            pipe.zrange(index_name, page * page_size,
+                        (page + 1) * page_size - 1)
+        length, uuids = pipe.execute()
+        if page_size and page >= 0:
+            uuids.reverse()
+        uuids, this_page, maxpage = _trim_page(page, page_size, length,
+                                               uuids, self.pages)
+        return self.get_many(uuids), this_page, maxpage
+
+    def get_range(self, type_key=None, marker=None, limit=None,
+                  direction='older'):
+        """Fetches a keyset page, see yagi.persistence.Driver.get_range.
+
+        The marker is found by its score, and the page is a score range
+        from there, so this takes O(log N) no matter how deep the page is.
+        """
+        uuids, has_newer, has_older = self.get_range_ids(type_key, marker,
+                                                         limit, direction)
+        return self.get_many(uuids), has_newer, has_older
+
+    def _more(self, limit, found):
+        """Limits a range to one more than the page still holds."""
+        if not limit:
+            return {}
+        return dict(start=0, num=limit + 1 - len(found))
+
+    def get_range_ids(self, type_key=None, marker=None, limit=None,
+                      direction='older'):
+        index_name = self._index(type_key)
+        if marker is None:
+            uuids = self.client.zrevrange(index_name, 0,
+                                          limit if limit else -1)
+            has_older = bool(limit) and len(uuids) > limit
+            return uuids[:limit], False, has_older
+        score = self.client.zscore(index_name, marker)
+        if score is None:
+            raise InvalidEntityUUID("Invalid marker: %s" % marker)
+        # Redis orders members with the same score by member, so entries
+        # stored in the same instant as the marker are either side of it
+        # in that order, rather than all skipped by an exclusive bound.
+        ties = self.client.zrangebyscore(index_name, repr(score), repr(score))
+        bound = '(%r' % score
+        if direction == 'newer':
+            uuids = [m for m in ties if m > marker]
+            if not limit or len(uuids) <= limit:
+                uuids += self.client.zrangebyscore(index_name, bound, '+inf',
+                                                   **self._more(limit, uuids))
+            has_newer = bool(limit) and len(uuids) > limit
+            uuids = uuids[:limit] if limit else uuids
+            uuids.reverse()
+            return uuids, has_newer, True
+        uuids = [m for m in reversed(ties) if m < marker]
+        if not limit or len(uuids) <= limit:
+            uuids += self.client.zrevrangebyscore(index_name, bound, '-inf',
+                                                  **self._more(limit, uuids))
+        has_older = bool(limit) and len(uuids) > limit
+        return (uuids[:limit] if limit else uuids), True, has_older
+
+    def sweep(self, now=None):
+        """Drops everything older than entry_ttl from the indexes.
+
+        Returns how many entries were dropped from the main index.
+        """
+        if self.ttl <= 0:
+            return 0
+        cutoff = (now or time.time()) - self.ttl
+        types = self.client.smembers(self.TYPES)
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(self.ENTRIES, '-inf', cutoff)
+        for key in types:
+            pipe.zremrangebyscore(self._index(key), '-inf', cutoff)
+        removed = pipe.execute()[0]
+        if removed:
+            self.client.incr(self.VERSION)
+            LOG.debug("Swept %d expired entries" % removed)
+        return removed
+
+    def start_sweeper(self):
+        if self.sweeper is not None or self.ttl <= 0:
+            return
+        self.sweeper = threading.Thread(target=self._sweep_loop,
+                                        name="yagi-redis-sweeper")
+        self.sweeper.daemon = True
+        self.sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception, e:
+                LOG.exception(e)
+
+
+def migrate_to_sorted_sets(batch_size=1000):
+    """Copies the list layout's indexes into SortedSetDriver's layout.
+
+    Walks the entries list from the oldest end, so entries keep their
+    order, and scores each entry by when it was written, judging by its
+    remaining TTL. Entries still in the old two key format are rewritten
+    as a single document. The old lists and event_type keys are deleted
+    once everything has been copied, so writers using the list layout
+    should be stopped first.
+
+    Returns the number of entries migrated.
+    """
+    old = Driver()
+    new = SortedSetDriver()
+    client = old.client
+    migrated = 0
+    offset = 0
+    while True:
+        # Dead uuids get cleaned out of the list as we read, so the slice
+        # is taken from the tail and only moves by what was migrated.
+        uuids = client.lrange('entries', -(offset + batch_size),
+                              -(offset + 1))
+        if not uuids:
+            break
+        uuids.reverse()
+        entities, missing = old._get_many(uuids)
+        if missing:
+            continue
+        pipe = client.pipeline(transaction=False)
+        for entity in entities:
+            pipe.ttl('entry:%s' % entity['id'])
+            pipe.ttl('entry:%s:content' % entity['id'])
+        ttls = pipe.execute()
+        now = time.time()
+        pipe = client.pipeline()
+        for i, entity in enumerate(entities):
+            fragment = None
+            if 'fragment' in entity:
+                fragment = (entity['fragment_sig'], entity['fragment'])
+            # No TTL comes back as None or a negative number, depending
+            # on the versions of redis and redis-py.
+            remaining = max(ttls[2 * i], ttls[2 * i + 1])
+            written = now
+            ttl = 0
+            if old.ttl > 0 and remaining is not None and remaining > 0:
+                written = now - (old.ttl - remaining)
+                # Keep the document around for as long as it had left.
+                ttl = remaining
+            new._write_entry(pipe, entity['event_type'], entity['id'],
+                             entity['content'], ttl=ttl, fragment=fragment)
+            score = max(written, new.last_score + 0.000001)
+            new.last_score = score
+            pipe.sadd(new.TYPES, entity['event_type'])
+            pipe.zadd(new._index(entity['event_type']), entity['id'], score)
+            pipe.zadd(new.ENTRIES, entity['id'], score)
+            pipe.delete('entry:%s:content' % entity['id'])
+            pipe.delete('entry:%s:event_type' % entity['id'])
+        pipe.execute()
+        migrated += len(entities)
+        offset += len(uuids)
+    pipe = client.pipeline()
+    pipe.delete('entries')
+    for key in client.keys('type:*'):
+        pipe.delete(key)
+    pipe.incr(Driver.VERSION)
+    pipe.execute()
+    return migrated
@@ -0,0 +1,281 @@
+import sqlite3
+import threading
+import time
+
+import yagi.config
+import yagi.log
+import yagi.persistence
+import yagi.persistence.codec
+from yagi.persistence import InvalidEntityUUID
+
+with yagi.config.defaults_for('persistence') as default:
+    default('database', 'yagi.sqlite')
+    default('entry_ttl', 60 * 60 * 24 * 30)
+    default('sweep_interval', 60)
+    default('busy_timeout', 30)
+
+LOG = yagi.log.logger
+
+# seq orders the entries. Being the rowid, it is also in every index, but
+# is listed so (event_type, seq, uuid) reads as what it is: a covering
+# index for paging through a single event type.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    uuid TEXT NOT NULL UNIQUE,
+    event_type TEXT NOT NULL,
+    created REAL NOT NULL,
+    doc BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_type_seq
+    ON entries (event_type, seq, uuid);
+CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('version', 0);
+"""
+
+# SQLite's default limit on the number of parameters in a statement.
+MAX_PARAMS = 999
+
+
+class Driver(yagi.persistence.Driver):
+    """Keeps entries in an SQLite database, for retention beyond RAM.
+
+    The database runs in WAL mode, so the feed reads while the event
+    worker writes. Both open the same file, no server is needed. Entries
+    are ordered by an autoincrementing seq, which keyset pages are ranges
+    of, so a page takes an index seek however deep it is. Entries older
+    than entry_ttl are deleted every sweep_interval seconds by whichever
+    process writes.
+    """
+
+    def __init__(self):
+        conf = yagi.config.config_with('persistence')
+        self.ttl = int(conf('entry_ttl'))
+        self.sweep_interval = float(conf('sweep_interval'))
+        self.codec = yagi.persistence.codec.from_config()
+        # One connection, shared by the threads (or green threads) of a
+        # process, one statement at a time.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(conf('database'),
+                                    timeout=float(conf('busy_timeout')),
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        self.last_sweep = time.time()
+        super(yagi.persistence.Driver, self).__init__()
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _entity(self, uuid, event_type, doc):
+        doc = self.codec.decode(str(doc))
+        entity = {'id': uuid, 'content': doc['content'],
+                  'event_type': event_type}
+        if 'fragment' in doc:
+            entity['fragment'] = doc['fragment']
+            entity['fragment_sig'] = doc['fragment_sig']
+        return entity
+
+    def create(self, key, entity_uuid, value):
+        self.create_many([(key, entity_uuid, value)])
+
+    def create_many(self, entities, fragments=None):
+        """Inserts the whole batch in one transaction.
+
+        An entity that is already stored, e.g. a redelivered message, is
+        left as it is.
+        """
+        if not entities:
+            return
+        now = time.time()
+        rows = []
+        for i, (key, entity_uuid, value) in enumerate(entities):
+            doc = dict(content=value)
+            if fragments:
+                doc['fragment_sig'], doc['fragment'] = fragments[i]
+            rows.append((entity_uuid, key, now,
+                         sqlite3.Binary(self.codec.encode(doc))))
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO entries '
+                    '(uuid, event_type, created, doc) VALUES (?, ?, ?, ?)',
+                    rows)
+                self._bump_version()
+        if (self.sweep_interval and
+                now - self.last_sweep >= self.sweep_interval):
+            self.sweep(now)
+
+    def _bump_version(self):
+        self.conn.execute("UPDATE meta SET value = value + 1 "
+                          "WHERE name = 'version'")
+
+    def sweep(self, now=None):
+        """Deletes everything older than entry_ttl.
+
+        Returns how many entries were deleted.
+        """
+        self.last_sweep = now or time.time()
+        if self.ttl <= 0:
+            return 0
+        with self.lock:
+            with self.conn:
+                removed = self.conn.execute(
+                    'DELETE FROM entries WHERE created < ?',
+                    (self.last_sweep - self.ttl,)).rowcount
+                if removed:
+                    self._bump_version()
+        if removed:
+            LOG.debug("Swept %d expired entries" % removed)
+        return removed
+
+    def get_many(self, entity_uuids):
+        found = {}
+        for i in xrange(0, len(entity_uuids), MAX_PARAMS):
+            chunk = entity_uuids[i:i + MAX_PARAMS]
+            rows = self._query('SELECT uuid, event_type, doc FROM entries '
+                               'WHERE uuid IN (%s)' %
+                               ', '.join('?' * len(chunk)), chunk)
+            for row in rows:
+                found[row[0]] = self._entity(*row)
+        return [found[uuid] for uuid in entity_uuids if uuid in found]
+
+    def get(self, key, entity_uuid):
+        """key is not used."""
+        entities = self.get_many([entity_uuid])
+        if not entities:
+            raise InvalidEntityUUID("Invalid event uuid: %s" % entity_uuid)
+        return entities
+
+    def _where(self, type_key, *clauses):
+        clauses = list(clauses)
+        params = []
+        if type_key:
+            clauses.insert(0, 'event_type = ?')
+            params.append(type_key)
+        if not clauses:
+            return '', params
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+    def count(self, type_key=None):
+        where, params = self._where(type_key)
+        return self._query('SELECT COUNT(*) FROM entries' + where,
+                           params)[0][0]
+
+    def get_page(self, type_key=None, page_size=None, page=-1):
+        """Fetches a numbered page, counting up from the oldest entries.
+
+        Numbered pages need an OFFSET, so deep pages get slower. The feed
+        uses keyset pages, see get_range, unless asked for a page number.
+        """
+        length = self.count(type_key)
+        maxpage = self.pages(page_size, length) - 1
+        if page < 0:
+            page = maxpage + 1 + page
+        if page < 0 or page > maxpage:
+            raise IndexError("Invalid page")
+        where, params = self._where(type_key)
+        sql = 'SELECT uuid, event_type, doc FROM entries' + where
+        if page_size:
+            sql += ' ORDER BY seq LIMIT ? OFFSET ?'
+            params.extend((page_size, page * page_size))
+        else:
+            sql += ' ORDER BY seq'
+        rows = self._query(sql, params)
+        rows.reverse()
+        return [self._entity(*row) for row in rows], page, maxpage
+
+    def get_all(self, page_size=None, page=-1):
+        return self.get_page(None, page_size, page)[0]
+
+    def get_all_of_type(self, key, page_size=None, page=-1):
+        return self.get_page(key, page_size, page)[0]
+
+    def _range(self, columns, type_key, marker, limit, direction):
+        """Selects the rows on a keyset page, newest first.
+
+        Returns (rows, has_newer, has_older).
+        """
+        clauses = []
+        params = []
+        order = 'DESC'
+        if marker is not None:
+            where, marker_params = self._where(type_key, 'uuid = ?')
+            found = self._query('SELECT seq FROM entries' + where,
+                                marker_params + [marker])
+            if not found:
+                raise InvalidEntityUUID("Invalid marker: %s" % marker)
+            if direction == 'newer':
+                clauses.append('seq > ?')
+                order = 'ASC'
+            else:
+                clauses.append('seq < ?')
+            params.append(found[0][0])
+        where, type_params = self._where(type_key, *clauses)
+        sql = 'SELECT %s FROM entries%s ORDER BY seq %s' % (columns, where,
+                                                            order)
+        params = type_params + params
+        if limit:
+            # One more than the page holds, to tell if there is another.
+            sql += ' LIMIT ?'
+            params.append(limit + 1)
+        rows = self._query(sql, params)
+        more = bool(limit) and len(rows) > limit
+        rows = rows[:limit] if limit else rows
+        if order == 'ASC':
+            rows.reverse()
+            return rows, more, True
+        return rows, marker is not None, more
+
+    def get_range(self, type_key=None, marker=None, limit=None,
+                  direction='older'):
+        """Fetches a keyset page, see yagi.persistence.Driver.get_range."""
+        rows, has_newer, has_older = self._range('uuid, event_type, doc',
+                                                 type_key, marker, limit,
+                                                 direction)
+        return [self._entity(*row) for row in rows], has_newer, has_older
+
+    def get_range_ids(self, type_key=None, marker=None, limit=None,
+                      direction='older'):
+        rows, has_newer, has_older = self._range('uuid', type_key, marker,
+                                                 limit, direction)
+        return [row[0] for row in rows], has_newer, has_older
+
+    def version(self):
+        return self._query("SELECT value FROM meta "
+                           "WHERE name = 'version'")[0][0]
+
+    def recode(self, batch_size=1000):
+        """Rewrites stored entries in the configured codec.
+
+        Returns how many entries there were, and their total size in bytes
+        before and after.
+        """
+        entries = before = after = 0
+        seq = 0
+        while True:
+            rows = self._query('SELECT seq, doc FROM entries WHERE seq > ? '
+                               'ORDER BY seq LIMIT ?', (seq, batch_size))
+            if not rows:
+                break
+            updates = []
+            for seq, doc in rows:
+                doc = str(doc)
+                recoded = self.codec.encode(self.codec.decode(doc))
+                entries += 1
+                before += len(doc)
+                after += len(recoded)
+                if recoded != doc:
+                    updates.append((sqlite3.Binary(recoded), seq))
+            with self.lock:
+                with self.conn:
+                    self.conn.executemany('UPDATE entries SET doc = ? '
+                                          'WHERE seq = ?', updates)
+        return entries, before, after
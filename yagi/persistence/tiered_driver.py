@@ -0,0 +1,451 @@
+"""Keeps recent entries in redis and older ones in archive files.
+
+New entries go to a hot tier in redis, laid out like the
+SortedSetDriver's. Once more than hot_entries entries are stored, or
+there are entries older than hot_seconds, the oldest are rolled out of
+redis a full page (archive_page_size entries) at a time into an archive
+file in archive_dir. Reads fall through to the archives for anything no
+longer hot, so redis only ever holds the hot window, however long
+entry_ttl is.
+
+An archive is a gzipped JSON list of a page's entities, oldest first,
+named after the number of its first entry, and never changes once
+written. Alongside it is a small index holding each entry's uuid and
+event type. A reader keeps only uuid hashes and per type positions of
+it in memory, and reads the uuids themselves from it for id-only pages
+and to confirm lookups, without decompressing the archive. Whole archives
+are deleted once everything in them is older than entry_ttl.
+"""
+
+import array
+import bisect
+import collections
+import contextlib
+import fcntl
+import gzip
+import json
+import os
+import threading
+import time
+
+import yagi.config
+import yagi.log
+import yagi.persistence
+import yagi.persistence.redis_driver
+from yagi.persistence import InvalidEntityUUID
+
+with yagi.config.defaults_for('persistence') as default:
+    default('archive_dir', 'yagi_archive')
+    default('archive_page_size', 1000)
+    default('hot_entries', 0)
+    default('hot_seconds', 60 * 60 * 6)
+    default('archive_interval', 60)
+    default('archive_cache_size', 8)
+
+LOG = yagi.log.logger
+
+SUFFIX = '.json.gz'
+INDEX_SUFFIX = '.idx'
+
+
+class HotTier(yagi.persistence.redis_driver.SortedSetDriver):
+    """The redis tier. Entries stay until archived, so have no TTL."""
+
+    def __init__(self):
+        super(HotTier, self).__init__()
+        self.ttl = 0
+
+    def oldest_ids(self, type_key, count):
+        """The count oldest uuids, oldest first."""
+        return self.client.zrange(self._index(type_key), 0, count - 1)
+
+    def rank_ids(self, type_key, start, stop):
+        """The uuids from rank start to stop, oldest first."""
+        if stop <= start:
+            return []
+        return self.client.zrange(self._index(type_key), start, stop - 1)
+
+
+class Archive(object):
+    """What a reader keeps in memory about one archive file."""
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.index_path = path[:-len(SUFFIX)] + INDEX_SUFFIX
+        index = self.index()
+        self.count = len(index['ids'])
+        self.newest = index['newest']
+        # Hash of uuid to position, or to a list of them in the rare case
+        # two uuids hash the same.
+        self.ids = {}
+        for i, uuid in enumerate(index['ids']):
+            key = hash(str(uuid))
+            found = self.ids.get(key)
+            if found is None:
+                self.ids[key] = i
+            elif isinstance(found, list):
+                found.append(i)
+            else:
+                self.ids[key] = [found, i]
+        self.types = {}
+        for i, event_type in enumerate(index['types']):
+            event_type = str(event_type)
+            if event_type not in self.types:
+                self.types[event_type] = array.array('I')
+            self.types[event_type].append(i)
+
+    def index(self):
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def uuids(self):
+        return [str(uuid) for uuid in self.index()['ids']]
+
+    def records(self, type_key=None):
+        if type_key:
+            return self.types.get(type_key, ())
+        return xrange(self.count)
+
+    def holds(self, i, type_key):
+        """Whether the entry at position i is of type type_key."""
+        records = self.records(type_key)
+        k = bisect.bisect_left(records, i)
+        return k < len(records) and records[k] == i
+
+
+def _load_page(archive):
+    with contextlib.closing(gzip.open(archive.path)) as f:
+        return json.load(f)
+
+
+class Driver(yagi.persistence.Driver):
+    """Redis for the hot window, archive files for the rest."""
+
+    def __init__(self):
+        conf = yagi.config.config_with('persistence')
+        self.hot = HotTier()
+        self.archive_dir = conf('archive_dir')
+        self.page_size = int(conf('archive_page_size'))
+        self.hot_entries = int(conf('hot_entries'))
+        self.hot_seconds = float(conf('hot_seconds'))
+        self.ttl = int(conf('entry_ttl'))
+        self.archive_interval = float(conf('archive_interval'))
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        self.lock = threading.RLock()
+        self.archives = []
+        self.archives_version = None
+        self.page_cache = collections.OrderedDict()
+        self.uuid_cache = collections.OrderedDict()
+        self.cache_size = int(conf('archive_cache_size'))
+        self.last_archive = 0
+        super(yagi.persistence.Driver, self).__init__()
+
+    def _path(self, base):
+        return os.path.join(self.archive_dir, '%020d%s' % (base, SUFFIX))
+
+    def _refresh(self, version=None):
+        """Picks up archives written or deleted since the version changed."""
+        if version is None:
+            version = self.hot.version()
+        with self.lock:
+            if version is not None and version == self.archives_version:
+                return self.archives
+            bases = sorted(int(name[:-len(SUFFIX)])
+                           for name in os.listdir(self.archive_dir)
+                           if name.endswith(SUFFIX))
+            known = dict((a.base, a) for a in self.archives)
+            self.archives = [known.get(base) or Archive(self._path(base),
+                                                        base)
+                             for base in bases]
+            self.archives_version = version
+            return self.archives
+
+    def _cached(self, cache, archive, load):
+        """What load gives for an archive, from a small LRU of them."""
+        with self.lock:
+            value = cache.pop(archive.base, None)
+            if value is None:
+                value = load(archive)
+            cache[archive.base] = value
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+            return value
+
+    def _page(self, archive):
+        """An archive's entities, decompressed."""
+        return self._cached(self.page_cache, archive, _load_page)
+
+    def _uuids(self, archive):
+        """An archive's uuids, from its index."""
+        return self._cached(self.uuid_cache, archive, Archive.uuids)
+
+    def _read(self, located):
+        return [self._page(archive)[i] for archive, i in located]
+
+    def _read_ids(self, located):
+        return [self._uuids(archive)[i] for archive, i in located]
+
+    def _find(self, archives, entity_uuid, type_key=None):
+        key = hash(str(entity_uuid))
+        for archive in reversed(archives):
+            found = archive.ids.get(key)
+            if found is None:
+                continue
+            if not isinstance(found, list):
+                found = [found]
+            for i in found:
+                if self._uuids(archive)[i] != entity_uuid:
+                    continue
+                if type_key and not archive.holds(i, type_key):
+                    return None
+                return archive, i
+        return None
+
+    @contextlib.contextmanager
+    def _archiving(self):
+        with self.lock:
+            with open(os.path.join(self.archive_dir, 'lock'),
+                      'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield self._refresh()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def create(self, key, entity_uuid, value):
+        self.create_many([(key, entity_uuid, value)])
+
+    def create_many(self, entities, fragments=None):
+        self.hot.create_many(entities, fragments)
+        now = time.time()
+        if now - self.last_archive >= self.archive_interval:
+            self.archive(now)
+            self.sweep(now)
+
+    def _overflow(self, now):
+        """How many of the oldest hot entries are outside the hot window."""
+        overflow = 0
+        if self.hot_entries:
+            overflow = self.hot.count() - self.hot_entries
+        if self.hot_seconds:
+            overflow = max(overflow, self.hot.client.zcount(
+                self.hot.ENTRIES, '-inf', now - self.hot_seconds))
+        return overflow
+
+    def archive(self, now=None):
+        """Rolls full pages of entries outside the hot window to disk.
+
+        Returns how many entries were archived.
+        """
+        self.last_archive = now or time.time()
+        archived = 0
+        with self._archiving() as archives:
+            base = archives[-1].base + archives[-1].count if archives else 0
+            while self._overflow(self.last_archive) >= self.page_size:
+                uuids = self.hot.oldest_ids(None, self.page_size)
+                newest = self.hot.client.zscore(self.hot.ENTRIES, uuids[-1])
+                found = dict((e['id'], e) for e in self.hot.get_many(uuids))
+                page = [found[uuid] for uuid in uuids if uuid in found]
+                self._write_archive(base, page, newest)
+                pipe = self.hot.client.pipeline()
+                for entity in page:
+                    pipe.zrem(self.hot._index(entity['event_type']),
+                              entity['id'])
+                    pipe.delete('entry:%s' % entity['id'])
+                pipe.zrem(self.hot.ENTRIES, *uuids)
+                pipe.incr(self.hot.VERSION)
+                pipe.execute()
+                base += len(page)
+                archived += len(page)
+        if archived:
+            LOG.debug("Archived %d entries" % archived)
+        return archived
+
+    def _write_archive(self, base, page, newest):
+        # Written under temporary names and renamed, index first, so
+        # readers only ever see complete archives.
+        path = self._path(base)
+        index_path = path[:-len(SUFFIX)] + INDEX_SUFFIX
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(dict(ids=[e['id'] for e in page],
+                           types=[e['event_type'] for e in page],
+                           newest=newest), f)
+        with contextlib.closing(gzip.open(path + '.tmp', 'wb')) as f:
+            json.dump(page, f)
+        os.rename(index_path + '.tmp', index_path)
+        os.rename(path + '.tmp', path)
+
+    def sweep(self, now=None):
+        """Deletes the archives holding nothing newer than entry_ttl.
+
+        Returns how many entries were deleted.
+        """
+        if self.ttl <= 0:
+            return 0
+        cutoff = (now or time.time()) - self.ttl
+        removed = 0
+        with self._archiving() as archives:
+            for archive in archives:
+                if archive.newest >= cutoff:
+                    break
+                os.unlink(archive.path)
+                os.unlink(archive.path[:-len(SUFFIX)] + INDEX_SUFFIX)
+                removed += archive.count
+            if removed:
+                self.hot.client.incr(self.hot.VERSION)
+        if removed:
+            LOG.debug("Swept %d expired entries" % removed)
+        return removed
+
+    def version(self):
+        return self.hot.version()
+
+    def count(self, type_key=None):
+        return self.hot.count(type_key) + sum(len(a.records(type_key))
+                                              for a in self._refresh())
+
+    def get_many(self, entity_uuids):
+        found = dict((e['id'], e) for e in self.hot.get_many(entity_uuids))
+        archives = None
+        for entity_uuid in entity_uuids:
+            if entity_uuid in found:
+                continue
+            if archives is None:
+                archives = self._refresh()
+            located = self._find(archives, entity_uuid)
+            if located is not None:
+                found[entity_uuid] = self._read([located])[0]
+        return [found[uuid] for uuid in entity_uuids if uuid in found]
+
+    def get(self, key, entity_uuid):
+        """key is not used."""
+        entities = self.get_many([entity_uuid])
+        if not entities:
+            raise InvalidEntityUUID("Invalid event uuid: %s" % entity_uuid)
+        return entities
+
+    def _older(self, archives, type_key, start=None):
+        """Yields (archive, position) newest first, from before start."""
+        for archive in reversed(archives):
+            if start is not None and archive.base > start[0].base:
+                continue
+            records = archive.records(type_key)
+            i = len(records)
+            if start is not None and archive is start[0]:
+                i = bisect.bisect_left(records, start[1])
+            for k in xrange(i - 1, -1, -1):
+                yield archive, records[k]
+
+    def _newer(self, archives, type_key, start):
+        """Yields (archive, position) oldest first, from after start."""
+        for archive in archives:
+            if archive.base < start[0].base:
+                continue
+            records = archive.records(type_key)
+            i = 0
+            if archive is start[0]:
+                i = bisect.bisect_right(records, start[1])
+            for k in xrange(i, len(records)):
+                yield archive, records[k]
+
+    def _take(self, located, count):
+        """Up to count of located, and whether there were more."""
+        if count is None:
+            return list(located), False
+        taken = [l for l, _ in zip(located, xrange(count + 1))]
+        return taken[:count], len(taken) > count
+
+    def get_range(self, type_key=None, marker=None, limit=None,
+                  direction='older'):
+        """Fetches a keyset page, see yagi.persistence.Driver.get_range.
+
+        Pages that reach past the hot window carry on into the archives,
+        and the other way round.
+        """
+        return self._range(type_key, marker, limit, direction, False)
+
+    def get_range_ids(self, type_key=None, marker=None, limit=None,
+                      direction='older'):
+        """Like get_range, but reads archive indexes rather than entries."""
+        return self._range(type_key, marker, limit, direction, True)
+
+    def _range(self, type_key, marker, limit, direction, ids_only):
+        if ids_only:
+            hot_range, read = self.hot.get_range_ids, self._read_ids
+            read_hot = list
+        else:
+            hot_range, read = self.hot.get_range, self._read
+            read_hot = self.hot.get_many
+        version = self.hot.version()
+        hot_marker = marker is None or self.hot.client.zscore(
+            self.hot._index(type_key), marker) is not None
+        if hot_marker:
+            entities, has_newer, has_older = hot_range(
+                type_key, marker, limit, direction)
+            if marker is not None and direction == 'newer':
+                return entities, has_newer, True
+            need = limit - len(entities) if limit else None
+            if need == 0:
+                if not has_older:
+                    has_older = any(a.records(type_key)
+                                    for a in self._refresh(version))
+                return entities, has_newer, has_older
+            located, has_older = self._take(
+                self._older(self._refresh(version), type_key), need)
+            return entities + read(located), has_newer, has_older
+        archives = self._refresh(version)
+        start = self._find(archives, marker, type_key)
+        if start is None:
+            raise InvalidEntityUUID("Invalid marker: %s" % marker)
+        if direction != 'newer':
+            located, has_older = self._take(
+                self._older(archives, type_key, start), limit)
+            return read(located), True, has_older
+        located, has_newer = self._take(
+            self._newer(archives, type_key, start), limit)
+        entities = read(located)
+        if not has_newer:
+            need = limit - len(entities) if limit else None
+            hot = self.hot.rank_ids(type_key, 0,
+                                    need + 1 if need is not None else
+                                    self.hot.count(type_key))
+            has_newer = need is not None and len(hot) > need
+            entities.extend(read_hot(hot[:need]))
+        entities.reverse()
+        return entities, has_newer, True
+
+    def get_page(self, type_key=None, page_size=None, page=-1):
+        """Fetches a numbered page, counting up from the oldest archive."""
+        archives = self._refresh()
+        archived = sum(len(a.records(type_key)) for a in archives)
+        length = archived + self.hot.count(type_key)
+        maxpage = self.pages(page_size, length) - 1
+        if page < 0:
+            page = maxpage + 1 + page
+        if page < 0 or page > maxpage:
+            raise IndexError("Invalid page")
+        start, stop = 0, length
+        if page_size:
+            start = page * page_size
+            stop = min(start + page_size, length)
+        located = []
+        offset = 0
+        for archive in archives:
+            records = archive.records(type_key)
+            lo, hi = max(start - offset, 0), min(stop - offset, len(records))
+            located.extend((archive, records[k]) for k in xrange(lo, hi))
+            offset += len(records)
+        entities = self._read(located)
+        hot = self.hot.rank_ids(type_key, max(start - archived, 0),
+                                stop - archived)
+        entities.extend(self.hot.get_many(hot))
+        entities.reverse()
+        return entities, page, maxpage
+
+    def get_all(self, page_size=None, page=-1):
+        return self.get_page(None, page_size, page)[0]
+
+    def get_all_of_type(self, key, page_size=None, page=-1):
+        return self.get_page(key, page_size, page)[0]
@@ -1,4 +1,6 @@
+import hashlib
 import json
+import urllib
 
 import feedgenerator
 
@@ -6,6 +8,13 @@ import yagi.config
 import yagi.utils
 
 
+# RFC 5005 feed history namespace, for marking archived pages.
+HISTORY_NS = u"http://purl.org/syndication/history/1.0"
+# Bump whenever entries are rendered differently, so fragments stored by
+# render_entry before then are no longer used.
+FRAGMENT_VERSION = 1
+
+
 def _entity_link(entity_id, key):
     return unicode(''.join([_entity_url(), '%s/' % key, str(entity_id)]))
 
@@ -31,6 +40,19 @@ def _categories():
                 (conf(val).split(',') if conf(val) else [])]
 
 
+def _page_url(path, page):
+    return "%s%s?page=%s" % (_entity_url(), path, page)
+
+
+def _marker_url(path, marker, limit, direction=None):
+    query = [('marker', marker)]
+    if direction:
+        query.append(('direction', direction))
+    if limit:
+        query.append(('limit', limit))
+    return "%s%s?%s" % (_entity_url(), path, urllib.urlencode(query))
+
+
 def clean_content(cdict):
     return dict([i for i in cdict.items() if not i[0].startswith('_')])
 
@@ -52,8 +74,16 @@ class PagedFeed(feedgenerator.Atom1Feed):
                 dict(type='application/json'))
         handler.endElement(u"entry")
 
+    def root_attributes(self):
+        attrs = super(PagedFeed, self).root_attributes()
+        if self.feed.get('archive'):
+            attrs[u"xmlns:fh"] = HISTORY_NS
+        return attrs
+
     def add_root_elements(self, handler):
         super(PagedFeed, self).add_root_elements(handler)
+        if self.feed.get('archive'):
+            handler.addQuickElement(u"fh:archive", "")
         if self.feed.get('next_page_url') is not None:
             handler.addQuickElement(u"link",
                                     "",
@@ -66,29 +96,119 @@ class PagedFeed(feedgenerator.Atom1Feed):
                                      u"href": self.feed['previous_page_url']})
 
 
-def dumps(entities, previous_page=None, next_page=None):
-    """Serializes a list of dictionaries as an ATOM feed"""
-
+def _feed(previous_page=None, next_page=None, previous_marker=None,
+          next_marker=None, limit=None, path='', archive=False):
     title = unicode(yagi.config.get('event_feed', 'feed_title'))
-    feed = PagedFeed(
+    previous_page_url = next_page_url = None
+    # Either way, previous goes to older entries and next to newer ones.
+    if previous_page is not None:
+        previous_page_url = _page_url(path, previous_page)
+    elif previous_marker is not None:
+        previous_page_url = _marker_url(path, previous_marker, limit)
+    if next_page is not None:
+        next_page_url = _page_url(path, next_page)
+    elif next_marker is not None:
+        next_page_url = _marker_url(path, next_marker, limit, 'newer')
+    return PagedFeed(
         title=title,
         link=_entity_url(),
         feed_url=_entity_url(),
         description=title,
         language=u'en',
-        previous_page_url=("%s?page=%s" % (_entity_url(), previous_page))
-                          if previous_page is not None else None,
-        next_page_url=("%s?page=%s" % (_entity_url(), next_page))
-                          if next_page is not None else None)
+        previous_page_url=previous_page_url,
+        next_page_url=next_page_url,
+        archive=archive)
+
+
+def _add_item(feed, entity):
+    event_type = unicode(entity['event_type'])
+    feed.add_item(
+        title=unicode(entity['event_type']),
+        link=_entity_link(entity['id'], entity['event_type']),
+        description=event_type,
+        contents=entity['content'],
+        categories=[event_type] + _categories())
+
+
+def dumps(entities, **links):
+    """Serializes a list of dictionaries as an ATOM feed
+
+    The previous and next links either go to numbered pages (previous_page,
+    next_page), or to the entities older than previous_marker and newer
+    than next_marker, with up to limit entities per page. path is the
+    feed's path, e.g. an event type. An archive page is marked as one that
+    won't change any more.
+    """
+    return ''.join(iter_dumps(entities, **links))
+
+
+class _Chunks(object):
+    """A file for SimplerXMLGenerator that hands back what was written."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def fragment_signature():
+    """Identifies the settings entry fragments are currently rendered with.
+
+    A fragment stored with another signature, e.g. from before the feed
+    host changed, is rendered again instead.
+    """
+    return hashlib.md5(repr((FRAGMENT_VERSION, _entity_url(),
+                             _categories()))).hexdigest()
+
+
+def render_entry(entity):
+    """Renders an entity's <entry> element, just as it appears in a feed.
+
+    Returns (signature, fragment), for storing alongside the entity. See
+    fragment_signature.
+    """
+    out = _Chunks()
+    handler = feedgenerator.SimplerXMLGenerator(out, 'utf-8')
+    feed = _feed()
+    _add_item(feed, entity)
+    feed.write_item(handler, feed.items.pop())
+    return fragment_signature(), out.drain()
+
+
+def iter_dumps(entities, **links):
+    """Serializes an ATOM feed a piece at a time, for use as an app_iter.
+
+    Yields the feed header, then each entry as soon as entities produces
+    it, then the end of the feed. Takes the same arguments as dumps.
+    Entities that come with a current fragment from render_entry are
+    copied out as they are.
+    """
+    feed = _feed(**links)
+    out = _Chunks()
+    handler = feedgenerator.SimplerXMLGenerator(out, 'utf-8')
+    handler.startDocument()
+    handler.startElement(u"feed", feed.root_attributes())
+    feed.add_root_elements(handler)
+    yield out.drain()
+    signature = fragment_signature()
     for entity in entities:
-        event_type = unicode(entity['event_type'])
-        feed.add_item(
-            title=unicode(entity['event_type']),
-            link=_entity_link(entity['id'], entity['event_type']),
-            description=event_type,
-            contents=entity['content'],
-            categories=[event_type] + _categories())
-    return feed.writeString('utf-8')
+        fragment = entity.get('fragment')
+        if fragment is not None and entity.get('fragment_sig') == signature:
+            if isinstance(fragment, unicode):
+                fragment = fragment.encode('utf-8')
+            yield fragment
+            continue
+        _add_item(feed, entity)
+        feed.write_item(handler, feed.items.pop())
+        yield out.drain()
+    handler.endElement(u"feed")
+    yield out.drain()
 
 
 def dump_item(entity):
@@ -0,0 +1,261 @@
+"""Parks failed deliveries on disk and retries them in the background.
+
+Each entry is a small JSON document holding everything needed to retry
+the delivery. Entries live in a spool directory so they survive restarts,
+and in a heap ordered by when they are next due. Once an entry runs out
+of tries it is appended to a dead letter file, from which it can be put
+back into the spool later with replay_dead_letters.
+
+Several processes can share one spool directory. Each one claims a
+numbered slot under it with a lock file, and entries put into the
+``incoming`` directory are picked up by whichever process renames them
+into its slot first.
+"""
+
+import errno
+import fcntl
+import heapq
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import yagi.log
+
+LOG = yagi.log.logger
+
+INCOMING = "incoming"
+
+
+def _filename(entry_id):
+    return "%s.json" % re.sub(r"[^A-Za-z0-9_.-]", "_", str(entry_id))
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _write_entry(path, entry):
+    # Write then rename, so a crash never leaves half an entry behind.
+    tmp = "%s.tmp" % path
+    with open(tmp, "w") as f:
+        json.dump(entry, f)
+    os.rename(tmp, path)
+
+
+class RetrySpool(object):
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.incoming = os.path.join(base_dir, INCOMING)
+        _makedirs(self.incoming)
+        self.path, self.lock_file = self._claim_slot()
+
+    def _claim_slot(self):
+        slot = 0
+        while True:
+            path = os.path.join(self.base_dir, str(slot))
+            lock_file = open("%s.lock" % path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                slot += 1
+                continue
+            _makedirs(path)
+            return path, lock_file
+
+    def save(self, entry):
+        _write_entry(os.path.join(self.path, _filename(entry["id"])), entry)
+
+    def remove(self, entry):
+        try:
+            os.unlink(os.path.join(self.path, _filename(entry["id"])))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _read(self, directory):
+        entries = []
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    entries.append(json.load(f))
+            except (IOError, ValueError), e:
+                LOG.error("Skipping unreadable spool entry %s" % name)
+                LOG.exception(e)
+        return entries
+
+    def load(self):
+        """Returns the entries in our slot, from before a restart."""
+        return self._read(self.path)
+
+    def claim_incoming(self):
+        """Moves entries from the incoming directory into our slot."""
+        claimed = []
+        for name in os.listdir(self.incoming):
+            if not name.endswith(".json"):
+                continue
+            try:
+                os.rename(os.path.join(self.incoming, name),
+                          os.path.join(self.path, name))
+            except OSError:
+                # Another process got to it first.
+                continue
+            claimed.append(name)
+        if not claimed:
+            return []
+        return [e for e in self.load() if _filename(e["id"]) in claimed]
+
+
+class RetryScheduler(object):
+    """Retries spooled deliveries with jittered exponential backoff.
+
+    ``deliver(entry)`` is called from a background thread whenever an entry
+    is due, and must return True once the entry no longer needs retrying,
+    or None if it didn't even try, in which case the try isn't counted.
+    An entry that has been tried ``max_tries`` times goes to the dead letter
+    file instead. A ``max_tries`` of zero or less retries forever.
+    """
+
+    def __init__(self, spool, deliver, dead_letter_file, max_tries=-1,
+                 interval=30, max_wait=600, rescan_interval=60, name=None):
+        self.spool = spool
+        self.name = name
+        self.deliver = deliver
+        self.dead_letter_file = dead_letter_file
+        self.max_tries = max_tries
+        self.interval = interval
+        self.max_wait = max_wait
+        self.rescan_interval = rescan_interval
+        self.heap = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        for entry in spool.load():
+            self._push(entry)
+
+    def backoff(self, tries):
+        """Seconds to wait before the next try, with 'equal' jitter."""
+        delay = min(self.interval * (2 ** max(tries - 1, 0)), self.max_wait)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def _push(self, entry):
+        with self.cond:
+            heapq.heappush(self.heap, (entry["due"], entry["id"], entry))
+            self.cond.notify()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, entry_id, body, tries=1, error=None):
+        entry = dict(id=entry_id, body=body, tries=tries, error=error,
+                     due=time.time() + self.backoff(tries))
+        self.spool.save(entry)
+        self._push(entry)
+        return entry
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run,
+                                           name="yagi-retry-scheduler")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        next_scan = 0
+        while not self.stopped:
+            if time.time() >= next_scan:
+                for entry in self.spool.claim_incoming():
+                    self._push(entry)
+                next_scan = time.time() + self.rescan_interval
+            entry = self._next_due(next_scan)
+            if entry is not None:
+                self.retry(entry)
+
+    def _next_due(self, until):
+        with self.cond:
+            if self.stopped:
+                return None
+            now = time.time()
+            if self.heap and self.heap[0][0] <= now:
+                return heapq.heappop(self.heap)[2]
+            wait = until - now
+            if self.heap:
+                wait = min(wait, self.heap[0][0] - now)
+            self.cond.wait(max(wait, 0))
+        return None
+
+    def retry(self, entry):
+        try:
+            delivered = self.deliver(entry)
+        except Exception, e:
+            LOG.exception(e)
+            entry["error"] = str(e)
+            delivered = False
+        if delivered:
+            self.spool.remove(entry)
+            return True
+        if delivered is not None:
+            entry["tries"] += 1
+            if self.max_tries > 0 and entry["tries"] >= self.max_tries:
+                LOG.error("Giving up on %s after %d tries, moving it to %s" %
+                          (entry["id"], entry["tries"],
+                           self.dead_letter_file))
+                self.dead_letter(entry)
+                self.spool.remove(entry)
+                return False
+        entry["due"] = time.time() + self.backoff(entry["tries"])
+        self.spool.save(entry)
+        self._push(entry)
+        return False
+
+    def dead_letter(self, entry):
+        entry = dict(entry, failed_at=time.time(), spool=self.name)
+        with open(self.dead_letter_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def replay_dead_letters(dead_letter_file, spool_dir):
+    """Puts every dead letter back into the spool it came from.
+
+    Returns the number of entries replayed.
+    """
+    # Move the file aside first so nothing appended while we work is lost.
+    replaying = "%s.replaying" % dead_letter_file
+    try:
+        os.rename(dead_letter_file, replaying)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return 0
+        raise
+    count = 0
+    with open(replaying) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            entry.pop("failed_at", None)
+            incoming = os.path.join(spool_dir,
+                                    entry.pop("spool", None) or "default",
+                                    INCOMING)
+            _makedirs(incoming)
+            entry["tries"] = 0
+            entry["due"] = time.time()
+            _write_entry(os.path.join(incoming, _filename(entry["id"])),
+                         entry)
+            count += 1
+    os.unlink(replaying)
+    return count
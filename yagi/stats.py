@@ -38,6 +38,9 @@ class StatsD(object):
         return yagi.config.get("stats", "messages_sent",
                                 default="yagi.messages_sent")
 
+    def metric_name(self, key):
+        return yagi.config.get("stats", key, default="yagi.%s" % key)
+
 
 class NoDriver(object):
     def ping(self, data):
@@ -52,6 +55,9 @@ class NoDriver(object):
     def messages_sent(self):
         return "messages_sent"
 
+    def metric_name(self, key):
+        return key
+
 
 def time_stat(metric, value):
     """Format execution time."""
@@ -63,6 +69,16 @@ def increment_stat(metric, value=1):
     DRIVER.ping("%s:%s|c" % (metric, value))
 
 
+def gauge_stat(metric, value):
+    """Format gauge."""
+    DRIVER.ping("%s:%s|g" % (metric, value))
+
+
+def metric(key):
+    """Name of a metric, overridable in the [stats] section."""
+    return DRIVER.metric_name(key)
+
+
 def messages_sent():
     return DRIVER.messages_sent()
 
@@ -0,0 +1,173 @@
+"""Forks a fixed number of worker processes and keeps them running.
+
+The parent process does no real work itself. It restarts children that
+die, forwards SIGHUP/SIGTERM/SIGINT to them and collects whatever the
+children send back through their report pipes. A child exits on SIGHUP
+and is started again straight away, so it picks up any new configuration.
+"""
+
+import errno
+import json
+import os
+import select
+import signal
+import time
+
+import yagi.log
+
+LOG = yagi.log.logger
+
+FORWARDED_SIGNALS = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+# The status a child exits with when asked to reload.
+RELOAD_STATUS = 3
+
+
+class Reload(BaseException):
+    """Unwinds a child on SIGHUP.
+
+    Not an Exception, so the workers' own error handling lets it through.
+    """
+
+
+def _reload(signum, frame):
+    raise Reload()
+
+
+class Supervisor(object):
+    """Runs target(worker_index, report) in each of ``workers`` children.
+
+    ``report`` is a callable the child can use to send a JSON serializable
+    value to the parent, where it is passed on to ``on_report`` together
+    with the index of the worker that sent it.
+    """
+
+    def __init__(self, workers, target, on_report=None, respawn_delay=1):
+        self.workers = workers
+        self.target = target
+        self.on_report = on_report
+        self.respawn_delay = respawn_delay
+        self.children = {}
+        self.pipes = {}
+        self.buffers = {}
+        self.respawns = {}
+        self.stopping = False
+
+    def run(self):
+        for sig in FORWARDED_SIGNALS:
+            signal.signal(sig, self._handle_signal)
+        for index in xrange(self.workers):
+            self.spawn(index)
+        while self.children or self.respawns:
+            self._read_reports(1.0)
+            self._reap()
+            self._respawn()
+        LOG.info("All workers have exited")
+
+    def spawn(self, index):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for fd in self.pipes:
+                os.close(fd)
+            self._run_child(index, write_fd)
+        os.close(write_fd)
+        self.children[pid] = index
+        self.pipes[read_fd] = index
+        self.buffers[read_fd] = ""
+        LOG.info("Started worker %d with pid %d" % (index, pid))
+        return pid
+
+    def _run_child(self, index, write_fd):
+        for sig in FORWARDED_SIGNALS:
+            signal.signal(sig, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, _reload)
+        pipe = os.fdopen(write_fd, "w", 0)
+
+        def report(value):
+            pipe.write(json.dumps(value) + "\n")
+
+        status = 0
+        try:
+            self.target(index, report)
+        except Reload:
+            status = RELOAD_STATUS
+        except Exception, e:
+            LOG.exception(e)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _handle_signal(self, signum, frame):
+        if signum != signal.SIGHUP:
+            self.stopping = True
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _read_reports(self, timeout):
+        if not self.pipes:
+            time.sleep(timeout)
+            return
+        try:
+            readable, _, _ = select.select(self.pipes.keys(), [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            data = os.read(fd, 65536)
+            if not data:
+                # The child is gone, _reap will notice.
+                del self.pipes[fd]
+                del self.buffers[fd]
+                os.close(fd)
+                continue
+            lines = (self.buffers[fd] + data).split("\n")
+            self.buffers[fd] = lines.pop()
+            for line in lines:
+                if self.on_report:
+                    self.on_report(self.pipes[fd], json.loads(line))
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            if self.stopping:
+                LOG.info("Worker %d (pid %d) exited" % (index, pid))
+                continue
+            if (os.WIFEXITED(status) and
+                    os.WEXITSTATUS(status) == RELOAD_STATUS):
+                LOG.info("Worker %d (pid %d) reloaded, restarting" %
+                         (index, pid))
+                self.respawns[index] = time.time()
+                continue
+            if os.WIFSIGNALED(status):
+                reason = "signal %d" % os.WTERMSIG(status)
+            else:
+                reason = "status %d" % os.WEXITSTATUS(status)
+            LOG.error("Worker %d (pid %d) died with %s, restarting in %s "
+                      "seconds" % (index, pid, reason, self.respawn_delay))
+            self.respawns[index] = time.time() + self.respawn_delay
+
+    def _respawn(self):
+        now = time.time()
+        for index, when in self.respawns.items():
+            if self.stopping:
+                del self.respawns[index]
+            elif when <= now:
+                del self.respawns[index]
+                self.spawn(index)